@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""Length-aware batching of the topic/content texts
+
+The texts are sorted by token length and cut into batches holding at most `max_tokens` padded
+tokens, so that every batch is only padded to the length of its own longest text and short texts
+are encoded in larger batches. The datasets return the position of each item, which is used to
+put the outputs back into the order of the dataframe. `pad_sequences` pads the token ids of a batch
+to its longest sequence.
+
+Identical texts (e.g. content items sharing their title and description) are only encoded once: the
+`unique_texts` of a dataset tell which items are batched and scatter their outputs to the duplicates.
+"""
+
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import Sampler, BatchSampler, DataLoader
+
+from utils import print_log
+
+def token_lengths(tokenizer, texts, max_len, batch_size = 4096):
+    '''Number of tokens of each text once truncated to `max_len`, special tokens included'''
+    # Repeated texts (e.g. a topic in all its candidate pairs) are only tokenized once
+    codes, texts = pd.factorize(pd.Series(texts, dtype = object))
+    lengths = np.zeros(len(texts), dtype = np.int32)
+    for start in range(0, len(texts), batch_size):
+        batch = tokenizer(list(texts[start:start + batch_size]),
+                          max_length = max_len,
+                          truncation = True,
+                          return_attention_mask = False)['input_ids']
+        lengths[start:start + len(batch)] = [len(tokens) for tokens in batch]
+    return lengths[codes]
+
+def pad_sequences(sequences, pad_token_id, max_len = None):
+    '''Token ids of `sequences` (truncated to `max_len`) padded to the longest one, and the attention mask'''
+    lengths = np.array([len(sequence) for sequence in sequences], dtype = np.int64)
+    if max_len is not None:
+        lengths = np.minimum(lengths, max_len)
+    width = max(int(lengths.max()), 1) if len(lengths) > 0 else 1
+    input_ids = np.full((len(sequences), width), pad_token_id, dtype = np.int64)
+    for i, (sequence, length) in enumerate(zip(sequences, lengths)):
+        input_ids[i, :length] = sequence[:length]
+    attention_mask = (np.arange(width) < lengths[:, None]).astype(np.int64)
+    return input_ids, attention_mask
+
+class UniqueTexts(object):
+    '''
+    The distinct texts of a dataset, or the distinct tuples of texts when several columns are given (e.g. the topic
+    and content texts of a pair). `first` holds the position of the first occurrence of each of them, in ascending
+    order, and `inverse` the distinct text at every position.
+    '''
+    def __init__(self, *columns):
+        inverse = np.zeros(len(columns[0]), dtype = np.int64)
+        for column in columns:
+            codes, uniques = pd.factorize(pd.Series(column, dtype = object))
+            # The codes are numbered by first occurrence, so are the distinct texts
+            inverse, _ = pd.factorize(inverse * len(uniques) + codes)
+        self.inverse = inverse.astype(np.int64)
+        self.first = np.unique(self.inverse, return_index = True)[1]
+
+    def __len__(self):
+        return len(self.first)
+
+    @property
+    def duplicate_ratio(self):
+        return 1 - len(self.first) / max(len(self.inverse), 1)
+
+    def summary(self):
+        return f'{len(self)}/{len(self.inverse)} distinct texts ({self.duplicate_ratio:.1%} duplicates)'
+
+    def scatter(self, array):
+        '''The outputs of every position, given the outputs of the distinct texts in the order of `first`'''
+        return array[torch.from_numpy(self.inverse)] if torch.is_tensor(array) else array[self.inverse]
+
+    def fill_duplicates(self, array):
+        '''Copy, in place, the outputs at the first occurrences of the texts to the positions of their duplicates'''
+        duplicates = np.ones(len(self.inverse), dtype = bool)
+        duplicates[self.first] = False
+        duplicates = np.flatnonzero(duplicates)
+        array[duplicates] = array[self.first[self.inverse[duplicates]]]
+        return array
+
+class TokenBudgetBatchSampler(Sampler):
+    def __init__(self, lengths, max_tokens, max_batch_size = None, indices = None):
+        self.lengths = np.asarray(lengths)
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        # Longest texts first, so that running out of memory shows up on the first batch
+        if indices is None:
+            order = np.argsort(-self.lengths, kind = 'stable')
+        else:
+            order = indices[np.argsort(-self.lengths[indices], kind = 'stable')]
+        self.batches = self._make_batches(order)
+
+    def _make_batches(self, order):
+        batches = []
+        start = 0
+        while start < len(order):
+            # The first item of the batch is the longest one, it sets the padded length
+            width = max(int(self.lengths[order[start]]), 1)
+            size = max(self.max_tokens // width, 1)
+            if self.max_batch_size is not None:
+                size = min(size, self.max_batch_size)
+            batches.append(order[start:start + size])
+            start += size
+        return batches
+
+    def __iter__(self):
+        for batch in self.batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        return len(self.batches)
+
+    def padded_tokens(self):
+        return sum(len(batch) * int(self.lengths[batch].max()) for batch in self.batches)
+
+class ShuffledTokenBudgetBatchSampler(Sampler):
+    '''
+    Training batches of approximately equal lengths holding at most `max_tokens` padded tokens. `lengths` has one
+    column per sequence of an item (e.g. topic and content), each padded to its own maximum within the batch.
+    Every epoch the items are shuffled, cut into buckets of `bucket_size` items that are sorted by lengths and
+    packed into batches, and the batches are shuffled, all from `seed + epoch` so each epoch is reproducible.
+    '''
+    def __init__(self, lengths, max_tokens, bucket_size, max_batch_size = None, seed = 0):
+        lengths = np.asarray(lengths)
+        self.lengths = lengths.reshape(len(lengths), -1)
+        self.max_tokens = max_tokens
+        self.bucket_size = bucket_size
+        self.max_batch_size = max_batch_size
+        self.seed = seed
+        self.set_epoch(0)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.batches = self.make_batches(epoch)
+
+    def _pack(self, bucket, batches):
+        lengths = self.lengths[bucket].tolist()
+        start = 0
+        widths = [0] * self.lengths.shape[1]
+        for i, item_lengths in enumerate(lengths):
+            new_widths = [max(width, length) for width, length in zip(widths, item_lengths)]
+            size = i - start + 1
+            full = self.max_batch_size is not None and size > self.max_batch_size
+            if size > 1 and (full or size * sum(new_widths) > self.max_tokens):
+                batches.append(bucket[start:i])
+                start = i
+                new_widths = item_lengths
+            widths = new_widths
+        if start < len(bucket):
+            batches.append(bucket[start:])
+
+    def make_batches(self, epoch):
+        rng = np.random.default_rng(self.seed + epoch)
+        order = rng.permutation(len(self.lengths))
+        batches = []
+        for start in range(0, len(order), self.bucket_size):
+            bucket = order[start:start + self.bucket_size]
+            # Sorted by the length of the first sequence, then of the second one...
+            self._pack(bucket[np.lexsort(self.lengths[bucket].T[::-1])], batches)
+        return [batches[i] for i in rng.permutation(len(batches))]
+
+    def num_batches(self, epoch):
+        return len(self.batches) if epoch == self.epoch else len(self.make_batches(epoch))
+
+    def __iter__(self):
+        for batch in self.batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        return len(self.batches)
+
+    def padded_tokens(self):
+        return sum(len(batch) * int(self.lengths[batch].max(axis = 0).sum()) for batch in self.batches)
+
+def inference_dataloader(cfg, dataset, max_tokens, collate_fn = None, num_workers = None):
+    '''
+    DataLoader over the items of `dataset` in token-budget batches of `max_tokens` padded tokens, or in batches of
+    `cfg.batch_size` in the dataframe order when it is None. When the dataset has `unique_texts`, only the first
+    occurrence of every distinct text is batched.
+    '''
+    num_workers = cfg.num_workers if num_workers is None else num_workers
+    unique_texts = getattr(dataset, 'unique_texts', None)
+    indices = None
+    if unique_texts is not None:
+        print_log(cfg, f'Encoding {unique_texts.summary()}')
+        indices = unique_texts.first
+    if max_tokens is None:
+        if indices is None:
+            return DataLoader(dataset, batch_size = cfg.batch_size, num_workers = num_workers, shuffle = False,
+                              collate_fn = collate_fn)
+        batch_sampler = BatchSampler(indices.tolist(), cfg.batch_size, drop_last = False)
+    else:
+        batch_sampler = TokenBudgetBatchSampler(dataset.token_lengths(), max_tokens, indices = indices)
+    return DataLoader(dataset, batch_sampler = batch_sampler, num_workers = num_workers, collate_fn = collate_fn)
@@ -0,0 +1,1023 @@
+# -*- coding: utf-8 -*-
+"""Micro-benchmarks of the data structures used by the training scripts
+
+Usage:
+    python benchmarks.py [name ...]
+
+The competition data in `data/` is used when it is available, otherwise a synthetic
+curriculum of a similar shape is generated.
+"""
+
+import os, sys, time, shutil, tracemalloc, subprocess
+import numpy as np
+import pandas as pd
+
+from topic_tree import TopicTree
+from topic_content_index import TopicContentIndex
+from preprocessing import join_fields
+from batching import TokenBudgetBatchSampler, ShuffledTokenBudgetBatchSampler, UniqueTexts, pad_sequences
+from token_store import TokenStore
+from embedding_store import EmbeddingStore, EmbeddingCache
+from index_store import SearchIndexStore
+from candidates import CandidateSet
+from embedding_inference import inference_model, inference_autocast, parity_report, run_sharded, ShardEncoder, \
+                                InferenceEngine
+from search_index import projection_report, ivf_sweep, pq_report, int8_report, exact_search, normalize, LanguagePartitionedIndex
+
+comp_data_dir = 'data'
+
+"""# Data"""
+
+def synthetic_topics(num_topics = 76972, num_channels = 171, max_children = 12, seed = 2022):
+    rng = np.random.default_rng(seed)
+    ids = np.array([f't_{i:012x}' for i in range(num_topics)], dtype = object)
+    parents = np.empty(num_topics, dtype = object)
+    channels = np.empty(num_topics, dtype = object)
+    levels = np.zeros(num_topics, dtype = np.int64)
+
+    # Each channel is a tree grown breadth-first from its root
+    roots = np.sort(rng.choice(np.arange(1, num_topics), size = num_channels - 1, replace = False))
+    roots = np.concatenate([[0], roots])
+    for channel, (start, end) in enumerate(zip(roots, np.append(roots[1:], num_topics))):
+        parents[start] = np.nan
+        channels[start] = f'c_{channel:06x}'
+        frontier, node = [start], start + 1
+        while node < end:
+            next_frontier = []
+            for parent in frontier:
+                for _ in range(rng.integers(1, max_children + 1)):
+                    if node >= end:
+                        break
+                    parents[node] = ids[parent]
+                    channels[node] = channels[start]
+                    levels[node] = levels[parent] + 1
+                    next_frontier.append(node)
+                    node += 1
+            frontier = next_frontier or [node - 1]
+
+    languages = rng.choice(['en', 'es', 'pt', 'ar', 'fr', 'bn', 'sw', 'gu'], size = num_topics)
+    return pd.DataFrame({
+        'id': ids,
+        'title': [f'topic title {i}' for i in range(num_topics)],
+        'description': np.where(rng.random(num_topics) < 0.5, None, 'some description'),
+        'channel': channels,
+        'category': rng.choice(['source', 'supplemental', 'aligned'], size = num_topics),
+        'level': levels,
+        'language': languages,
+        'parent': parents,
+        'has_content': rng.random(num_topics) < 0.8,
+    })
+
+def synthetic_content(num_content = 154047, mean_text_len = 600, num_empty = 0, seed = 2022):
+    rng = np.random.default_rng(seed)
+    vocabulary = np.array(['lesson', 'number', 'fraction', 'energy', 'cell', 'map', 'history', 'reading', 'water',
+                           'equation', 'graph', 'story', 'music', 'planet', 'language', 'practice'], dtype = object)
+    text_lens = rng.lognormal(np.log(mean_text_len / 8), 1., size = num_content).astype(np.int64)
+    words = rng.choice(vocabulary, size = text_lens.sum())
+    texts = [' '.join(chunk) for chunk in np.split(words, np.cumsum(text_lens)[:-1])]
+    texts = np.where(rng.random(num_content) < 0.4, None, np.array(texts, dtype = object))
+    # The last `num_empty` items have neither a description nor a text
+    empty = np.arange(num_content) >= num_content - num_empty
+    texts[empty] = None
+    return pd.DataFrame({
+        'id': [f'c_{i:012x}' for i in range(num_content)],
+        'title': [f'content title {i % 50000}' for i in range(num_content)],
+        'description': np.where((rng.random(num_content) < 0.6) | empty, None, 'a short description'),
+        'kind': rng.choice(['document', 'video', 'exercise', 'audio', 'html5'], size = num_content),
+        'text': texts,
+        'language': rng.choice(['en', 'es', 'pt', 'ar', 'fr', 'bn', 'sw', 'gu'], size = num_content),
+        'copyright_holder': None,
+        'license': None,
+    })
+
+def synthetic_correlations(topics_df, content_df, max_content = 9, seed = 2022):
+    rng = np.random.default_rng(seed)
+    topic_ids = topics_df.loc[topics_df['has_content'], 'id'].values
+    num_content = rng.integers(1, max_content + 1, size = len(topic_ids))
+    content_ids = content_df['id'].values[rng.integers(0, len(content_df), size = num_content.sum())]
+    return pd.DataFrame({
+        'topic_id': topic_ids,
+        'content_ids': [' '.join(chunk) for chunk in np.split(content_ids, np.cumsum(num_content)[:-1])],
+    })
+
+def load_topics():
+    path = os.path.join(comp_data_dir, 'topics.csv')
+    if os.path.exists(path):
+        return pd.read_csv(path)
+    return synthetic_topics()
+
+def load_content():
+    path = os.path.join(comp_data_dir, 'content.csv')
+    if os.path.exists(path):
+        return pd.read_csv(path)
+    return synthetic_content()
+
+def load_correlations(topics_df, content_df):
+    path = os.path.join(comp_data_dir, 'correlations.csv')
+    if os.path.exists(path):
+        return pd.read_csv(path)
+    return synthetic_correlations(topics_df, content_df)
+
+def synthetic_embeddings(num_topics = 20000, num_content = 154047, dim = 768, num_languages = 30, seed = 2022):
+    # Embeddings sharing a mean direction, with a decaying spectrum, and topics close to some content items (in
+    # their language); a few languages hold most of the content
+    rng = np.random.default_rng(seed)
+    basis = np.linalg.qr(rng.normal(size = (dim, dim)))[0] * (1 / np.sqrt(np.arange(1, dim + 1)))
+    mean = rng.normal(size = dim) / np.sqrt(dim)
+    content_embeddings = (rng.normal(size = (num_content, dim)) @ basis.T + mean).astype(np.float32)
+    language_weights = 1 / np.arange(1, num_languages + 1)**1.5
+    content_languages = rng.choice(num_languages, num_content, p = language_weights / language_weights.sum())
+    sources = rng.integers(0, num_content, num_topics)
+    topic_embeddings = content_embeddings[sources]
+    topic_embeddings = topic_embeddings + (0.5 * rng.normal(size = (num_topics, dim)) @ basis.T).astype(np.float32)
+    return topic_embeddings, content_languages[sources], content_embeddings, content_languages
+
+def load_embeddings(store_dir = 'ext_data/embeddings'):
+    '''The latest topic and content embeddings and languages stored by the re-ranker, synthetic ones when there are none'''
+    stores = {}
+    for name in ['topics', 'content']:
+        paths = [os.path.join(store_dir, path) for path in os.listdir(store_dir)
+                 if path.startswith(f'{name}_v') and '.' not in path] if os.path.isdir(store_dir) else []
+        if paths:
+            stores[name] = EmbeddingStore(max(paths, key = os.path.getmtime))
+    if len(stores) == 2:
+        return tuple(array for name in ['topics', 'content'] for array in stores[name].load()[1:])
+    return synthetic_embeddings()
+
+def synthetic_tokenizer(texts, vocab_size = 8000):
+    '''A small WordPiece tokenizer trained on `texts`, so the benchmarks run without downloading a backbone'''
+    from tokenizers import Tokenizer, models, normalizers, pre_tokenizers, processors, trainers
+    from transformers import PreTrainedTokenizerFast
+    special_tokens = ['[PAD]', '[UNK]', '[CLS]', '[SEP]']
+    tokenizer = Tokenizer(models.WordPiece(unk_token = '[UNK]'))
+    tokenizer.normalizer = normalizers.BertNormalizer()
+    tokenizer.pre_tokenizer = pre_tokenizers.BertPreTokenizer()
+    tokenizer.train_from_iterator(texts, trainers.WordPieceTrainer(vocab_size = vocab_size, special_tokens = special_tokens))
+    tokenizer.post_processor = processors.TemplateProcessing(
+        single = '[CLS] $A [SEP]', special_tokens = [(token, tokenizer.token_to_id(token)) for token in ['[CLS]', '[SEP]']])
+    return PreTrainedTokenizerFast(tokenizer_object = tokenizer, pad_token = '[PAD]', unk_token = '[UNK]',
+                                   cls_token = '[CLS]', sep_token = '[SEP]')
+
+def peak_memory(fn, *args):
+    # Peak of the Python allocations made by `fn`, in MB
+    tracemalloc.start()
+    output = fn(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 2**20, output
+
+def timeit(fn, *args, repeat = 1):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        output = fn(*args)
+    return (time.perf_counter() - start) / repeat, output
+
+"""# Topic tree"""
+
+def legacy_parent(topics_df, topic_id):
+    parent_id = topics_df.loc[topic_id].parent
+    return None if pd.isna(parent_id) else parent_id
+
+def legacy_ancestors(topics_df, topic_id):
+    ancestors = []
+    parent = legacy_parent(topics_df, topic_id)
+    while parent is not None:
+        ancestors.append(parent)
+        parent = legacy_parent(topics_df, parent)
+    return ancestors
+
+def legacy_children(topics_df, topic_id):
+    return topics_df[topics_df.parent == topic_id].index.tolist()
+
+def legacy_siblings(topics_df, topic_id):
+    parent = legacy_parent(topics_df, topic_id)
+    if parent is None:
+        return []
+    return [child for child in legacy_children(topics_df, parent) if child != topic_id]
+
+def benchmark_topic_tree(num_queries = 200, seed = 2022):
+    topics_df = load_topics()
+    build_time, tree = timeit(TopicTree.from_df, topics_df)
+    print(f'TopicTree over {len(tree)} topics built in {build_time:.3f}s')
+
+    indexed_df = topics_df.set_index('id')
+    sample = np.random.default_rng(seed).choice(len(tree), size = num_queries, replace = False)
+    sample_ids = tree.ids[sample]
+
+    queries = {
+        'parent': (legacy_parent, tree.parent),
+        'ancestors': (legacy_ancestors, tree.ancestors),
+        'children': (legacy_children, tree.children),
+        'siblings': (legacy_siblings, tree.siblings),
+    }
+    for name, (legacy_fn, tree_fn) in queries.items():
+        legacy_time, legacy_output = timeit(lambda: [legacy_fn(indexed_df, topic_id) for topic_id in sample_ids])
+        tree_time, tree_output = timeit(lambda: [tree_fn(idx) for idx in sample])
+
+        # Both sides must agree before the timings mean anything
+        if name == 'parent':
+            tree_output = [None if p < 0 else tree.ids[p] for p in tree_output]
+        else:
+            tree_output = [tree.ids[nodes].tolist() for nodes in tree_output]
+        assert tree_output == legacy_output, f'TopicTree.{name} disagrees with the pandas lookup!'
+
+        print(f'{name:>10s}: pandas {1e6 * legacy_time / num_queries:10.1f}us/query - '
+              f'TopicTree {1e6 * tree_time / num_queries:8.2f}us/query - '
+              f'speed-up x{legacy_time / tree_time:.0f}')
+
+    subtree_time, _ = timeit(lambda: [tree.subtree(idx) for idx in tree.roots])
+    print(f'   subtree: all {len(tree.roots)} channels walked in {subtree_time:.3f}s')
+
+def benchmark_breadcrumbs(num_legacy = 2000, separator = '</s>'):
+    topics_df = load_topics()
+    topics_df['description'] = topics_df['description'].fillna(' ')
+    tree = TopicTree.from_df(topics_df)
+    topics_df = topics_df.set_index('id')
+    topics_df['input_text'] = topics_df['language'] + '[LECR]' + topics_df['title'] + '[LECR]' + topics_df['description']
+
+    # The per-topic loop of the training scripts, timed on a prefix and extrapolated
+    def legacy_loop(topic_ids):
+        topics_df['text'] = topics_df['input_text'].values
+        for topic_id in topic_ids:
+            chain = [topic_id] + legacy_ancestors(topics_df, topic_id)
+            topics_df.loc[topic_id, 'text'] = separator.join([topics_df.loc[t]['input_text'] for t in chain])
+        return topics_df['text'].values
+
+    legacy_time, legacy_output = timeit(legacy_loop, tree.ids[:num_legacy])
+    legacy_time = legacy_time * len(tree) / num_legacy
+
+    texts = topics_df['input_text'].values
+    tree_time, tree_output = timeit(tree.breadcrumbs, texts, separator)
+    assert (tree_output[:num_legacy] == legacy_output[:num_legacy]).all(), 'The breadcrumbs differ!'
+    print(f'Breadcrumbs of {len(tree)} topics: loop ~{legacy_time:.1f}s (extrapolated) - level order {tree_time:.3f}s')
+
+    near_time, _ = timeit(tree.near_ancestors, texts, separator, 2)
+    print(f'Near ancestors (how_near = 2): {near_time:.3f}s')
+
+"""# Topic <-> content index"""
+
+def benchmark_topic_content_index(num_queries = 50, nfolds = 5, seed = 2022):
+    topics_df, content_df = load_topics(), load_content()[['id']]
+    correlations_df = load_correlations(topics_df, content_df)
+    topics_df['fold'] = np.random.default_rng(seed).integers(0, nfolds, size = len(topics_df))
+    correlations_df['fold'] = correlations_df['topic_id'].map(topics_df.set_index('id')['fold'])
+
+    def legacy_content_fold():
+        content_fold = pd.Series(-1, index = content_df.index)
+        for fold in range(nfolds):
+            content_in_fold = set(correlations_df.loc[correlations_df['fold'] == fold, 'content_ids'].str.split().explode().tolist())
+            content_not_in_fold = set(correlations_df.loc[correlations_df['fold'] != fold, 'content_ids'].str.split().explode().tolist())
+            content_fold.loc[content_df['id'].isin(content_in_fold - content_not_in_fold)] = fold
+        return content_fold.values
+
+    build_time, index = timeit(TopicContentIndex.from_correlations, correlations_df, topics_df['id'].values, content_df['id'].values)
+    print(f'Index over {index.num_edges} edges built in {build_time:.3f}s')
+
+    legacy_time, legacy_fold = timeit(legacy_content_fold)
+    index_time, index_fold = timeit(index.content_fold, topics_df['fold'].values)
+    assert (legacy_fold == index_fold).all(), 'The content folds differ!'
+    print(f'Content fold assignment: sets {legacy_time:.3f}s - index {index_time:.4f}s')
+
+    # `ContentItem.topics` / `Topic.content`
+    indexed_correlations = correlations_df.set_index('topic_id')
+    sample = np.random.default_rng(seed).choice(index.content_ids[index.content_degree() > 0], size = num_queries)
+    legacy_time, _ = timeit(lambda: [indexed_correlations[indexed_correlations.content_ids.str.contains(c)].index.tolist() for c in sample])
+    index_time, _ = timeit(lambda: [index.topic_ids_of(c) for c in sample])
+    print(f'content -> topics: str.contains {1e3 * legacy_time / num_queries:.2f}ms/query - index {1e6 * index_time / num_queries:.2f}us/query')
+
+    topic_sample = correlations_df['topic_id'].values[:num_queries]
+    legacy_time, _ = timeit(lambda: [indexed_correlations.loc[t].content_ids.split() for t in topic_sample])
+    index_time, _ = timeit(lambda: [index.content_ids_of(t) for t in topic_sample])
+    print(f'topic -> content: split {1e6 * legacy_time / num_queries:.2f}us/query - index {1e6 * index_time / num_queries:.2f}us/query')
+
+"""# Input text"""
+
+def benchmark_input_text(sep_token = '[LECR]', chunk_size = 20000):
+    content_df = load_content()
+    for column in ['title', 'description', 'text']:
+        content_df[column] = content_df[column].fillna(' ')
+    fields = ['language', 'title', 'description', 'text', 'kind']
+
+    def legacy_apply():
+        return content_df.apply(lambda x: sep_token.join([x[field] for field in fields]), axis = 1).values
+
+    legacy_time, legacy_output = timeit(legacy_apply)
+    vectorized_time, vectorized_output = timeit(join_fields, content_df, fields, sep_token, chunk_size)
+    assert (legacy_output == vectorized_output).all(), 'The input texts differ!'
+    print(f'input_text of {len(content_df)} content items: apply {legacy_time:.2f}s - column-wise {vectorized_time:.2f}s - '
+          f'speed-up x{legacy_time / vectorized_time:.1f}')
+
+    output_size = sum(len(text) for text in vectorized_output) / 2**20
+    for chunk in [len(content_df), chunk_size]:
+        peak, _ = peak_memory(join_fields, content_df, fields, sep_token, chunk)
+        print(f'Peak allocations with chunks of {chunk} rows: {peak:.0f}MB (output text ~{output_size:.0f}MB)')
+
+"""# Content ingestion"""
+
+def benchmark_content_ingestion(chunksize = 20000, max_len = 32):
+    path = os.path.join(comp_data_dir, 'content.csv')
+    if not os.path.exists(path):
+        # Its last chunk has no description/text at all, pandas reads such columns as float64
+        path = os.path.join('/tmp', f'synthetic_content_{chunksize}.csv')
+        if not os.path.exists(path):
+            synthetic_content(num_empty = chunksize).to_csv(path, index = False)
+
+    # Every mode runs in a fresh interpreter, so that its peak RSS is not polluted by the others
+    script = '''
+import sys, time
+sys.path.insert(0, {repo!r})
+from preprocessing import read_content_csv
+class Config(object):
+    content_chunksize = {chunksize!r}
+    content_char_budget = {budget!r}
+start = time.time()
+df = read_content_csv(Config(), {path!r})
+elapsed = time.time() - start
+# ru_maxrss would include the RSS of the forking benchmark process, the high-water mark of this image does not
+peak_rss = int(next(line for line in open('/proc/self/status') if line.startswith('VmHWM')).split()[1]) / 1024
+print(elapsed, peak_rss, df.memory_usage(deep = True).sum() / 2**20)
+'''
+    repo = os.path.dirname(os.path.abspath(__file__))
+    budget = {'title': 16 * max_len, 'description': 16 * max_len, 'text': 16 * max_len}
+    modes = {
+        'read_csv': (None, None),
+        'chunked': (chunksize, None),
+        'chunked + clipped': (chunksize, budget),
+    }
+    for name, (mode_chunksize, mode_budget) in modes.items():
+        code = script.format(repo = repo, chunksize = mode_chunksize, budget = mode_budget, path = path)
+        output = subprocess.run([sys.executable, '-c', code], capture_output = True, text = True, check = True).stdout
+        elapsed, peak_rss, frame_size = map(float, output.split())
+        print(f'{name:>18s}: {elapsed:.2f}s - peak RSS {peak_rss:.0f}MB - dataframe {frame_size:.0f}MB')
+
+def legacy_restore_order(positions, outputs):
+    '''The outputs of the batches put back into the order of the dataset, given the position of every item'''
+    return outputs[np.argsort(np.concatenate(positions), kind = 'stable')]
+
+def benchmark_length_bucketing(num_texts = 2048, max_len = 256, batch_size = 32, seed = 2022):
+    import torch
+    from torch.utils.data import Dataset, DataLoader
+    from transformers import BertConfig, BertModel
+
+    # A small randomly initialized encoder, the length distribution is skewed like the content texts
+    torch.manual_seed(seed)
+    model = BertModel(BertConfig(vocab_size = 30000, hidden_size = 256, num_hidden_layers = 4, num_attention_heads = 4,
+                                 intermediate_size = 1024, max_position_embeddings = max_len)).eval()
+    rng = np.random.default_rng(seed)
+    lengths = np.clip(rng.lognormal(np.log(max_len / 6), 0.8, num_texts), 4, max_len).astype(np.int32)
+
+    class PaddedDataset(Dataset):
+        def __len__(self):
+            return num_texts
+        def __getitem__(self, idx):
+            input_ids = np.zeros(max_len, dtype = np.int64)
+            input_ids[:lengths[idx]] = (idx * 7919 + np.arange(lengths[idx])) % 29999 + 1
+            return {'idx': idx, 'input_ids': torch.from_numpy(input_ids),
+                    'attention_mask': torch.from_numpy((input_ids > 0).astype(np.int64))}
+
+    def encode(dataloader):
+        positions, embeddings = [], []
+        with torch.no_grad():
+            for item in dataloader:
+                local_len = int(item['attention_mask'].sum(axis = 1).max())
+                mask = item['attention_mask'][:, :local_len]
+                output = model(item['input_ids'][:, :local_len], attention_mask = mask).last_hidden_state
+                embeddings.append(((output * mask.unsqueeze(-1)).sum(dim = 1) / mask.sum(dim = -1, keepdims = True)).numpy())
+                positions.append(item['idx'].numpy())
+        return legacy_restore_order(positions, np.concatenate(embeddings))
+
+    num_tokens = lengths.sum()
+    fixed_padded = sum(lengths[start:start + batch_size].max() * len(lengths[start:start + batch_size])
+                       for start in range(0, num_texts, batch_size))
+    elapsed, fixed_embeddings = timeit(encode, DataLoader(PaddedDataset(), batch_size = batch_size, shuffle = False))
+    print(f'fixed batches of {batch_size}: {num_texts / elapsed:.0f} texts/s - '
+          f'{fixed_padded / num_tokens:.2f} padded tokens per token')
+    for max_tokens in [batch_size * max_len // 2, batch_size * max_len, 2 * batch_size * max_len]:
+        sampler = TokenBudgetBatchSampler(lengths, max_tokens)
+        elapsed, embeddings = timeit(encode, DataLoader(PaddedDataset(), batch_sampler = sampler))
+        print(f'token budget {max_tokens}: {num_texts / elapsed:.0f} texts/s - '
+              f'{sampler.padded_tokens() / num_tokens:.2f} padded tokens per token - {len(sampler)} batches - '
+              f'max diff {np.abs(embeddings - fixed_embeddings).max():.1e}')
+
+def benchmark_train_batching(num_pairs = 600000, max_len = 32, batch_size = 32, nepochs = 3, seed = 2022):
+    # Topic/content token lengths of the retriever pairs, topics are breadcrumbs and mostly hit max_len
+    rng = np.random.default_rng(seed)
+    lengths = np.stack([np.clip(rng.lognormal(np.log(max_len / 1.5), 0.6, num_pairs), 4, max_len),
+                        np.clip(rng.lognormal(np.log(max_len / 3), 0.8, num_pairs), 3, max_len)], axis = 1).astype(np.int32)
+    num_tokens = lengths.sum()
+
+    def describe(name, batches, elapsed):
+        padded = np.array([len(batch) * lengths[batch].max(axis = 0).sum() for batch in batches])
+        sizes = np.array([len(batch) for batch in batches])
+        print(f'{name}: {len(batches)} batches ({elapsed:.2f}s) - {padded.sum() / num_tokens:.2f} padded tokens per token - '
+              f'tokens per batch {padded.mean():.0f} +/- {padded.std():.0f} - pairs per batch {sizes.mean():.1f}')
+
+    start = time.perf_counter()
+    order = rng.permutation(num_pairs)
+    describe(f'shuffled batches of {batch_size}', [order[i:i + batch_size] for i in range(0, num_pairs, batch_size)],
+             time.perf_counter() - start)
+    elapsed, sampler = timeit(ShuffledTokenBudgetBatchSampler, lengths, 2 * batch_size * max_len, 100 * batch_size,
+                              4 * batch_size, seed)
+    describe(f'token budget {2 * batch_size * max_len}', sampler.batches, elapsed)
+    print('batches per epoch:', [sampler.num_batches(epoch) for epoch in range(nepochs)])
+
+def benchmark_pair_assembly(num_topics = 400, num_content = 4000, num_k = 50, max_len = 128, seed = 2022):
+    import tempfile
+    rng = np.random.default_rng(seed)
+    topics_df = synthetic_topics(num_topics = num_topics, num_channels = 4)
+    content_df = synthetic_content(num_content = num_content)
+    topic_texts = (topics_df['title'] + ' ' + topics_df['description'].fillna('')).values
+    content_texts = (content_df['title'] + ' ' + content_df['text'].fillna('')).values
+    tokenizer = synthetic_tokenizer(np.concatenate([topic_texts, content_texts]))
+
+    # num_k candidates per topic, as in the reranker
+    pair_topics = np.repeat(np.arange(num_topics), num_k)
+    pair_contents = rng.integers(0, num_content, size = len(pair_topics))
+
+    def per_pair():
+        pairs = []
+        for t, c in zip(pair_topics, pair_contents):
+            topic_token = tokenizer(topic_texts[t], padding = 'max_length', max_length = max_len, truncation = True)
+            content_token = tokenizer(content_texts[c], padding = 'max_length', max_length = max_len, truncation = True)
+            pairs.append(topic_token['input_ids'] + content_token['input_ids'][1:])
+        return pairs
+
+    def from_stores(path):
+        topic_store = TokenStore.build(os.path.join(path, 'topics'), topics_df['id'].values, topic_texts, tokenizer, max_len)
+        content_store = TokenStore.build(os.path.join(path, 'content'), content_df['id'].values, content_texts, tokenizer, max_len)
+        pairs = []
+        for t, c in zip(pair_topics, pair_contents):
+            topic_input_ids, _ = topic_store.padded(t)
+            content_input_ids, _ = content_store.padded(c)
+            pairs.append(np.concatenate([topic_input_ids, content_input_ids[1:]]).tolist())
+        return pairs
+
+    elapsed, legacy_pairs = timeit(per_pair)
+    print(f'per-pair tokenization: {len(pair_topics) / elapsed:.0f} pairs/s - {2 * len(pair_topics)} tokenizer calls')
+    with tempfile.TemporaryDirectory() as path:
+        elapsed, pairs = timeit(from_stores, path)
+    print(f'token stores: {len(pair_topics) / elapsed:.0f} pairs/s (stores built included) - '
+          f'{num_topics + num_content} texts tokenized - identical: {pairs == legacy_pairs}')
+
+def legacy_collate(batch, pad_token_id, max_len):
+    input_ids, attention_mask = [], []
+    for sequence in batch:
+        sequence = list(sequence)
+        mask = [1] * len(sequence)
+        if len(sequence) > max_len:
+            sequence, mask = sequence[:max_len], mask[:max_len]
+        else:
+            sequence = sequence + [pad_token_id] * (max_len - len(sequence))
+            mask = mask + [0] * (max_len - len(mask))
+        input_ids.append(sequence)
+        attention_mask.append(mask)
+    return np.array(input_ids), np.array(attention_mask)
+
+def benchmark_pair_collation(num_pairs = 1024, max_len = 128, batch_size = 64, seed = 2022):
+    import torch
+    from transformers import BertConfig, BertModel
+
+    rng = np.random.default_rng(seed)
+    topic_lengths = np.clip(rng.lognormal(np.log(max_len / 3), 0.6, num_pairs), 4, max_len).astype(np.int64)
+    content_lengths = np.clip(rng.lognormal(np.log(max_len / 2), 0.8, num_pairs), 3, max_len).astype(np.int64)
+    topics = [rng.integers(5, 29999, length) for length in topic_lengths]
+    contents = [rng.integers(5, 29999, length) for length in content_lengths]
+    pad = lambda tokens: np.concatenate([tokens, np.zeros(max_len - len(tokens), dtype = np.int64)])
+    padded_pairs = [np.concatenate([pad(t), pad(c)[1:]]) for t, c in zip(topics, contents)]
+    packed_pairs = [np.concatenate([t, c[1:]]) for t, c in zip(topics, contents)]
+
+    batches = [padded_pairs[i:i + batch_size] for i in range(0, num_pairs, batch_size)]
+    elapsed, _ = timeit(lambda: [legacy_collate(batch, 0, 2 * max_len) for batch in batches], repeat = 5)
+    print(f'legacy collator: {num_pairs / elapsed:.0f} pairs/s')
+    elapsed, _ = timeit(lambda: [pad_sequences(batch, 0, 2 * max_len) for batch in batches], repeat = 5)
+    print(f'numpy collator: {num_pairs / elapsed:.0f} pairs/s')
+
+    torch.manual_seed(seed)
+    model = BertModel(BertConfig(vocab_size = 30000, hidden_size = 256, num_hidden_layers = 4, num_attention_heads = 4,
+                                 intermediate_size = 1024, max_position_embeddings = 2 * max_len)).eval()
+
+    def encode(pairs, batches):
+        positions, embeddings = [], []
+        with torch.no_grad():
+            for batch in batches:
+                input_ids, attention_mask = pad_sequences([pairs[i] for i in batch], 0, 2 * max_len)
+                mask = torch.from_numpy(attention_mask)
+                output = model(torch.from_numpy(input_ids), attention_mask = mask).last_hidden_state
+                embeddings.append(((output * mask.unsqueeze(-1)).sum(dim = 1) / mask.sum(dim = -1, keepdims = True)).numpy())
+                positions.append(np.asarray(batch))
+        return legacy_restore_order(positions, np.concatenate(embeddings))
+
+    fixed = [list(range(i, min(i + batch_size, num_pairs))) for i in range(0, num_pairs, batch_size)]
+    packed_lengths = np.array([len(pair) for pair in packed_pairs])
+    modes = {
+        'padded pairs': (padded_pairs, fixed),
+        'packed pairs': (packed_pairs, fixed),
+        'packed pairs sorted by length': (packed_pairs, list(TokenBudgetBatchSampler(packed_lengths, batch_size * 2 * max_len))),
+    }
+    reference = None
+    for name, (pairs, mode_batches) in modes.items():
+        elapsed, embeddings = timeit(encode, pairs, mode_batches)
+        tokens = sum(len(batch) * max(len(pairs[i]) for i in batch) for batch in mode_batches)
+        message = f'{name}: {num_pairs / elapsed:.0f} pairs/s - {tokens / num_pairs:.0f} padded tokens per pair'
+        if name.startswith('packed'):
+            reference = embeddings if reference is None else reference
+            message += f' - max diff {np.abs(embeddings - reference).max():.1e}'
+        print(message)
+
+def benchmark_embedding_store(num_texts = 230000, dim = 768, seed = 2022):
+    import tempfile
+    rng = np.random.default_rng(seed)
+    ids = np.array([f'c_{i:012x}' for i in range(num_texts)])
+    embeddings = rng.standard_normal((num_texts, dim), dtype = np.float32)
+    languages = rng.integers(0, 30, num_texts)
+    for dtype in ['float32', 'float16']:
+        with tempfile.TemporaryDirectory() as path:
+            path = os.path.join(path, 'content')
+            write_time, _ = timeit(EmbeddingStore.write, path, ids, embeddings, languages, {}, dtype)
+            size = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path)) / 2**20
+            open_time, store = timeit(lambda: EmbeddingStore(path).embeddings)
+            load_time, (_, loaded, _) = timeit(EmbeddingStore(path).load)
+            print(f'{dtype}: {size:.0f}MB - write {write_time:.2f}s - memory-map {open_time * 1000:.1f}ms - '
+                  f'load as float32 {load_time:.2f}s - max error {np.abs(loaded - embeddings).max():.1e}')
+
+def benchmark_incremental_embedding(num_texts = 3000, max_len = 64, edited = 0.02, added = 0.01, removed = 0.01, seed = 2022):
+    import tempfile, torch
+    from transformers import BertConfig, BertModel
+
+    rng = np.random.default_rng(seed)
+    texts = synthetic_content(num_content = num_texts)['title'].values
+    tokenizer = synthetic_tokenizer(texts)
+    torch.manual_seed(seed)
+    model = BertModel(BertConfig(vocab_size = len(tokenizer), hidden_size = 256, num_hidden_layers = 4, num_attention_heads = 4,
+                                 intermediate_size = 1024, max_position_embeddings = max_len)).eval()
+
+    def encode(texts, batch_size = 64):
+        embeddings = []
+        with torch.no_grad():
+            for start in range(0, len(texts), batch_size):
+                token = tokenizer(list(texts[start:start + batch_size]), padding = True, truncation = True,
+                                  max_length = max_len, return_tensors = 'pt')
+                output = model(**token).last_hidden_state
+                mask = token['attention_mask'].unsqueeze(-1)
+                embeddings.append(((output * mask).sum(dim = 1) / mask.sum(dim = 1)).numpy())
+        return np.concatenate(embeddings) if embeddings else np.zeros((0, model.config.hidden_size), dtype = np.float32)
+
+    def incremental(cache, texts):
+        hashes = cache.text_hashes(texts)
+        found, rows = cache.lookup(hashes)
+        embeddings = np.empty((len(texts), model.config.hidden_size), dtype = np.float32)
+        embeddings[~found] = encode(texts[~found])
+        if found.any():
+            embeddings[found] = cache.embeddings[rows[found]]
+        cache.update(hashes, embeddings)
+        return embeddings, (~found).sum()
+
+    # The daily refresh edits some texts, adds new ones and removes others
+    refreshed = texts.copy()
+    edited_idx = rng.choice(num_texts, int(edited * num_texts), replace = False)
+    refreshed[edited_idx] = refreshed[edited_idx] + ' (revised)'
+    refreshed = np.concatenate([np.delete(refreshed, rng.choice(num_texts, int(removed * num_texts), replace = False)),
+                                texts[rng.choice(num_texts, int(added * num_texts))] + ' (new)'])
+
+    with tempfile.TemporaryDirectory() as path:
+        cache = EmbeddingCache(os.path.join(path, 'content_cache'), 'benchmark')
+        elapsed, _ = timeit(incremental, cache, texts)
+        print(f'first run: {elapsed:.2f}s - {num_texts} texts encoded')
+        elapsed, (embeddings, num_encoded) = timeit(incremental, cache, refreshed)
+        print(f'refresh, incremental: {elapsed:.2f}s - {num_encoded} texts encoded - cache of {len(cache)} texts')
+        elapsed, full_embeddings = timeit(encode, refreshed)
+        print(f'refresh, full re-encode: {elapsed:.2f}s - {len(refreshed)} texts encoded - '
+              f'max diff {np.abs(embeddings - full_embeddings).max():.1e}')
+
+def benchmark_cpu_inference(num_topics = 500, num_content = 3000, max_len = 64, batch_size = 64, k = 50,
+                            backbone = 'paraphrase-multilingual-mpnet-base-v4', seed = 2022):
+    import torch, warnings
+    from transformers import AutoModel, AutoTokenizer, BertConfig, BertModel
+    warnings.filterwarnings('ignore')    # Deprecation of the eager-mode quantization API
+
+    topics_df = synthetic_topics(num_topics = num_topics, num_channels = 5)
+    content_df = synthetic_content(num_content = num_content)
+    correlations_df = synthetic_correlations(topics_df, content_df)
+    index = TopicContentIndex.from_correlations(correlations_df, topic_ids = topics_df['id'].values,
+                                                content_ids = content_df['id'].values)
+    true_indices = [index.content_of(i).tolist() for i in range(num_topics)]
+    topic_texts = (topics_df['title'] + ' ' + topics_df['description'].fillna('')).values
+    content_texts = (content_df['title'] + ' ' + content_df['description'].fillna('')).values
+
+    # The retriever backbone when it was downloaded, a small randomly initialized encoder otherwise
+    torch.manual_seed(seed)
+    if os.path.isdir(backbone):
+        tokenizer = AutoTokenizer.from_pretrained(backbone)
+        model = AutoModel.from_pretrained(backbone).eval()
+    else:
+        print(f'{backbone} not found, using a randomly initialized encoder')
+        tokenizer = synthetic_tokenizer(np.concatenate([topic_texts, content_texts]))
+        model = BertModel(BertConfig(vocab_size = len(tokenizer), hidden_size = 384, num_hidden_layers = 6, num_attention_heads = 6,
+                                     intermediate_size = 1536, max_position_embeddings = max_len)).eval()
+
+    class Config(object):
+        device = torch.device('cpu')
+        apex = False
+
+    def encode(cfg, encoder, texts):
+        embeddings = []
+        with torch.no_grad():
+            for start in range(0, len(texts), batch_size):
+                token = tokenizer(list(texts[start:start + batch_size]), padding = True, truncation = True,
+                                  max_length = max_len, return_tensors = 'pt')
+                with inference_autocast(cfg):
+                    output = encoder(input_ids = token['input_ids'], attention_mask = token['attention_mask']).last_hidden_state
+                mask = token['attention_mask'].unsqueeze(-1)
+                embeddings.append(((output.float() * mask).sum(dim = 1) / mask.sum(dim = 1)).numpy())
+        return np.concatenate(embeddings)
+
+    reference = None
+    for mode in [None, 'int8', 'bf16']:
+        cfg = Config()
+        cfg.cpu_inference = mode
+        encoder = inference_model(cfg, model)
+        elapsed, embeddings = timeit(lambda: (encode(cfg, encoder, topic_texts), encode(cfg, encoder, content_texts)))
+        message = f'{mode or "fp32"}: {(num_topics + num_content) / elapsed:.0f} texts/s'
+        if reference is None:
+            reference = embeddings
+        report = parity_report(*reference, *embeddings, k = k, true_indices = true_indices)
+        message += ' - ' + ' - '.join(f'{name} {value:.4f}' for name, value in report.items())
+        print(message)
+
+def benchmark_sharded_embedding(num_texts = 4000, max_len = 64, batch_size = 64, seed = 2022):
+    import tempfile, torch
+    from transformers import BertConfig, BertModel
+
+    texts = synthetic_content(num_content = num_texts)['title'].values
+    tokenizer = synthetic_tokenizer(texts)
+    torch.manual_seed(seed)
+    model = BertModel(BertConfig(vocab_size = len(tokenizer), hidden_size = 256, num_hidden_layers = 4, num_attention_heads = 4,
+                                 intermediate_size = 1024, max_position_embeddings = max_len)).eval()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        model.save_pretrained(os.path.join(tmp_dir, 'model'))
+        token_store = TokenStore.build(os.path.join(tmp_dir, 'tokens'), np.arange(num_texts), texts, tokenizer, max_len)
+        encoder = ShardEncoder(os.path.join(tmp_dir, 'model'), len(tokenizer), max_len, token_store = token_store,
+                               rows = np.arange(num_texts), max_tokens = batch_size * max_len)
+
+        # The parent runs parallel regions first, as the re-ranker does before encoding
+        num_cores = os.cpu_count()
+        torch.set_num_threads(num_cores)
+        elapsed, reference = timeit(encoder, 0, num_texts)
+        print(f'1 process x {num_cores} threads: {num_texts / elapsed:.0f} texts/s')
+        for num_shards in sorted({2, 4, num_cores} - {1}):
+            threads = max(num_cores // num_shards, 1)
+            elapsed, embeddings = timeit(run_sharded, encoder, num_texts, encoder.hidden_size, num_shards, threads)
+            print(f'{num_shards} processes x {threads} threads: {num_texts / elapsed:.0f} texts/s - '
+                  f'max diff {np.abs(embeddings - reference).max():.1e}')
+
+def benchmark_text_dedup(num_texts = 3000, duplicates = 0.3, max_len = 64, batch_size = 64, sep_token = '[LECR]', seed = 2022):
+    import torch
+    from transformers import BertConfig, BertModel
+
+    content_df = load_content()
+    for column in ['title', 'description', 'text']:
+        content_df[column] = content_df[column].fillna(' ')
+    texts = join_fields(content_df, ['language', 'title', 'description', 'text', 'kind'], sep_token)
+    elapsed, unique_texts = timeit(UniqueTexts, texts)
+    print(f'content: {unique_texts.summary()} - {elapsed:.2f}s')
+
+    # A sample of the content in which a fraction `duplicates` of the texts repeat other ones, encoded in full and
+    # once per distinct text
+    rng = np.random.default_rng(seed)
+    texts = texts[rng.choice(len(texts), num_texts, replace = False)]
+    texts[:int(duplicates * num_texts)] = texts[rng.integers(int(duplicates * num_texts), num_texts, int(duplicates * num_texts))]
+    tokenizer = synthetic_tokenizer(texts)
+    torch.manual_seed(seed)
+    model = BertModel(BertConfig(vocab_size = len(tokenizer), hidden_size = 256, num_hidden_layers = 4, num_attention_heads = 4,
+                                 intermediate_size = 1024, max_position_embeddings = max_len)).eval()
+
+    def encode(texts):
+        embeddings = []
+        with torch.no_grad():
+            for start in range(0, len(texts), batch_size):
+                token = tokenizer(list(texts[start:start + batch_size]), padding = True, truncation = True,
+                                  max_length = max_len, return_tensors = 'pt')
+                output = model(**token).last_hidden_state
+                mask = token['attention_mask'].unsqueeze(-1)
+                embeddings.append(((output * mask).sum(dim = 1) / mask.sum(dim = 1)).numpy())
+        return np.concatenate(embeddings)
+
+    def encode_unique(texts):
+        unique_texts = UniqueTexts(texts)
+        return unique_texts.scatter(encode(texts[unique_texts.first])), unique_texts
+
+    full_time, full = timeit(encode, texts)
+    unique_time, (embeddings, unique_texts) = timeit(encode_unique, texts)
+    print(f'sample: {unique_texts.summary()} - all texts {full_time:.2f}s - distinct texts {unique_time:.2f}s - '
+          f'max diff {np.abs(embeddings - full).max():.1e}')
+
+def benchmark_inference_engine(num_texts = 4000, max_len = 128, max_tokens = 64 * 128, seed = 2022):
+    import torch
+    from torch.utils.data import Dataset, DataLoader
+    from transformers import BertConfig, BertModel
+
+    content_df = synthetic_content(num_content = num_texts)
+    texts = (content_df['title'] + ' ' + content_df['text'].fillna('')).values
+    tokenizer = synthetic_tokenizer(texts)
+    torch.manual_seed(seed)
+    model = BertModel(BertConfig(vocab_size = len(tokenizer), hidden_size = 256, num_hidden_layers = 4, num_attention_heads = 4,
+                                 intermediate_size = 1024, max_position_embeddings = max_len)).eval()
+
+    class Config(object):
+        device = torch.device('cpu')
+        use_tqdm = False
+
+    # The texts are tokenized by the dataset, as without a token store
+    class TextDataset(Dataset):
+        def __len__(self):
+            return len(texts)
+
+        def __getitem__(self, idx):
+            return idx, tokenizer(texts[idx], truncation = True, max_length = max_len)['input_ids']
+
+    def collate(batch):
+        input_ids, attention_mask = pad_sequences([tokens for _, tokens in batch], tokenizer.pad_token_id)
+        return {'idx': torch.tensor([idx for idx, _ in batch]), 'input_ids': torch.from_numpy(input_ids),
+                'attention_mask': torch.from_numpy(attention_mask)}
+
+    lengths = np.array([len(tokens) for tokens in tokenizer(list(texts), truncation = True, max_length = max_len)['input_ids']])
+    dataloader = DataLoader(TextDataset(), batch_sampler = TokenBudgetBatchSampler(lengths, max_tokens), collate_fn = collate)
+
+    def forward(item):
+        output = model(input_ids = item['input_ids'], attention_mask = item['attention_mask']).last_hidden_state
+        mask = item['attention_mask'].unsqueeze(-1)
+        return (output * mask).sum(dim = 1) / mask.sum(dim = 1)
+
+    def legacy():
+        positions, embeddings = [], []
+        with torch.no_grad():
+            for item in dataloader:
+                positions.append(item['idx'].numpy())
+                embeddings.append(forward(item).numpy())
+        return legacy_restore_order(positions, np.concatenate(embeddings))
+
+    engine = InferenceEngine(Config(), forward)
+    legacy_time, (legacy_peak, reference) = timeit(peak_memory, legacy)
+    engine_time, (engine_peak, embeddings) = timeit(peak_memory, engine.run, dataloader, num_texts)
+    output_size = embeddings.nbytes / 2**20
+    print(f'lists + concatenate: {legacy_time:.2f}s - peak allocations {legacy_peak:.1f}MB (output {output_size:.1f}MB)')
+    print(f'engine: {engine_time:.2f}s - peak allocations {engine_peak:.1f}MB - max diff {np.abs(embeddings - reference).max():.1e}')
+    print(f'engine stages: {engine.summary()}')
+
+"""# Search"""
+
+def benchmark_exact_search(num_queries = 2000, k = 50, seed = 2022):
+    from sklearn.neighbors import NearestNeighbors
+
+    topic_embeddings, _, content_embeddings, _ = load_embeddings()
+    rng = np.random.default_rng(seed)
+    queries = topic_embeddings[rng.choice(len(topic_embeddings), min(num_queries, len(topic_embeddings)), replace = False)]
+    print(f'{len(queries)} queries - {len(content_embeddings)} content items')
+
+    def legacy():
+        neighbors_model = NearestNeighbors(n_neighbors = k, metric = 'cosine')
+        neighbors_model.fit(content_embeddings)
+        return neighbors_model.kneighbors(queries, return_distance = True)
+
+    legacy_time, (legacy_distances, legacy_indices) = timeit(legacy)
+    print(f'NearestNeighbors: {legacy_time:.2f}s')
+    for num_threads in sorted({1, os.cpu_count()}):
+        for memory_mb in [256, 1024]:
+            elapsed, (distances, indices) = timeit(exact_search, queries, content_embeddings, k, memory_mb, num_threads)
+            identical = np.array_equal(indices, legacy_indices) and np.array_equal(distances, legacy_distances)
+            print(f'exact_search, {num_threads} threads, {memory_mb}MB blocks: {elapsed:.2f}s - '
+                  f'speed-up x{legacy_time / elapsed:.1f} - identical {identical}')
+
+def benchmark_language_partitions(num_queries = 5000, num_masked = 200, k = 50, seed = 2022):
+    topic_embeddings, topic_languages, content_embeddings, content_languages = load_embeddings()
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(len(topic_embeddings), min(num_queries, len(topic_embeddings)), replace = False)
+    queries, query_languages = topic_embeddings[sample], topic_languages[sample]
+    print(f'{len(queries)} queries - {len(content_embeddings)} content items in {len(np.unique(content_languages))} languages')
+
+    def masked(queries, query_languages):
+        # As the original find_similar_contents of the re-ranker did: a dense language mask over all the content and fully sorted rows
+        scores = normalize(queries) @ normalize(content_embeddings).T
+        scores[query_languages[:, None] != content_languages[None, :]] = -1
+        return np.argsort(-scores, axis = 1, kind = 'stable')[:, :k]
+
+    global_time, _ = timeit(exact_search, queries, content_embeddings, k)
+    print(f'all the content, top-{k}: {global_time:.2f}s')
+    masked_time, masked_indices = timeit(masked, queries[:num_masked], query_languages[:num_masked])
+    print(f'dense language mask and full sort: {masked_time * len(queries) / num_masked:.2f}s (from {num_masked} queries) - '
+          f'mask of {len(queries) * len(content_embeddings) / 2**20:.0f}MB')
+    build_time, index = timeit(LanguagePartitionedIndex, content_embeddings, content_languages)
+    search_time, (_, indices) = timeit(index.search, queries, query_languages, k)
+    same = np.mean([len(set(a.tolist()) & set(b.tolist())) / k for a, b in zip(masked_indices, indices[:num_masked])])
+    print(f'language partitions: build {build_time:.2f}s - search {search_time:.2f}s - speed-up x{global_time / search_time:.1f} '
+          f'over the unpartitioned top-{k} - overlap with the masked search {same:.4f}')
+
+def benchmark_projection(num_queries = 2000, dims = (128, 256), seed = 2022):
+    topic_embeddings, _, content_embeddings, _ = load_embeddings()
+    dims = tuple(dim for dim in dims if dim < content_embeddings.shape[1]) or (content_embeddings.shape[1] // 4, content_embeddings.shape[1] // 2)
+    rng = np.random.default_rng(seed)
+    queries = topic_embeddings[rng.choice(len(topic_embeddings), min(num_queries, len(topic_embeddings)), replace = False)]
+    print(f'{len(queries)} queries - {len(content_embeddings)} content items')
+    for center in [False, True]:
+        report = projection_report(queries, content_embeddings, dims = dims, center = center)
+        for dim, row in report.items():
+            if center and dim == content_embeddings.shape[1]:
+                continue    # Same full-dimension search
+            print(f'{dim}{" (centered)" if center else ""}: ' + ' - '.join(f'{name} {value:.3f}' for name, value in row.items()))
+
+def benchmark_ivf(num_queries = 2000, nlists = (256, 1024), nprobes = (4, 16, 64), k = 50, seed = 2022):
+    topic_embeddings, _, content_embeddings, _ = load_embeddings()
+    rng = np.random.default_rng(seed)
+    queries = topic_embeddings[rng.choice(len(topic_embeddings), min(num_queries, len(topic_embeddings)), replace = False)]
+    # About 40 content items per list at least, as the k-means needs
+    nlists = tuple(nlist for nlist in nlists if nlist * 40 <= len(content_embeddings)) or (max(len(content_embeddings) // 40, 1),)
+    print(f'{len(queries)} queries - {len(content_embeddings)} content items')
+    for row in ivf_sweep(queries, content_embeddings, nlists = nlists, nprobes = nprobes, k = k):
+        name = 'exact' if row['nlist'] is None else f'nlist {row["nlist"]} nprobe {row["nprobe"]}'
+        print(f'{name}: recall@{k} {row[f"recall@{k}"]:.4f} - {row["query_ms"]:.3f}ms/query - build {row["build_s"]:.2f}s')
+
+def benchmark_pq(num_queries = 2000, subspaces = (48, 96), reranks = (0, 4), k = 50, seed = 2022):
+    topic_embeddings, _, content_embeddings, _ = load_embeddings()
+    rng = np.random.default_rng(seed)
+    queries = topic_embeddings[rng.choice(len(topic_embeddings), min(num_queries, len(topic_embeddings)), replace = False)]
+    print(f'{len(queries)} queries - {len(content_embeddings)} content items')
+    start = time.perf_counter()
+    exact_search(queries, content_embeddings, k)
+    print(f'exact: {(time.perf_counter() - start) / len(queries) * 1000:.3f}ms/query - '
+          f'{content_embeddings.shape[0] * content_embeddings.shape[1] * 4 / 2**20:.1f}MB')
+    for row in pq_report(queries, content_embeddings, subspaces = subspaces, reranks = reranks, k = k):
+        print(f'{row["subspaces"]} subspaces, re-rank x{row["rerank"]}: recall@{k} {row[f"recall@{k}"]:.4f} - '
+              f'{row["query_ms"]:.3f}ms/query - {row["index_mb"]:.1f}MB (x{row["float32_mb"] / row["index_mb"]:.0f} smaller) - '
+              f'build {row["build_s"]:.2f}s')
+
+def benchmark_int8_search(num_queries = 2000, reranks = (1, 2, 4), k = 50, seed = 2022):
+    topic_embeddings, _, content_embeddings, _ = load_embeddings()
+    rng = np.random.default_rng(seed)
+    queries = topic_embeddings[rng.choice(len(topic_embeddings), min(num_queries, len(topic_embeddings)), replace = False)]
+    print(f'{len(queries)} queries - {len(content_embeddings)} content items')
+    for row in int8_report(queries, content_embeddings, reranks = reranks, k = k):
+        name = 'float32' if row['rerank'] is None else f'int8, re-scored top-{k} x{row["rerank"]}'
+        print(f'{name}: {row["queries_per_s"]:.0f} queries/s - {row["index_mb"]:.1f}MB - recall@{k} {row[f"recall@{k}"]:.4f} - '
+              f'exact top-{k} {row["exact_match"]:.1%} - build {row["build_s"]:.2f}s')
+
+def benchmark_index_store(num_queries = 100, k = 50, seed = 2022):
+    import tempfile, torch
+    topic_embeddings, topic_languages, content_embeddings, content_languages = load_embeddings()
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(len(topic_embeddings), num_queries, replace = False)
+    tmp_dir = tempfile.mkdtemp()
+    np.save(os.path.join(tmp_dir, 'queries.npy'), topic_embeddings[sample])
+    np.save(os.path.join(tmp_dir, 'query_languages.npy'), topic_languages[sample])
+    np.save(os.path.join(tmp_dir, 'embeddings.npy'), content_embeddings)
+    np.save(os.path.join(tmp_dir, 'languages.npy'), content_languages)
+    print(f'{num_queries} queries - {len(content_embeddings)} content items')
+
+    # Every run is a fresh interpreter: either it builds the index from the saved embeddings, or it opens a stored index.
+    # The peak RSS of a child is inherited from this process, its resident memory is read at the end instead
+    script = '''
+import resource, sys, time
+sys.path.insert(0, {repo!r})
+import numpy as np, torch
+from index_store import SearchIndexStore
+from candidates import CandidateSet
+from search_index import build_index, index_search, normalize
+class Config(object):
+    thres = {{'num_k': {k!r}}}
+    device = torch.device('cpu')
+    search_dim = None
+    language_partitioned_search = {partitioned!r}
+    search_extra_languages = {{}}
+    languages_map = {{}}
+    search_nlist = {nlist!r}
+    search_nprobe = 16
+    search_pq_subspaces = None
+    search_int8 = False
+cfg = Config()
+queries, query_languages = np.load({tmp_dir!r} + '/queries.npy'), np.load({tmp_dir!r} + '/query_languages.npy')
+start = time.perf_counter()
+if {path!r} is None:
+    index = build_index(cfg, np.load({tmp_dir!r} + '/embeddings.npy'), np.load({tmp_dir!r} + '/languages.npy'))
+    ready = time.perf_counter()
+    search = lambda queries, languages: index_search(cfg, index, queries, languages)
+else:
+    store = SearchIndexStore({path!r})
+    index = store.index
+    ready = time.perf_counter()
+    search = lambda queries, languages: store.search(cfg, queries, languages)
+search(queries[:1], query_languages[:1])
+first = time.perf_counter()
+search(queries, query_languages)
+rss = int(open('/proc/self/statm').read().split()[1]) * resource.getpagesize() / 2**20
+print(ready - start, first - ready, time.perf_counter() - first, rss)
+'''
+    repo = os.path.dirname(os.path.abspath(__file__))
+
+    class Config(object):
+        device = torch.device('cpu')
+        search_dim = None
+        search_pq_subspaces = None
+        search_int8 = False
+    for name, partitioned, nlist in [('exact', False, None), ('language partitions', True, None), ('IVF', False, 1024)]:
+        cfg = Config()
+        cfg.language_partitioned_search, cfg.search_nlist = partitioned, nlist
+        path = os.path.join(tmp_dir, name.replace(' ', '_'))
+        build_time, store = timeit(SearchIndexStore.build, cfg, path, np.arange(len(content_embeddings)).astype(str),
+                                   content_embeddings, content_languages)
+        size = sum(os.path.getsize(os.path.join(path, file)) for file in os.listdir(path)) / 2**20
+        print(f'{name}: stored in {build_time:.2f}s - {size:.0f}MB')
+        for mode, mode_path in [('rebuilt', None), ('memory-mapped', path)]:
+            code = script.format(repo = repo, tmp_dir = tmp_dir, k = k, partitioned = partitioned, nlist = nlist, path = mode_path)
+            output = subprocess.run([sys.executable, '-c', code], capture_output = True, text = True, check = True).stdout
+            ready, first, batch, rss = map(float, output.split())
+            print(f'{mode:>16s}: ready in {ready * 1000:.0f}ms - first query {first * 1000:.0f}ms - '
+                  f'{num_queries} queries {batch * 1000:.0f}ms - RSS {rss:.0f}MB')
+    shutil.rmtree(tmp_dir)
+
+def benchmark_candidate_set(num_topics = 20000, num_content = 154047, k = 50, num_correlated = 3, seed = 2022):
+    rng = np.random.default_rng(seed)
+    topic_ids = np.array([f't_{i:08x}' for i in range(num_topics)])
+    content_ids = np.array([f'c_{i:08x}' for i in range(num_content)])
+    # Search results with some topics short of candidates (padded), and a few correlated content items per topic
+    # Distinct content items in every row, as a search returns
+    indices = (rng.integers(0, num_content, size = (num_topics, 1)) + np.arange(k) * 3001) % num_content
+    distances = np.sort(rng.random((num_topics, k), dtype = np.float32), axis = 1)
+    short = rng.random(num_topics) < 0.1
+    indices[short, k // 2:], distances[short, k // 2:] = -1, np.inf
+    correlations_df = pd.DataFrame({'topic_id': topic_ids,
+                                    'content_ids': [' '.join(content_ids[np.concatenate([row[:1], rng.integers(0, num_content, num_correlated - 1)])])
+                                                    for row in indices]})
+    topic_content_index = TopicContentIndex.from_correlations(correlations_df, topic_ids = topic_ids, content_ids = content_ids)
+
+    def strings():
+        # As find_candidates/valid_fn did: joined ids and lists of distances per topic, split and exploded back
+        oof_dict_ids, oof_dict_ids_top10, oof_dict_distance = {}, {}, {}
+        for i, topic_id in enumerate(topic_ids):
+            found = indices[i][indices[i] >= 0]
+            oof_dict_ids[topic_id] = ' '.join(content_ids[found].tolist())
+            oof_dict_ids_top10[topic_id] = ' '.join(content_ids[found[:10]].tolist())
+            oof_dict_distance[topic_id] = distances[i][:len(found)].tolist()
+        candidate_df = pd.DataFrame({'topic_id': list(oof_dict_ids.keys()), 'content_id': list(oof_dict_ids.values()),
+                                     'distance': list(oof_dict_distance.values())})
+        candidate_df['content_id'] = candidate_df['content_id'].str.split()
+        return candidate_df.explode(['content_id', 'distance']), list(oof_dict_ids.values()), list(oof_dict_ids_top10.values())
+
+    def string_metrics(pred_ids):
+        true_ids = correlations_df['content_ids'].str.split().tolist()
+        scores = []
+        for true, pred in zip(true_ids, pd.Series(pred_ids).str.split().tolist()):
+            tp = len(set(true) & set(pred))
+            precision, recall = tp / len(pred), tp / len(true)
+            scores.append(5 * precision * recall / (4 * precision + recall + 1e-15))
+        return sum(scores) / len(scores)
+
+    def columnar():
+        candidates = CandidateSet.from_search(topic_ids, content_ids, distances, indices)
+        return candidates, candidates.to_frame()
+
+    string_time, (candidate_df, pred_ids, pred_ids_top10) = timeit(strings)
+    string_metric_time, string_score = timeit(lambda: (string_metrics(pred_ids), string_metrics(pred_ids_top10)))
+    columnar_time, (candidates, frame) = timeit(columnar)
+    columnar_metric_time, columnar_score = timeit(lambda: (candidates.metrics(topic_content_index)[0],
+                                                           candidates.top(10).metrics(topic_content_index)[0]))
+    assert (frame['content_id'].values == candidate_df['content_id'].values).all(), 'The candidates differ!'
+    assert string_score == columnar_score, 'The scores differ!'
+    print(f'{len(candidates)} candidates of {num_topics} topics')
+    print(f'joined strings: {string_time:.2f}s, scores {string_metric_time:.2f}s - distance {candidate_df["distance"].dtype}, '
+          f'{candidate_df.memory_usage(deep = True).sum() / 2**20:.0f}MB')
+    print(f'CandidateSet: {columnar_time:.2f}s, scores {columnar_metric_time:.2f}s - distance {frame["distance"].dtype}, '
+          f'{frame.memory_usage(deep = True).sum() / 2**20:.0f}MB as a dataframe, '
+          f'{sum(array.nbytes for array in [candidates.topics, candidates.contents, candidates.distances, candidates.ranks]) / 2**20:.1f}MB of arrays')
+
+"""# Main"""
+
+benchmarks = {
+    'topic_tree': benchmark_topic_tree,
+    'breadcrumbs': benchmark_breadcrumbs,
+    'topic_content_index': benchmark_topic_content_index,
+    'input_text': benchmark_input_text,
+    'content_ingestion': benchmark_content_ingestion,
+    'length_bucketing': benchmark_length_bucketing,
+    'train_batching': benchmark_train_batching,
+    'pair_assembly': benchmark_pair_assembly,
+    'pair_collation': benchmark_pair_collation,
+    'embedding_store': benchmark_embedding_store,
+    'incremental_embedding': benchmark_incremental_embedding,
+    'cpu_inference': benchmark_cpu_inference,
+    'sharded_embedding': benchmark_sharded_embedding,
+    'text_dedup': benchmark_text_dedup,
+    'inference_engine': benchmark_inference_engine,
+    'exact_search': benchmark_exact_search,
+    'language_partitions': benchmark_language_partitions,
+    'projection': benchmark_projection,
+    'ivf': benchmark_ivf,
+    'pq': benchmark_pq,
+    'int8_search': benchmark_int8_search,
+    'index_store': benchmark_index_store,
+    'candidate_set': benchmark_candidate_set,
+}
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(benchmarks.keys())
+    for name in names:
+        print(f' {name} '.center(50, '-'))
+        benchmarks[name]()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""Candidate content of the topics, as columnar arrays
+
+A `CandidateSet` holds the candidates found by the kNN search in contiguous arrays: the topic
+(int32, a row of `topic_ids`), the content item (int32, a row of `content_ids`), the cosine distance
+(float32) and the rank of the candidate among those of its topic (int32). The candidates of a topic
+are contiguous, from the nearest. The labels and the F2 score/recall are computed from the arrays and
+the edges of a `TopicContentIndex`; the ids are only looked up at the edges, by `to_frame` (the pairs
+of the re-ranker) and `to_strings` (the space-separated content ids of each topic, as submitted).
+"""
+
+import numpy as np
+import pandas as pd
+
+class CandidateSet(object):
+    def __init__(self, topic_ids, content_ids, topics, contents, distances, ranks):
+        self.topic_ids = np.asarray(topic_ids)
+        self.content_ids = np.asarray(content_ids)
+        self.topics = np.asarray(topics, dtype = np.int32)
+        self.contents = np.asarray(contents, dtype = np.int32)
+        self.distances = np.asarray(distances, dtype = np.float32)
+        self.ranks = np.asarray(ranks, dtype = np.int32)
+
+    @classmethod
+    def from_search(cls, topic_ids, content_ids, distances, indices):
+        '''The candidates of the distances/indices of a search, the -1 indices padding the rows are dropped'''
+        found = indices >= 0
+        topics, ranks = np.nonzero(found)
+        return cls(topic_ids, content_ids, topics, indices[found], distances[found], ranks)
+
+    def __len__(self):
+        return len(self.topics)
+
+    @property
+    def num_topics(self):
+        return len(self.topic_ids)
+
+    def top(self, n):
+        '''The first n candidates of every topic'''
+        keep = self.ranks < n
+        return CandidateSet(self.topic_ids, self.content_ids, self.topics[keep], self.contents[keep], self.distances[keep],
+                            self.ranks[keep])
+
+    def offsets(self):
+        '''The candidates of the i-th topic are those from offsets[i] to offsets[i + 1]'''
+        return np.searchsorted(self.topics, np.arange(self.num_topics + 1))
+
+    def to_frame(self):
+        return pd.DataFrame({
+            'topic_id': self.topic_ids[self.topics],
+            'content_id': self.content_ids[self.contents],
+            'distance': self.distances,
+        })
+
+    def to_strings(self):
+        '''The space-separated content ids of the candidates of every topic'''
+        content_ids = self.content_ids[self.contents].tolist()
+        offsets = self.offsets().tolist()
+        return [' '.join(content_ids[start:end]) for start, end in zip(offsets[:-1], offsets[1:])]
+
+    def to_lists(self):
+        '''The distances of the candidates of every topic'''
+        distances = self.distances.tolist()
+        offsets = self.offsets().tolist()
+        return [distances[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+    def _edges(self, topic_content_index):
+        # Rows of the topics and content of the index, -1 for those it does not have
+        topics = topic_content_index.topic2idx.get_indexer(self.topic_ids)
+        contents = topic_content_index.content2idx.get_indexer(self.content_ids)
+        return topics, contents
+
+    def labels(self, topic_content_index):
+        '''Whether each candidate is correlated with its topic'''
+        topics, contents = self._edges(topic_content_index)
+        keys = topics[self.topics].astype(np.int64) * len(topic_content_index.content_ids) + contents[self.contents]
+        keys[(topics[self.topics] < 0) | (contents[self.contents] < 0)] = -1
+        edge_keys = topic_content_index.edge_topics.astype(np.int64) * len(topic_content_index.content_ids) + \
+                    topic_content_index.edge_contents
+        return np.isin(keys, edge_keys)
+
+    def metrics(self, topic_content_index, topics = None, beta = 2, eps = 1e-15):
+        '''
+        F2 score and recall of the candidates, averaged over `topics` (rows of `topic_ids`, by default those with
+        correlated content) in their order, as `metric_fn` on the strings of the candidates
+        '''
+        num_true = np.zeros(self.num_topics, dtype = np.int64)
+        index_topics = self._edges(topic_content_index)[0]
+        known = index_topics >= 0
+        num_true[known] = topic_content_index.topic_degree()[index_topics[known]]
+        num_pred = np.bincount(self.topics, minlength = self.num_topics)
+        num_tp = np.bincount(self.topics[self.labels(topic_content_index)], minlength = self.num_topics)
+        topics = np.flatnonzero(num_true > 0) if topics is None else np.asarray(topics)
+
+        precision = num_tp[topics] / np.maximum(num_pred[topics], 1)
+        recall = num_tp[topics] / num_true[topics]
+        f2 = (1 + beta**2) * (precision * recall) / ((beta**2) * precision + recall + eps)
+        # Summed in order as Python floats, so the scores are those of `metric_fn` to the last bit
+        return sum(f2.tolist()) / len(f2), sum(recall.tolist()) / len(recall)
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""Inference of the encoders
+
+On CPU, `cfg.cpu_inference` selects how the encoder runs when it only infers embeddings:
+    None    float32, as it was trained
+    'int8'  the linear layers are dynamically quantized (int8 weights, activations quantized on the fly)
+    'bf16'  bfloat16 autocast
+`torch.cuda.amp.autocast` does nothing on CPU, so the GPU path keeps `cfg.apex` as before.
+`parity_report` measures what a mode costs against float32: the cosine drift of the embeddings and
+the recall of the float32 nearest neighbours.
+
+`run_sharded` spreads the encoding of a corpus over several processes, each with its own intra-op
+threads, that write their outputs into one shared memory-mapped array. They are new interpreters, not
+forks: a process forked after its parent ran a parallel region deadlocks in the inherited OpenMP
+thread pool. The encoder is pickled to them, a `ShardEncoder` loads the model in each of them.
+
+`InferenceEngine` overlaps the preparation of the batches with the forward passes and writes the
+outputs of every batch in place into preallocated arrays, instead of concatenating them at the end.
+"""
+
+import os, sys, time, types, queue, pickle, threading, contextlib, tempfile, subprocess
+import numpy as np
+import torch
+from torch import nn
+from tqdm import tqdm
+
+from batching import pad_sequences, TokenBudgetBatchSampler
+from search_index import normalize, exact_search
+
+def inference_model(cfg, model):
+    '''The module used for inference: a dynamically quantized copy in the 'int8' mode on CPU, the module itself otherwise'''
+    if cfg.device.type == 'cpu' and cfg.cpu_inference == 'int8':
+        return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype = torch.qint8)
+    return model
+
+def inference_autocast(cfg):
+    if cfg.device.type != 'cpu':
+        return torch.cuda.amp.autocast(enabled = cfg.apex)
+    if cfg.cpu_inference == 'bf16':
+        return torch.autocast('cpu', dtype = torch.bfloat16)
+    return contextlib.nullcontext()
+
+class InferenceEngine(object):
+    '''
+    Run `forward_fn` (item -> output tensor, or tuple of them) on the batches of a dataloader whose items have an
+    `idx` field. A background thread loads the next batches and moves them to the device, up to `prefetch` batches
+    ahead, while the outputs of the current one are written at the positions of its items. `timings` holds the
+    seconds spent loading, transferring, waiting for a batch, computing and writing.
+    '''
+    def __init__(self, cfg, forward_fn, prefetch = 2):
+        self.cfg = cfg
+        self.forward_fn = forward_fn
+        self.prefetch = prefetch
+        self.timings = {}
+
+    def _time(self, stage, start):
+        self.timings[stage] = self.timings.get(stage, 0.) + time.perf_counter() - start
+
+    def _produce(self, dataloader, batches, stop):
+        try:
+            iterator = iter(dataloader)
+            while not stop.is_set():
+                start = time.perf_counter()
+                item = next(iterator, None)
+                self._time('load', start)
+                if item is None:
+                    break
+                start = time.perf_counter()
+                item = {k: v.to(self.cfg.device, non_blocking = True) if torch.is_tensor(v) else v for k, v in item.items()}
+                self._time('transfer', start)
+                batches.put(item)
+        except Exception as e:
+            batches.put(e)
+        batches.put(None)
+
+    def run(self, dataloader, size, out = None):
+        '''
+        Outputs of the `size` items of the dataset, each at its `idx`, in `out` (a tuple of arrays, e.g. memory-mapped)
+        when it is given, otherwise in float32 arrays allocated from the shape of the first outputs
+        '''
+        batches = queue.Queue(maxsize = self.prefetch)
+        stop = threading.Event()
+        producer = threading.Thread(target = self._produce, args = (dataloader, batches, stop), daemon = True)
+        producer.start()
+        single = False
+        try:
+            with tqdm(total = len(dataloader), disable = not self.cfg.use_tqdm) as tbar:
+                while True:
+                    start = time.perf_counter()
+                    item = batches.get()
+                    self._time('wait', start)
+                    if item is None:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+
+                    start = time.perf_counter()
+                    with torch.no_grad():
+                        outputs = self.forward_fn(item)
+                    single = torch.is_tensor(outputs)
+                    outputs = [output.cpu().numpy() for output in ((outputs,) if single else outputs)]
+                    self._time('compute', start)
+
+                    start = time.perf_counter()
+                    if out is None:
+                        out = tuple(np.empty((size,) + output.shape[1:], dtype = np.float32) for output in outputs)
+                    positions = item['idx'].cpu().numpy()
+                    for array, output in zip(out, outputs):
+                        array[positions] = output
+                    self._time('write', start)
+                    tbar.update()
+        finally:
+            stop.set()
+            # Unblock the producer if it is waiting for room in the queue
+            while producer.is_alive():
+                try:
+                    batches.get(timeout = 0.1)
+                except queue.Empty:
+                    pass
+            producer.join()
+        if out is None:
+            return None    # Empty dataloader
+        return out[0] if single else out
+
+    def summary(self):
+        return ' - '.join(f'{stage} {seconds:.2f}s' for stage, seconds in self.timings.items())
+
+class ShardEncoder(object):
+    '''
+    Mean-pooled last hidden states of the encoder saved at `model_dir`, `encoder(start, end)` encoding the texts from
+    start to end: the rows `rows` of a token store, or the `texts` tokenized by `tokenizer`. The batches are cut as
+    `inference_dataloader` does. The encoder is pickled without its model, every process loads it from the
+    memory-mapped safetensors weights.
+    '''
+    def __init__(self, model_dir, vocab_size, max_len, token_store = None, rows = None, tokenizer = None, texts = None,
+                 max_tokens = None, batch_size = 64, cpu_inference = None):
+        self.model_dir = model_dir
+        self.vocab_size = vocab_size
+        self.max_len = max_len
+        self.token_store = token_store
+        self.rows = rows
+        self.tokenizer = tokenizer
+        self.texts = texts
+        self.max_tokens = max_tokens
+        self.batch_size = batch_size
+        # The CPU settings `inference_model` and `inference_autocast` read from the config
+        self.settings = types.SimpleNamespace(device = torch.device('cpu'), cpu_inference = cpu_inference, apex = False)
+        self._model = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_model'] = None
+        return state
+
+    @property
+    def hidden_size(self):
+        from transformers import AutoConfig
+        return AutoConfig.from_pretrained(self.model_dir).hidden_size
+
+    @property
+    def model(self):
+        if self._model is None:
+            from transformers import AutoModel
+            model = AutoModel.from_pretrained(self.model_dir)
+            model.resize_token_embeddings(self.vocab_size)
+            self._model = inference_model(self.settings, model).eval()
+        return self._model
+
+    def _sequences(self, start, end):
+        if self.token_store is not None:
+            return [self.token_store.get(row) for row in self.rows[start:end]], self.token_store.pad_token_id
+        sequences = self.tokenizer(list(self.texts[start:end]),
+                                   max_length = self.max_len,
+                                   truncation = True,
+                                   return_attention_mask = False)['input_ids']
+        return sequences, self.tokenizer.pad_token_id
+
+    def __call__(self, start, end):
+        sequences, pad_token_id = self._sequences(start, end)
+        if self.max_tokens is None:
+            batches = [np.arange(i, min(i + self.batch_size, len(sequences))) for i in range(0, len(sequences), self.batch_size)]
+        else:
+            lengths = np.minimum([len(sequence) for sequence in sequences], self.max_len)
+            batches = TokenBudgetBatchSampler(lengths, self.max_tokens).batches
+        model = self.model
+        out = np.empty((len(sequences), model.config.hidden_size), dtype = np.float32)
+        for batch in batches:
+            input_ids, attention_mask = pad_sequences([sequences[i] for i in batch], pad_token_id, self.max_len)
+            input_ids, attention_mask = torch.from_numpy(input_ids), torch.from_numpy(attention_mask)
+            with torch.no_grad(), inference_autocast(self.settings):
+                output = model(input_ids, attention_mask).last_hidden_state
+                mask = attention_mask.unsqueeze(-1)
+                out[batch] = ((output * mask).sum(dim = 1) / mask.sum(dim = 1)).float().numpy()
+        return out
+
+def _encode_shard(encoder, path, start, end, num_threads):
+    torch.set_num_threads(num_threads)
+    output = np.load(path, mmap_mode = 'r+')
+    output[start:end] = encoder(start, end)
+    output.flush()
+
+# Run by every shard process, with the import path of the parent then the arguments of `_encode_shard` on its stdin
+_SHARD_MAIN = 'import sys, pickle; sys.path[:0] = pickle.load(sys.stdin.buffer); import embedding_inference; ' \
+              'embedding_inference._encode_shard(*pickle.load(sys.stdin.buffer))'
+
+def run_sharded(encoder, num_rows, dim, num_shards, num_threads = None, path = None):
+    '''
+    Call `encoder(start, end)` on `num_shards` contiguous ranges of rows, each in a new process with `num_threads`
+    intra-op threads, and write the float32 outputs at their offsets of the memory-mapped array at `path`. The encoder
+    is pickled to the processes, it must be defined in a module they can import (e.g. a `ShardEncoder`).
+    '''
+    num_threads = num_threads or max(os.cpu_count() // num_shards, 1)
+    if path is None:
+        handle, path = tempfile.mkstemp(suffix = '.npy')
+        os.close(handle)
+        remove = True
+    else:
+        remove = False
+    np.lib.format.open_memmap(path, mode = 'w+', dtype = np.float32, shape = (num_rows, dim)).flush()
+
+    bounds = np.linspace(0, num_rows, num_shards + 1).astype(np.int64)
+    processes = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        if end == start:
+            continue
+        process = subprocess.Popen([sys.executable, '-c', _SHARD_MAIN], stdin = subprocess.PIPE)
+        try:
+            pickle.dump(sys.path, process.stdin)
+            pickle.dump((encoder, path, int(start), int(end), num_threads), process.stdin)
+            process.stdin.close()
+        except BrokenPipeError:
+            pass    # The process failed before reading its arguments, its exit code tells
+        processes.append(process)
+    failed = [exitcode for exitcode in [process.wait() for process in processes] if exitcode != 0]
+
+    output = np.load(path, mmap_mode = 'r')
+    if remove:
+        os.remove(path)    # The mapping stays valid until the array is released
+    assert not failed, f'{len(failed)} embedding shards failed!'
+    return output
+
+def _recall(indices, true_indices):
+    recalls = [len(set(pred.tolist()) & set(true)) / len(true) for pred, true in zip(indices, true_indices) if len(true) > 0]
+    return float(np.mean(recalls)) if recalls else float('nan')
+
+def parity_report(reference_queries, reference_corpus, queries, corpus, k = 50, true_indices = None):
+    '''
+    Compare the query/corpus embeddings of an inference mode with the float32 reference: cosine drift of every
+    embedding, recall of the k nearest float32 neighbours of each query and, given the indices of the true corpus
+    items of each query, the recall@k of both
+    '''
+    reference_queries, reference_corpus = normalize(reference_queries), normalize(reference_corpus)
+    queries, corpus = normalize(queries), normalize(corpus)
+    drift = 1 - np.concatenate([(reference_queries * queries).sum(axis = 1), (reference_corpus * corpus).sum(axis = 1)])
+
+    reference_neighbors = exact_search(reference_queries, reference_corpus, k, normalized = True)[1]
+    neighbors = exact_search(queries, corpus, k, normalized = True)[1]
+    report = {
+        'mean_cosine_drift': float(drift.mean()),
+        'max_cosine_drift': float(drift.max()),
+        f'neighbor_recall@{k}': _recall(neighbors, reference_neighbors),
+    }
+    if true_indices is not None:
+        report[f'recall@{k}_fp32'] = _recall(reference_neighbors, true_indices)
+        report[f'recall@{k}'] = _recall(neighbors, true_indices)
+    return report
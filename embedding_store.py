@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""Persistent, memory-mapped embeddings of the topics and content
+
+The ids, embeddings (float32 or float16) and languages returned by `TextEmbedding.fit` are saved as
+`.npy` files that are memory-mapped when loaded, with a `meta.json` recording the embedding model
+directory. A store is keyed by the fingerprint of the embedding model (its weights and the tokenizer)
+and of the encoded data (ids, input texts and languages), so a later run only loads it back when
+neither of them changed.
+
+`EmbeddingCache` addresses the embedding of every text by the hash of the model fingerprint and of
+the text itself, so that when the data changes only the new or edited texts are encoded again.
+"""
+
+import os, json, hashlib, functools
+import numpy as np
+
+from token_store import tokenizer_fingerprint, texts_fingerprint
+from utils import print_log, file_hash, write_directory, MemoryMappedStore
+
+EMBEDDING_STORE_VERSION = 1
+
+def model_fingerprint(model_dir):
+    names = sorted(name for name in os.listdir(model_dir) if name.endswith(('.json', '.bin', '.safetensors')))
+    # Hashing the weights takes a while, it is only done again when the files were modified
+    stamps = tuple((name, os.path.getsize(os.path.join(model_dir, name)), os.path.getmtime(os.path.join(model_dir, name)))
+                   for name in names)
+    return _model_fingerprint(model_dir, stamps)
+
+@functools.lru_cache(maxsize = None)
+def _model_fingerprint(model_dir, stamps):
+    sha = hashlib.sha1()
+    for name, _, _ in stamps:
+        sha.update(name.encode())
+        sha.update(file_hash(os.path.join(model_dir, name)).encode())
+    return sha.hexdigest()[:16]
+
+def embedding_key(cfg):
+    '''Fingerprint of everything the embedding of a text depends on, besides the text itself'''
+    key = f'{model_fingerprint(cfg.embedding_model_dir)}_{tokenizer_fingerprint(cfg.tokenizer, cfg.max_len)}'
+    if cfg.device.type == 'cpu' and cfg.cpu_inference is not None:
+        key += f'_{cfg.cpu_inference}'    # The quantized/bfloat16 embeddings differ from the float32 ones
+    return key
+
+def data_fingerprint(df):
+    sha = hashlib.sha1()
+    sha.update(texts_fingerprint(df['id'].values, df['input_text'].values).encode())
+    sha.update(np.ascontiguousarray(df['encoded_language'].values, dtype = np.int64).tobytes())
+    return sha.hexdigest()[:16]
+
+class EmbeddingStore(MemoryMappedStore):
+    array_names = ('ids', 'embeddings', 'languages')
+
+    @property
+    def ids(self):
+        return self.arrays['ids']
+
+    @property
+    def embeddings(self):
+        return self.arrays['embeddings']
+
+    @property
+    def languages(self):
+        return self.arrays['languages']
+
+    def __len__(self):
+        return len(self.arrays['ids'])
+
+    def load(self):
+        '''The ids, float32 embeddings and languages, as returned by `TextEmbedding.fit`'''
+        return np.asarray(self.ids), np.asarray(self.embeddings, dtype = np.float32), np.asarray(self.languages)
+
+    @classmethod
+    def write(cls, path, ids, embeddings, languages, meta, dtype = 'float32'):
+        def write_fn(tmp_path):
+            np.save(os.path.join(tmp_path, 'ids.npy'), np.asarray(ids).astype(str))
+            np.save(os.path.join(tmp_path, 'embeddings.npy'), np.asarray(embeddings, dtype = dtype))
+            np.save(os.path.join(tmp_path, 'languages.npy'), np.asarray(languages, dtype = np.int64))
+            with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+                json.dump(dict(meta, version = EMBEDDING_STORE_VERSION, size = len(ids), dim = int(np.shape(embeddings)[1]),
+                               dtype = dtype), f, indent = 2)
+        return cls(write_directory(path, write_fn, replace = True))
+
+    @classmethod
+    def load_or_build(cls, cfg, name, df, embed_fn):
+        '''
+        Load the embeddings of `df` when `cfg.done_embedding` is set and the store matches the current model and
+        data, otherwise compute them with `embed_fn` (e.g. `TextEmbedding(cfg, df).fit`) and store them
+        '''
+        fields = {
+            'model': embedding_key(cfg),
+            'data': data_fingerprint(df),
+            'dtype': cfg.embedding_dtype,
+        }
+        key = hashlib.sha1(json.dumps(fields, sort_keys = True).encode()).hexdigest()[:16]
+        path = os.path.join(cfg.embedding_store_dir, f'{name}_v{EMBEDDING_STORE_VERSION}_{key}')
+        if cfg.done_embedding and os.path.exists(os.path.join(path, 'meta.json')):
+            print_log(cfg, f'Loading the {name} embeddings from {path}...')
+            return cls(path)
+
+        ids, embeddings, languages = embed_fn()
+        print_log(cfg, f'Storing the {name} embeddings to {path}...')
+        os.makedirs(cfg.embedding_store_dir, exist_ok = True)
+        meta = {'name': name, 'embedding_model_dir': cfg.embedding_model_dir, 'key': fields}
+        return cls.write(path, ids, embeddings, languages, meta, dtype = cfg.embedding_dtype)
+
+class EmbeddingCache(object):
+    '''
+    Embeddings addressed by the hash of the model fingerprint and of the input text. `lookup` finds the texts that
+    were already encoded and `update` replaces the cache by the embeddings of the current texts, so the entities
+    removed from the data are dropped from it.
+    '''
+    def __init__(self, path, model_key, dtype = 'float32'):
+        self.path = path
+        self.model_key = model_key
+        self.dtype = dtype
+        if os.path.exists(os.path.join(path, 'meta.json')):
+            self.hashes = np.load(os.path.join(path, 'hashes.npy'))
+            self.embeddings = np.load(os.path.join(path, 'embeddings.npy'), mmap_mode = 'r')
+        else:
+            self.hashes = np.zeros(0, dtype = 'S40')
+            self.embeddings = None
+
+    @classmethod
+    def open(cls, cfg, name):
+        return cls(os.path.join(cfg.embedding_store_dir, f'{name}_cache'), embedding_key(cfg), dtype = cfg.embedding_dtype)
+
+    def text_hashes(self, texts):
+        prefix = self.model_key.encode() + b'\x00'
+        return np.array([hashlib.sha1(prefix + text.encode()).hexdigest() for text in texts], dtype = 'S40')
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def lookup(self, hashes):
+        '''Whether each hash is in the cache, and its row when it is'''
+        rows = np.searchsorted(self.hashes, hashes)
+        rows = np.minimum(rows, max(len(self.hashes) - 1, 0))
+        found = self.hashes[rows] == hashes if len(self.hashes) > 0 else np.zeros(len(hashes), dtype = bool)
+        return found, rows
+
+    def update(self, hashes, embeddings):
+        # The hashes are kept sorted, for `lookup`; identical texts share one entry
+        hashes, first = np.unique(hashes, return_index = True)
+        def write_fn(tmp_path):
+            np.save(os.path.join(tmp_path, 'hashes.npy'), hashes)
+            np.save(os.path.join(tmp_path, 'embeddings.npy'), np.asarray(embeddings, dtype = self.dtype)[first])
+            with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+                json.dump({'version': EMBEDDING_STORE_VERSION, 'size': len(hashes), 'dtype': self.dtype}, f, indent = 2)
+        write_directory(self.path, write_fn, replace = True)
+        self.hashes = hashes
+        self.embeddings = np.load(os.path.join(self.path, 'embeddings.npy'), mmap_mode = 'r')
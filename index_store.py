@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""Persistent, memory-mapped search indexes of the content
+
+A `SearchIndexStore` holds everything needed to search the candidates of the topics: the content ids
+and languages, the projection of `cfg.search_dim` (if any), the arrays of the index selected by the
+config (the normalized content matrix, its language partitions, the IVF lists, the PQ or int8 codes)
+and, for the PQ and int8 indexes, the normalized content they re-rank from. Every array is an `.npy`
+file memory-mapped when the store is opened, so a new process only reads the pages its queries touch
+and opening a store takes the same time whatever the size of the corpus. `meta.json` records the
+version of the format and the kind of index.
+
+A store is keyed by the content embedding store it was built from, whose name is already the
+fingerprint of the embedding model and of the content, and by the settings of the index.
+"""
+
+import os, json, hashlib
+import numpy as np
+
+from search_index import ExactIndex, LanguagePartitionedIndex, IVFIndex, PQIndex, Int8Index, PCAProjection, \
+                         fit_projection, build_index, index_search, normalize
+from utils import print_log, write_directory, MemoryMappedStore
+
+SEARCH_INDEX_VERSION = 1
+
+INDEX_KINDS = {
+    'exact': ExactIndex,
+    'language_partitioned': LanguagePartitionedIndex,
+    'ivf': IVFIndex,
+    'pq': PQIndex,
+    'int8': Int8Index,
+}
+
+def index_settings(cfg):
+    '''The settings of the config the stored index depends on (the search parameters, e.g. nprobe, are not stored)'''
+    return {
+        'search_dim': cfg.search_dim,
+        'language_partitioned_search': cfg.language_partitioned_search,
+        'search_nlist': cfg.search_nlist,
+        'search_pq_subspaces': cfg.search_pq_subspaces,
+        'search_int8': cfg.search_int8,
+    }
+
+class SearchIndexStore(MemoryMappedStore):
+    def __init__(self, path):
+        super().__init__(path)
+        assert self.meta['version'] == SEARCH_INDEX_VERSION, f'{path} is a search index of version {self.meta["version"]}!'
+        self._index = None
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state['_index'] = None
+        return state
+
+    @property
+    def array_names(self):
+        return self.meta['arrays']
+
+    def _state(self, prefix):
+        return {name[len(prefix):]: array for name, array in self.arrays.items() if name.startswith(prefix)}
+
+    @property
+    def ids(self):
+        return self.arrays['ids']
+
+    @property
+    def languages(self):
+        return self.arrays['languages']
+
+    @property
+    def vectors(self):
+        '''The normalized content the PQ and int8 candidates are re-ranked from, None for the other indexes'''
+        return self.arrays.get('vectors')
+
+    @property
+    def projection(self):
+        return PCAProjection.from_state(self._state('projection.')) if 'projection.components' in self.arrays else None
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = INDEX_KINDS[self.meta['kind']].from_state(self._state('index.'))
+        return self._index
+
+    def __len__(self):
+        return self.meta['size']
+
+    def search(self, cfg, topic_embeddings, topic_languages):
+        '''The distances and indices of the nearest content items of the topics, as `candidate_search`'''
+        projection = self.projection
+        if projection is not None:
+            topic_embeddings = projection.transform(topic_embeddings)
+        return index_search(cfg, self.index, topic_embeddings, topic_languages, vectors = self.vectors)
+
+    @classmethod
+    def write(cls, path, ids, languages, index, projection = None, vectors = None, meta = {}):
+        arrays = {'ids': np.asarray(ids).astype(str), 'languages': np.asarray(languages, dtype = np.int64)}
+        arrays.update({f'index.{name}': array for name, array in index.state().items()})
+        if projection is not None:
+            arrays.update({f'projection.{name}': array for name, array in projection.state().items()})
+        if vectors is not None:
+            arrays['vectors'] = vectors
+        kind = next(name for name, index_class in INDEX_KINDS.items() if isinstance(index, index_class))
+
+        def write_fn(tmp_path):
+            for name, array in arrays.items():
+                np.save(os.path.join(tmp_path, f'{name}.npy'), np.asarray(array))
+            with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+                json.dump(dict(meta, version = SEARCH_INDEX_VERSION, kind = kind, size = len(arrays['ids']),
+                               arrays = sorted(arrays.keys())), f, indent = 2)
+        return cls(write_directory(path, write_fn, replace = True))
+
+    @classmethod
+    def build(cls, cfg, path, ids, embeddings, languages, meta = {}):
+        projection = fit_projection(cfg, embeddings)
+        if projection is not None:
+            embeddings = projection.transform(embeddings)
+        index = build_index(cfg, embeddings, languages)
+        vectors = normalize(embeddings) if isinstance(index, (PQIndex, Int8Index)) else None
+        return cls.write(path, ids, languages, index, projection = projection, vectors = vectors, meta = meta)
+
+    @classmethod
+    def load_or_build(cls, cfg, name, embedding_store):
+        '''
+        Open the index of the content of `embedding_store` when `cfg.done_embedding` is set and it was built with the
+        current settings, otherwise build and store it
+        '''
+        fields = {'embeddings': os.path.basename(os.path.normpath(embedding_store.path)), 'index': index_settings(cfg)}
+        key = hashlib.sha1(json.dumps(fields, sort_keys = True).encode()).hexdigest()[:16]
+        path = os.path.join(cfg.embedding_store_dir, f'{name}_index_v{SEARCH_INDEX_VERSION}_{key}')
+        if cfg.done_embedding and os.path.exists(os.path.join(path, 'meta.json')):
+            print_log(cfg, f'Loading the {name} search index from {path}...')
+            return cls(path)
+
+        ids, embeddings, languages = embedding_store.load()
+        print_log(cfg, f'Storing the {name} search index to {path}...')
+        os.makedirs(cfg.embedding_store_dir, exist_ok = True)
+        return cls.build(cfg, path, ids, embeddings, languages, meta = {'name': name, 'key': fields})
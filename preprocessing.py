@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""Preprocessing shared by retriever_train.py and reranker_train.py
+
+`load_processed_data` reads topics.csv, content.csv and correlations.csv, splits the topics into
+folds, assigns the content folds, fills the missing values, encodes the languages and builds the
+`input_text` of topics (with their breadcrumbs) and content. The result is written to a columnar
+cache keyed by the hash of the CSV files and of the relevant `Config` fields, so that subsequent
+launches only read the processed tables back.
+"""
+
+import os, json, pickle, hashlib
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from sklearn.model_selection import StratifiedGroupKFold, GroupKFold
+
+from topic_tree import TopicTree
+from topic_content_index import TopicContentIndex
+from utils import print_log, file_hash, write_directory
+
+try:
+    import pyarrow
+    cache_format = 'parquet'
+except ImportError:
+    cache_format = 'pkl'
+
+PREPROCESSING_VERSION = 1
+
+"""# Processing steps"""
+
+def read_content_csv(cfg, path):
+    '''
+    Read content.csv by chunks of `cfg.content_chunksize` rows, storing `language`/`kind` as categoricals and
+    clipping the text fields to the character budgets of `cfg.content_char_budget` as they are read, so the
+    full texts are never held in memory at once.
+    '''
+    if cfg.content_chunksize is None:
+        return pd.read_csv(path)
+
+    categorical = ['language', 'kind']
+    chunks = []
+    # A chunk without any description/text would otherwise read the column as float64 NaN
+    text_dtypes = {'title': str, 'description': str, 'text': str}
+    for chunk in pd.read_csv(path, chunksize = cfg.content_chunksize, dtype = text_dtypes):
+        if cfg.content_char_budget is not None:
+            for field, budget in cfg.content_char_budget.items():
+                chunk[field] = chunk[field].str.slice(0, budget)
+        for field in categorical:
+            chunk[field] = chunk[field].astype('category')
+        chunks.append(chunk)
+
+    # The chunks have different categories, unify them before concatenating
+    categories = {field: union_categoricals([chunk[field] for chunk in chunks]).categories for field in categorical}
+    for chunk in chunks:
+        for field in categorical:
+            chunk[field] = chunk[field].cat.set_categories(categories[field])
+    return pd.concat(chunks, ignore_index = True)
+
+def process_data(cfg, df, is_content = False):
+    # Fill NaN values in the title and description columns
+    df['title'] = df['title'].fillna(' ')
+    df['description'] = df['description'].fillna(' ')
+    if is_content:
+        df['text'] = df['text'].fillna(' ')
+
+    # Encode the language
+    df['encoded_language'] = df['language'].map(cfg.languages_map).astype(np.int64)
+    return df
+
+def fold_path(cfg):
+    return os.path.join(cfg.ext_data_dir, f'topic2fold_{cfg.nfolds}split_stratifiedkfold.pkl')
+
+def write_folds(cfg, topics_df):
+    '''Save the fold of every topic, for the runs with `done_kfold_split` set'''
+    topic2fold_split = topics_df[['id', 'fold']].set_index('id').to_dict()['fold']
+    with open(fold_path(cfg), 'wb') as f:
+        pickle.dump(topic2fold_split, f)
+    return topic2fold_split
+
+def split_folds(cfg, topics_df):
+    if cfg.done_kfold_split:
+        with open(fold_path(cfg), 'rb') as f:
+            return pickle.load(f)
+
+    if cfg.kfold_method == 'stratified_group':
+        kf = StratifiedGroupKFold(n_splits = cfg.nfolds)
+        folds = list(kf.split(topics_df, y = topics_df['has_content'], groups = topics_df['channel']))
+    else:
+        kf = GroupKFold(n_splits = cfg.nfolds)
+        folds = list(kf.split(topics_df, groups = topics_df['channel']))
+    topics_df['fold'] = -1
+
+    for fold, (train_idx, val_idx) in enumerate(folds):
+        topics_df.loc[val_idx, 'fold'] = fold
+    return write_folds(cfg, topics_df)
+
+def join_fields(df, fields, separator, chunk_size = 20000):
+    '''
+    Column-wise equivalent of `df.apply(lambda x: separator.join([x[f] for f in fields]), axis = 1)`. The rows
+    are processed by chunks, so the temporary strings never exceed one chunk of the (possibly huge) fields.
+    '''
+    input_text = np.empty(len(df), dtype = object)
+    for start in range(0, len(df), chunk_size):
+        chunk = df.iloc[start:start + chunk_size]
+        text = chunk[fields[0]].to_numpy(dtype = object)
+        for field in fields[1:]:
+            text = text + separator + chunk[field].to_numpy(dtype = object)
+        input_text[start:start + chunk_size] = text
+    return input_text
+
+def build_input_text(cfg, topics_df, content_df):
+    topics_df['input_text'] = join_fields(topics_df, cfg.topic_fields, cfg.topic_field_separator, chunk_size = cfg.text_chunk_size)
+    content_df['input_text'] = join_fields(content_df, cfg.content_fields, cfg.content_field_separator, chunk_size = cfg.text_chunk_size)
+
+    # Same as Topic(topic_id).get_breadcrumbs(separator = cfg.tokenizer.sep_token) for every topic
+    topic_tree = TopicTree.from_df(topics_df)
+    topics_df['input_text'] = topic_tree.breadcrumbs(topics_df['input_text'].values, separator = cfg.tokenizer.sep_token,
+                                                     n_jobs = cfg.breadcrumb_jobs)
+    return topics_df, content_df
+
+def preprocess(cfg):
+    content_df = read_content_csv(cfg, os.path.join(cfg.comp_data_dir, 'content.csv'))
+    topics_df = pd.read_csv(os.path.join(cfg.comp_data_dir, 'topics.csv'))
+    correlations_df = pd.read_csv(os.path.join(cfg.comp_data_dir, 'correlations.csv'))
+
+    all_languages = sorted(list(set(topics_df['language'].tolist() + content_df['language'].tolist())))
+    cfg.languages_map = dict(zip(all_languages, range(len(all_languages))))
+
+    print_log(cfg, 'Splitting the folds...')
+    topic2fold_split = split_folds(cfg, topics_df)
+    topics_df['fold'] = topics_df['id'].map(topic2fold_split)
+    correlations_df['fold'] = correlations_df['topic_id'].map(topic2fold_split)
+
+    # A content item belongs to a fold when all of its topics are in that fold
+    topic_content_index = TopicContentIndex.from_correlations(correlations_df, topic_ids = topics_df['id'].values,
+                                                              content_ids = content_df['id'].values)
+    content_df['fold'] = topic_content_index.content_fold(topics_df['fold'].values)
+
+    print_log(cfg, 'Processing the topics and content...')
+    topics_df = process_data(cfg, topics_df)
+    content_df = process_data(cfg, content_df, is_content = True)
+    topics_df, content_df = build_input_text(cfg, topics_df, content_df)
+    return topics_df, content_df, correlations_df
+
+"""# Cache"""
+
+def cache_key(cfg):
+    fields = {
+        'version': PREPROCESSING_VERSION,
+        'topic_fields': cfg.topic_fields,
+        'topic_field_separator': cfg.topic_field_separator,
+        'content_fields': cfg.content_fields,
+        'content_field_separator': cfg.content_field_separator,
+        'content_char_budget': cfg.content_char_budget if cfg.content_chunksize is not None else None,
+        'breadcrumb_separator': cfg.tokenizer.sep_token,
+        'nfolds': cfg.nfolds,
+        'seed': cfg.seed,
+        'kfold_method': cfg.kfold_method,
+    }
+    for name in ['topics', 'content', 'correlations']:
+        fields[name] = file_hash(os.path.join(cfg.comp_data_dir, f'{name}.csv'))
+    if cfg.done_kfold_split:
+        fields['folds'] = file_hash(fold_path(cfg))
+    return hashlib.sha1(json.dumps(fields, sort_keys = True).encode()).hexdigest()[:16], fields
+
+def _write_table(df, path):
+    if cache_format == 'parquet':
+        df.to_parquet(path, index = False)
+    else:
+        df.to_pickle(path)
+
+def _read_table(path):
+    if cache_format == 'parquet':
+        return pd.read_parquet(path)
+    return pd.read_pickle(path)
+
+def load_processed_data(cfg):
+    if not cfg.use_processed_cache:
+        return preprocess(cfg)
+
+    key, fields = cache_key(cfg)
+    cache_dir = os.path.join(cfg.processed_data_dir, key)
+    tables = ['topics', 'content', 'correlations']
+
+    if os.path.exists(os.path.join(cache_dir, 'meta.json')):
+        print_log(cfg, f'Loading the processed data from {cache_dir}...')
+        with open(os.path.join(cache_dir, 'meta.json'), 'r') as f:
+            cfg.languages_map = json.load(f)['languages_map']
+        topics_df, content_df, correlations_df = (_read_table(os.path.join(cache_dir, f'{name}.{cache_format}')) for name in tables)
+        if not cfg.done_kfold_split:
+            write_folds(cfg, topics_df)    # As `split_folds` does, the other script may have saved its own folds since
+        return topics_df, content_df, correlations_df
+
+    topics_df, content_df, correlations_df = preprocess(cfg)
+
+    def write_fn(tmp_dir):
+        for name, df in zip(tables, [topics_df, content_df, correlations_df]):
+            _write_table(df, os.path.join(tmp_dir, f'{name}.{cache_format}'))
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump({'languages_map': cfg.languages_map, 'key': fields}, f, indent = 2)
+
+    print_log(cfg, f'Caching the processed data to {cache_dir}...')
+    write_directory(cache_dir, write_fn)
+    return topics_df, content_df, correlations_df
@@ -23,7 +23,6 @@ from sklearn.model_selection import StratifiedGroupKFold, GroupKFold
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.decomposition import TruncatedSVD
 from sklearn.pipeline import Pipeline
-from sklearn.neighbors import NearestNeighbors
 
 from scipy.spatial.distance import cdist
 
@@ -38,6 +37,16 @@ from transformers import AutoTokenizer, AutoConfig, AutoModel
 from transformers import get_cosine_schedule_with_warmup, get_linear_schedule_with_warmup, AdamW
 transformers.logging.set_verbosity_error()
 
+from topic_tree import TopicTree
+from topic_content_index import TopicContentIndex
+from preprocessing import load_processed_data
+from token_store import TokenStore
+from embedding_store import EmbeddingStore, EmbeddingCache
+from embedding_inference import inference_model, inference_autocast, run_sharded, ShardEncoder, InferenceEngine
+from batching import token_lengths, pad_sequences, inference_dataloader, UniqueTexts
+from index_store import SearchIndexStore
+from candidates import CandidateSet
+
 import warnings
 warnings.filterwarnings('ignore')
 
@@ -63,33 +72,78 @@ class Config(object):
     backbone = 'paraphrase-multilingual-mpnet-base-v4'    # 'microsoft/mdeberta-v3-base', 'xlm-roberta-base'
     tokenizer = AutoTokenizer.from_pretrained(backbone)
     config = AutoConfig.from_pretrained(backbone)
-    done_embedding = False
+    # Reuse the topic/content embeddings stored by a previous run, they are recomputed anyway when the embedding
+    # model or the data changed
+    done_embedding = True
+    embedding_dtype = 'float32'    # 'float16' halves the stored embeddings
+    # Only encode the texts that are new or were edited since the last run, the others are read from the cache
+    incremental_embedding = True
     # Add new token
     sep_token = '[LECR]'
     sep_token_id = tokenizer.vocab_size + 1
     special_tokens_dict = {'additional_special_tokens': [sep_token]}
     tokenizer.add_special_tokens(special_tokens_dict)
+    # Input text, the fields are joined in this order
+    topic_fields = ['language', 'title', 'description']
+    topic_field_separator = sep_token
+    content_fields = ['language', 'title', 'description', 'text', 'kind']
+    content_field_separator = sep_token
+    text_chunk_size = 20000    # Rows joined at once, bounds the memory taken by the temporary strings
     # Embedding model
     embedding_model = 'v17a'
     # Data
     done_kfold_split = False
+    kfold_method = 'stratified_group'    # 'group', 'stratified_group'
+    breadcrumb_jobs = 1    # Number of processes building the topic breadcrumbs
+    use_processed_cache = True    # Reuse the processed data cached by a previous run (of either script)
     nfolds = 5
     negative_sample_ratio = 0.3
     done_context = True
     # Dataloader
     max_len = 128
+    # content.csv is read by chunks and its fields are clipped to a character budget (None keeps everything),
+    # only the first max_len tokens of the input text are used anyway
+    content_chunksize = 20000    # None to read the whole file at once
+    content_char_budget = {'title': 16 * max_len, 'description': 16 * max_len, 'text': 16 * max_len}
+    use_token_store = True    # Tokenize the topics and content once, the datasets read the token ids from disk
     batch_size = 64 if not debug else 4
+    # Inference sorts the texts by token length and fills each batch up to this many padded tokens (None keeps
+    # batches of batch_size in the dataframe order)
+    inference_max_tokens = batch_size * max_len
+    # On CPU, the encoder infers the embeddings in float32 (None), with its linear layers dynamically quantized to
+    # int8 ('int8') or with bfloat16 autocast ('bf16'), see `python benchmarks.py cpu_inference` for the trade-off
+    cpu_inference = None
+    dedup_texts = True    # Encode the identical input texts only once at inference
+    # On CPU, the corpus is split into this many contiguous shards encoded by as many processes, each with
+    # embedding_shard_threads intra-op threads (None shares the cores between the shards)
+    embedding_shards = 1
+    embedding_shard_threads = None
     num_workers = os.cpu_count()
     # For validation
     thres = {
         'cosine': None,
         'num_k': 50,
     }
+    search_dim = None    # The embeddings are projected to this many dimensions (e.g. 128, 256) for the kNN search
+    language_partitioned_search = False    # The candidates of a topic are only searched among the content of its language
+    search_extra_languages = {}    # and of these other languages, e.g. {'mul': ['en']}
+    search_nlist = None    # Approximate kNN search with an IVF index of this many k-means lists (e.g. 1024)
+    search_nprobe = 16    # probing the lists of this many nearest centroids of every topic
+    search_pq_subspaces = None    # Approximate kNN search over the content product-quantized to this many bytes (e.g. 96)
+    search_pq_rerank = 4    # and exact re-rank of the num_k * search_pq_rerank nearest codes (0 to skip it)
+    search_int8 = False    # kNN search over the content quantized to int8
+    search_int8_rerank = 4    # re-scoring the num_k * search_int8_rerank best candidates in float32
     
     ################## For the second-stage training ##################
     apex = True
     gradient_checkpointing = False
     stg2_nepochs = 3
+    # A pair is the topic and content token ids, each padded to max_len as the second-stage model was trained with.
+    # Packing them without the inner padding makes the pairs much shorter, but changes the inputs of the model
+    stg2_packed_pairs = False
+    # The pairs are inferred sorted by length, up to this many padded tokens per batch (None keeps batches of
+    # batch_size in the dataframe order)
+    stg2_inference_max_tokens = batch_size * 2 * max_len
     gradient_accumulation_steps = 1
     max_grad_norm = 50
     # Optimizer
@@ -113,16 +167,25 @@ class Config(object):
         comp_data_dir = f'/content/drive/My Drive/Kaggle competitions/{competition_name}/comp_data'
         ext_data_dir = f'/content/drive/My Drive/Kaggle competitions/{competition_name}/ext_data'
         model_dir = f'/content/drive/My Drive/Kaggle competitions/{competition_name}/model'
+        processed_data_dir = f'{ext_data_dir}/processed'
+        token_store_dir = f'{ext_data_dir}/tokens'
+        embedding_store_dir = f'{ext_data_dir}/embeddings'
         embedding_model_dir = f'{model_dir}/{embedding_model[:-1]}/{embedding_model[-1]}'
         os.makedirs(os.path.join(model_dir, ver[:-1], ver[-1]), exist_ok = True)
     elif env == 'kaggle':
         comp_data_dir = ...
         ext_data_dir = ...
         model_dir = ...
+        processed_data_dir = ...
+        token_store_dir = ...
+        embedding_store_dir = ...
     elif env == 'vastai':
         comp_data_dir = 'data'
         ext_data_dir = 'ext_data'
         model_dir = f'model'
+        processed_data_dir = f'{ext_data_dir}/processed'
+        token_store_dir = f'{ext_data_dir}/tokens'
+        embedding_store_dir = f'{ext_data_dir}/embeddings'
         embedding_model_dir = f'{model_dir}/{embedding_model[:-1]}/{embedding_model[-1]}'
         os.makedirs(os.path.join(model_dir, ver[:-1], ver[-1]), exist_ok = True)
 
@@ -181,60 +244,26 @@ def print_log(cfg, message):
     else:
         print(message)
 
-"""# Explore the data"""
-
-content_df = pd.read_csv(os.path.join(cfg.comp_data_dir, 'content.csv'))
-topics_df = pd.read_csv(os.path.join(cfg.comp_data_dir, 'topics.csv'))
-
-all_languages = sorted(list(set(topics_df['language'].tolist() + content_df['language'].tolist())))
-cfg.languages_map = dict(zip(all_languages, range(len(all_languages))))
-
-"""# K-fold spliting"""
-
-if not cfg.done_kfold_split:
-    kf = StratifiedGroupKFold(n_splits = cfg.nfolds)
-    folds = list(kf.split(topics_df, y = topics_df['has_content'], groups = topics_df['channel']))
-    topics_df['fold'] = -1
-
-    for fold, (train_idx, val_idx) in enumerate(folds):
-        topics_df.loc[val_idx, 'fold'] = fold
-    topic2fold_split = topics_df[['id', 'fold']].set_index('id').to_dict()['fold']
-
-    with open(os.path.join(cfg.ext_data_dir, f'topic2fold_{cfg.nfolds}split_stratifiedkfold.pkl'), 'wb') as f:
-        pickle.dump(topic2fold_split, f)
-else:
-    with open(os.path.join(cfg.ext_data_dir, f'topic2fold_{cfg.nfolds}split_stratifiedkfold.pkl'), 'rb') as f:
-        topic2fold_split = pickle.load(f)
-
-correlations_df = pd.read_csv(os.path.join(cfg.comp_data_dir, 'correlations.csv'))
-topics_df['fold'] = topics_df['id'].map(topic2fold_split)
-correlations_df['fold'] = correlations_df['topic_id'].map(topic2fold_split)
-content_df['fold'] = -1
-
-for fold in range(cfg.nfolds):
-    content_in_fold = set(correlations_df.loc[correlations_df['fold'] == fold, 'content_ids'].str.split().explode().tolist())
-    content_not_in_fold = set(correlations_df.loc[correlations_df['fold'] != fold, 'content_ids'].str.split().explode().tolist())
-    only_content_in_fold = content_in_fold - content_not_in_fold
-    content_df.loc[content_df['id'].isin(only_content_in_fold), 'fold'] = fold
-
 """# Prepare the data
 
-* Process the topic and content data
+* Load the processed topics/content/correlations, they are only recomputed from the CSV files when the cache misses
 """
 
-def process_data(cfg, df, is_content = False):
-    # Fill NaN values in the title and description columns
-    df['title'] = df['title'].fillna(' ')
-    df['description'] = df['description'].fillna(' ')
-    if is_content:
-        df['text'] = df['text'].fillna(' ')
+topics_df, content_df, correlations_df = load_processed_data(cfg)
+topic2fold_split = topics_df[['id', 'fold']].set_index('id').to_dict()['fold']
+ground_truth_df = correlations_df[['topic_id', 'content_ids']].copy()
+
+topic_tree = TopicTree.from_df(topics_df)
+topic_content_index = TopicContentIndex.from_correlations(correlations_df, topic_ids = topics_df['id'].values, 
+                                                          content_ids = content_df['id'].values)
 
-    # Encode the language
-    df['encoded_language'] = df['language'].map(cfg.languages_map)
-    return df
+"""* Pre-tokenize the input texts, the token stores are only rebuilt when the texts or the tokenizer change"""
 
-topics_df = process_data(cfg, topics_df)
-content_df = process_data(cfg, content_df, is_content = True)
+if cfg.use_token_store:
+    topic_token_store = TokenStore.load_or_build(cfg, 'topics', topics_df['id'].values, topics_df['input_text'].values)
+    content_token_store = TokenStore.load_or_build(cfg, 'content', content_df['id'].values, content_df['input_text'].values)
+else:
+    topic_token_store = content_token_store = None
 
 """# Helper functions from the host"""
 
@@ -244,32 +273,25 @@ class Topic:
 
     @property
     def parent(self):
-        parent_id = topics_df.loc[self.id].parent
-        if pd.isna(parent_id):
+        parent_idx = topic_tree.parent(topic_tree.index(self.id))
+        if parent_idx < 0:
             return None
         else:
-            return Topic(parent_id)
+            return Topic(topic_tree.ids[parent_idx])
 
     @property
     def ancestors(self):
-        ancestors = []
-        parent = self.parent
-        while parent is not None:
-            ancestors.append(parent)
-            parent = parent.parent
-        return ancestors
+        return [Topic(topic_id) for topic_id in topic_tree.ids[topic_tree.ancestors(topic_tree.index(self.id))]]
 
     @property
     def siblings(self):
-        if not self.parent:
-            return []
-        else:
-            return [topic for topic in self.parent.children if topic != self]
+        return [Topic(topic_id) for topic_id in topic_tree.ids[topic_tree.siblings(topic_tree.index(self.id))]]
 
     @property
     def content(self):
-        if self.id in correlations_df.index:
-            return [ContentItem(content_id) for content_id in correlations_df.loc[self.id].content_ids.split()]
+        content_ids = topic_content_index.content_ids_of(self.id)
+        if len(content_ids) > 0:
+            return [ContentItem(content_id) for content_id in content_ids]
         else:
             return tuple([]) if self.has_content else []
 
@@ -289,7 +311,11 @@ class Topic:
 
     @property
     def children(self):
-        return [Topic(child_id) for child_id in topics_df[topics_df.parent == self.id].index]
+        return [Topic(child_id) for child_id in topic_tree.ids[topic_tree.children(topic_tree.index(self.id))]]
+
+    @property
+    def subtree(self):
+        return [Topic(topic_id) for topic_id in topic_tree.ids[topic_tree.subtree(topic_tree.index(self.id))]]
 
     def subtree_markdown(self, depth=0):
         markdown = "  " * depth + "- " + self.title + "\n"
@@ -305,7 +331,8 @@ class Topic:
         return self.id == other.id
 
     def __getattr__(self, name):
-        return topics_df.loc[self.id][name]
+        # Rows of topics_df are in the same order as the topic tree
+        return topics_df[name].iat[topic_tree.index(self.id)]
 
     def __str__(self):
         return self.title
@@ -320,10 +347,11 @@ class ContentItem:
 
     @property
     def topics(self):
-        return [Topic(topic_id) for topic_id in topics_df.loc[correlations_df[correlations_df.content_ids.str.contains(self.id)].index].index]
+        return [Topic(topic_id) for topic_id in topic_content_index.topic_ids_of(self.id)]
 
     def __getattr__(self, name):
-        return content_df.loc[self.id][name]
+        # Rows of content_df are in the same order as the incidence index
+        return content_df[name].iat[topic_content_index.content_index(self.id)]
 
     def __str__(self):
         return self.title
@@ -347,41 +375,19 @@ class ContentItem:
             breadcrumbs.append(new_breadcrumb)
         return breadcrumbs
 
-"""# Process the topics_df data"""
-
-topics_df = topics_df.set_index('id')
-content_df = content_df.set_index('id')
-correlations_df = correlations_df.set_index('topic_id')
-
-topics_df['input_text'] = topics_df.apply(lambda x: cfg.sep_token.join([x['language'],
-                                                                        x['title'],
-                                                                        x['description']]), axis = 1)
-
-content_df['input_text'] = content_df.apply(lambda x: cfg.sep_token.join([x['language'],
-                                                                          x['title'],
-                                                                          x['description'],
-                                                                          x['text'],
-                                                                          x['kind']]), axis = 1)
-
-topics_df['text'] = topics_df['input_text'].values
-
-for topic_id in tqdm(topics_df.index):
-    topics_df.loc[topic_id, 'text'] = Topic(topic_id).get_breadcrumbs(separator = cfg.tokenizer.sep_token)
-    
-topics_df = topics_df.drop('input_text', axis = 1).rename(columns = {'text': 'input_text'})
-    
-topics_df = topics_df.reset_index()
-content_df = content_df.reset_index()
-correlations_df = correlations_df.reset_index()
-
 """# Design the dataloader"""
 
 class LECRDataset(Dataset):
-    def __init__(self, cfg, df):
+    def __init__(self, cfg, df, token_store = None):
         self.cfg = cfg
         self.input_text = df['input_text'].tolist()
         self.ids = df['id'].tolist()
         self.language = df['encoded_language'].tolist()
+        self.unique_texts = UniqueTexts(self.input_text) if cfg.dedup_texts else None
+        # Rows of the pre-tokenized texts, if any
+        self.token_store = token_store
+        if token_store is not None:
+            self.token_rows = token_store.indices(df['id'].values)
         
     def _tokenize(self, text):
         token = self.cfg.tokenizer(text,
@@ -391,6 +397,11 @@ class LECRDataset(Dataset):
                                    return_attention_mask = True)
         return token
 
+    def token_lengths(self):
+        if self.token_store is not None:
+            return np.minimum(self.token_store.lengths[self.token_rows], self.cfg.max_len)
+        return token_lengths(self.cfg.tokenizer, self.input_text, self.cfg.max_len)
+
     def __len__(self):
         return len(self.input_text)
 
@@ -399,32 +410,44 @@ class LECRDataset(Dataset):
         input_text = self.input_text[idx]
         language = self.language[idx]
         
-        content_token = self._tokenize(input_text)
+        if self.token_store is not None:
+            input_ids, attention_mask = self.token_store.padded(self.token_rows[idx], self.cfg.max_len)
+        else:
+            content_token = self._tokenize(input_text)
+            input_ids, attention_mask = content_token['input_ids'], content_token['attention_mask']
         
         return {
+            'idx': idx,
             'ids': ids,
-            'input_ids': torch.tensor(content_token['input_ids'], dtype = torch.long),
-            'attention_mask': torch.tensor(content_token['attention_mask'], dtype = torch.long),
+            'input_ids': torch.tensor(input_ids, dtype = torch.long),
+            'attention_mask': torch.tensor(attention_mask, dtype = torch.long),
             'language': torch.tensor(language, dtype = torch.long),
         }
 
 """# Deriving the text features"""
 
 class TextEmbedding(object):
-    def __init__(self, cfg, df):
+    def __init__(self, cfg, df, token_store = None, cache = None):
         self.cfg = cfg
         self.df = df
+        self.token_store = token_store
+        self.cache = cache
         
-    def _prepare_materials(self):
+    def _prepare_dataloader(self, df, num_workers = None):
         print_log(self.cfg, 'Preparing the dataloader...')
-        dataset = LECRDataset(cfg, self.df)
-        dataloader = DataLoader(dataset, batch_size = cfg.batch_size, num_workers = cfg.num_workers, shuffle = False)
-        
+        dataset = LECRDataset(cfg, df, token_store = self.token_store)
+        return inference_dataloader(self.cfg, dataset, self.cfg.inference_max_tokens, num_workers = num_workers)
+    
+    def _prepare_model(self):
         print_log(self.cfg, 'Preparing the encoding model...')
         
         model = AutoModel.from_pretrained(self.cfg.embedding_model_dir).to(self.cfg.device)
         model.resize_token_embeddings(len(self.cfg.tokenizer))
-        return model, dataloader
+        return inference_model(self.cfg, model)
+    
+    def _prepare_materials(self, df = None):
+        dataloader = self._prepare_dataloader(self.df if df is None else df)
+        return self._prepare_model(), dataloader
     
     def _pooler(self, x, mask = None):
         if mask is not None:
@@ -435,144 +458,110 @@ class TextEmbedding(object):
     
     def _embedding(self, model, dataloader):
         model.eval()
-    
-        ids = []
-        embeddings = []
-        languages = []
         
-        if self.cfg.use_tqdm:
-            tbar = tqdm(dataloader)
+        def forward(item):
+            input_ids, attention_mask = item['input_ids'], item['attention_mask']
+            with inference_autocast(self.cfg):
+                local_len = max(attention_mask.sum(axis = 1))
+                batch_embedding = model(input_ids[:,:local_len], attention_mask[:,:local_len]).last_hidden_state
+                batch_embedding = self._pooler(batch_embedding, mask = attention_mask[:,:local_len])
+            return batch_embedding.float()
+        
+        # The embedding of every text is written at its position in the dataframe, whatever the order of the batches
+        dataset = dataloader.dataset
+        engine = InferenceEngine(self.cfg, forward)
+        embeddings = engine.run(dataloader, len(dataset))
+        print_log(self.cfg, f'Inference timings: {engine.summary()}')
+        if dataset.unique_texts is not None:
+            dataset.unique_texts.fill_duplicates(embeddings)
+        return np.array(dataset.ids), embeddings, np.array(dataset.language)
+
+    def _encode_sharded(self, df):
+        '''Embeddings of the texts of `df`, encoded by `cfg.embedding_shards` processes that each load the model'''
+        unique_texts = UniqueTexts(df['input_text'].values) if self.cfg.dedup_texts else None
+        positions = np.arange(len(df)) if unique_texts is None else unique_texts.first
+        if self.token_store is not None:
+            texts = {'token_store': self.token_store, 'rows': self.token_store.indices(df['id'].values[positions])}
         else:
-            tbar = dataloader
-
-        for i, item in enumerate(tbar):
-            batch_ids = item['ids']
-            input_ids = item['input_ids'].to(self.cfg.device)
-            attention_mask = item['attention_mask'].to(self.cfg.device)
-            batch_languages = item['language']
-            
-            with torch.no_grad():
-                with autocast(enabled = self.cfg.apex):
-                    local_len = max(attention_mask.sum(axis = 1))
-                    batch_embedding = model(input_ids[:,:local_len], attention_mask[:,:local_len]).last_hidden_state
-                    batch_embedding = self._pooler(batch_embedding, mask = attention_mask[:,:local_len])
-                        
-            ids.append(batch_ids)
-            embeddings.append(batch_embedding.cpu().numpy())
-            languages.append(batch_languages.numpy())
-
-        ids = np.concatenate(ids)
-        embeddings = np.concatenate(embeddings)
-        languages = np.concatenate(languages)
-        return ids, embeddings, languages
+            texts = {'tokenizer': self.cfg.tokenizer, 'texts': df['input_text'].values[positions]}
+        encoder = ShardEncoder(self.cfg.embedding_model_dir, len(self.cfg.tokenizer), self.cfg.max_len,
+                               max_tokens = self.cfg.inference_max_tokens, batch_size = self.cfg.batch_size,
+                               cpu_inference = self.cfg.cpu_inference, **texts)
+        
+        print_log(self.cfg, f'Encoding {len(positions)} texts in {self.cfg.embedding_shards} shards...')
+        embeddings = run_sharded(encoder, len(positions), encoder.hidden_size, self.cfg.embedding_shards, 
+                                 num_threads = self.cfg.embedding_shard_threads)
+        return embeddings if unique_texts is None else unique_texts.scatter(embeddings)
+    
+    def _encode(self, df):
+        '''Embeddings of the texts of `df`, in its order'''
+        if self.cfg.embedding_shards > 1 and self.cfg.device.type == 'cpu':
+            return self._encode_sharded(df)
+        model, dataloader = self._prepare_materials(df)
+        return self._embedding(model, dataloader)[1]
+
+    def _fit_incremental(self):
+        hashes = self.cache.text_hashes(self.df['input_text'].values)
+        found, rows = self.cache.lookup(hashes)
+        missing = np.flatnonzero(~found)
+        print_log(self.cfg, f'{len(missing)}/{len(self.df)} texts are not in the embedding cache...')
+        
+        if len(missing) > 0:
+            new_embeddings = self._encode(self.df.iloc[missing])
+            embeddings = np.empty((len(self.df), new_embeddings.shape[1]), dtype = np.float32)
+            embeddings[missing] = new_embeddings
+        else:
+            embeddings = np.empty((len(self.df), self.cache.embeddings.shape[1]), dtype = np.float32)
+        if found.any():
+            embeddings[found] = self.cache.embeddings[rows[found]]
+        
+        # The cache now holds the current texts only
+        self.cache.update(hashes, embeddings)
+        return self.df['id'].values.astype(str), embeddings, self.df['encoded_language'].values.astype(np.int64)
 
     def fit(self):
+        if self.cache is not None:
+            return self._fit_incremental()
+        if self.cfg.embedding_shards > 1 and self.cfg.device.type == 'cpu':
+            embeddings = self._encode_sharded(self.df)
+            return self.df['id'].values.astype(str), embeddings, self.df['encoded_language'].values.astype(np.int64)
         model, dataloader = self._prepare_materials()
         ids, embeddings, languages = self._embedding(model, dataloader)
         return ids, embeddings, languages
 
-"""* Deriving topic/content embeddings"""
+"""* Deriving topic/content embeddings, or loading them back from the embedding store"""
 
-topic_embeddings_object = TextEmbedding(cfg, topics_df)
-topic_ids, topic_embeddings, topic_languages = topic_embeddings_object.fit()
+topic_embedding_cache = EmbeddingCache.open(cfg, 'topics') if cfg.incremental_embedding else None
+topic_embeddings_object = TextEmbedding(cfg, topics_df, token_store = topic_token_store, cache = topic_embedding_cache)
+topic_embedding_store = EmbeddingStore.load_or_build(cfg, 'topics', topics_df, topic_embeddings_object.fit)
+topic_ids, topic_embeddings, topic_languages = topic_embedding_store.load()
 
-content_embeddings_object = TextEmbedding(cfg, content_df)
-content_ids, content_embeddings, content_languages = content_embeddings_object.fit()
+content_embedding_cache = EmbeddingCache.open(cfg, 'content') if cfg.incremental_embedding else None
+content_embeddings_object = TextEmbedding(cfg, content_df, token_store = content_token_store, cache = content_embedding_cache)
+content_embedding_store = EmbeddingStore.load_or_build(cfg, 'content', content_df, content_embeddings_object.fit)
+content_ids = np.asarray(content_embedding_store.ids)
 
 """# Find the candidates by k-Nearest-Neighbor algorithm
 
-* Utils
-The following function allows us to find the similar contents of a small chunk of topics, for memory management purpose
+* Find candidates
 """
 
-def find_similar_contents(cfg, sub_topic_ids, sub_topic_embeddings, sub_topic_languages, content_ids, content_embeddings, content_languages):
-    similar_languages = (sub_topic_languages.view(-1, 1) - content_languages.view(1, -1)).bool().to(cfg.device)
-    cosine_similarity = F.normalize(sub_topic_embeddings.to(cfg.device)) @ F.normalize(content_embeddings.to(cfg.device)).t()
-    cosine_similarity = cosine_similarity.masked_fill(similar_languages, -1)
-    sorted_cosine_similarity, sorted_idx = torch.sort(cosine_similarity, dim = 1, descending = True)
-    
-    sorted_cosine_similarity = sorted_cosine_similarity.detach().cpu().numpy()
-    sorted_idx = sorted_idx.detach().cpu().numpy()
-    
-    topic_dict_ids = {}
-    topic_dict_distance = {}
-    for i, topic_id in enumerate(sub_topic_ids):
-        sorted_score = sorted_cosine_similarity[i]
-        sorted_content_ids = content_ids[sorted_idx[i]]
-        
-        # Chose the contents with higher cosine similarity score than the cosine threshold and the same language as the topic, moreover the list is not longer than num_k threshold
-        if cfg.thres['cosine'] is not None:
-            if cfg.thres['num_k'] is not None:
-                # If both filters are used
-                chosen_content_ids = sorted_content_ids[sorted_score > cfg.thres['cosine']][:cfg.thres['num_k']]
-                chosen_distance = sorted_score[sorted_score > cfg.thres['cosine']][:cfg.thres['num_k']]
-            else:
-                # If we filter only by the cosine similarity threshold
-                chosen_content_ids = sorted_content_ids[sorted_score > cfg.thres['cosine']]
-                chosen_distance = sorted_score[sorted_score > cfg.thres['cosine']]
-        else:
-            if cfg.thres['num_k'] is not None:
-                # If we filter only by the maximum length
-                chosen_content_ids = sorted_content_ids[:cfg.thres['num_k']]
-                chosen_distance = sorted_score[:cfg.thres['num_k']]
-            else:
-                # If we don't filter at all
-                chosen_content_ids = sorted_content_ids
-                chosen_distance = sorted_score
-
-        topic_dict_ids[topic_id] = ' '.join(chosen_content_ids.tolist())
-        topic_dict_distance[topic_id] = chosen_distance.tolist()
-    return topic_dict_ids, topic_dict_distance
-
-"""* Find candidates"""
-
-def find_candidates(cfg, topic_ids, topic_embeddings, topic_languages, content_ids, content_embeddings, content_languages):        
-    neighbors_model = NearestNeighbors(n_neighbors = cfg.thres['num_k'], metric = 'cosine')
-    neighbors_model.fit(content_embeddings)
-    
-    dist, indices = neighbors_model.kneighbors(topic_embeddings, return_distance = True)
-    
-    oof_dict_ids = {}
-    oof_dict_ids_top10 = {}
-    oof_dict_distance = {}
-    
-    for i, (topic_lang, topic_id) in enumerate(zip(topic_languages, topic_ids)):
-        chosen_contents = content_ids[indices[i]]
-        chosen_contents_top10 = content_ids[indices[i][:10]]
-        
-        oof_dict_ids[topic_id] = ' '.join(chosen_contents.tolist())
-        oof_dict_ids_top10[topic_id] = ' '.join(chosen_contents_top10.tolist())
-        oof_dict_distance[topic_id] = dist[i].tolist()
-
-    # Post-process the candidate dataframe
-    candidate_df = pd.DataFrame()
-    candidate_df['topic_id'] = list(oof_dict_ids.keys())
-    candidate_df['content_id'] = list(oof_dict_ids.values())
-    candidate_df['distance'] = list(oof_dict_distance.values())
-    candidate_df['content_id'] = candidate_df['content_id'].str.split()
-    candidate_df = candidate_df.explode(['content_id', 'distance'])
-    
+def find_candidates(cfg, topic_ids, topic_embeddings, topic_languages, content_ids, content_index):
+    dist, indices = content_index.search(cfg, topic_embeddings, topic_languages)
     torch.cuda.empty_cache()
-    
-    return candidate_df
+    # Fewer than num_k content items may be in the languages of a topic, the padding is dropped
+    return CandidateSet.from_search(topic_ids, content_ids, dist, indices)
 
-candidate_df = find_candidates(cfg, topic_ids, topic_embeddings, topic_languages, content_ids, content_embeddings, content_languages)
+content_index = SearchIndexStore.load_or_build(cfg, 'content', content_embedding_store)
+candidates = find_candidates(cfg, topic_ids, topic_embeddings, topic_languages, content_ids, content_index)
 
 """# Attach the ground truth
 
-* Process the correlations
+* The candidates correlated with their topic are labelled from the topic-content index
 """
 
-correlations_df['content_ids'] = correlations_df['content_ids'].str.split()
-correlations_df = correlations_df.explode('content_ids')
-correlations_df = correlations_df.rename(columns = {'content_ids': 'content_id'})
-correlations_df['label'] = 1
-correlations_df
-
-"""* Merge the candidate data and correlations data"""
-
-data = candidate_df.merge(correlations_df, left_on = ['topic_id', 'content_id'], right_on = ['topic_id', 'content_id'], how = 'left')
-data['label'] = data['label'].fillna(0)
+data = candidates.to_frame()
+data['label'] = candidates.labels(topic_content_index).astype(np.float64)
 data
 
 data = data.merge(topics_df[['id', 'input_text', 'encoded_language', 'category', 'has_content']], 
@@ -604,19 +593,15 @@ def metric_eachrow_fn(pred, true, beta = 2, eps = 1e-15):
     f2 = (1 + beta**2) * (precision * recall) / ((beta**2) * precision + recall + eps)
     return f2
 
-data = data.sort_values(['topic_id', 'distance'])
-data['cum_count'] = data.groupby('topic_id').agg('cumcount')
-submission = data.loc[data['cum_count'] < 10].drop('cum_count', axis = 1)
-submission = submission.groupby('topic_id')['content_id'].apply(lambda x: ' '.join(x.tolist())).to_frame().reset_index()
-true = correlations_df.dropna().groupby('topic_id')['content_id'].apply(lambda x: ' '.join(x.tolist())).to_frame().reset_index()
-final_oof = true.merge(submission, on = 'topic_id', how = 'left')
-final_oof = final_oof.merge(topics_df[['id', 'category', 'has_content']], 
-                            left_on = 'topic_id', right_on = 'id', how = 'left')
-final_oof = final_oof.loc[(final_oof.category != 'source') & final_oof.has_content].drop(['id', 'category', 'has_content'], axis = 1)
-final_oof.columns = ['topic_id', 'content_ids', 'pred_content_ids']
+# The 10 nearest candidates of the topics with correlated content, other than the sources, in the order of their ids
+candidate_topics = topics_df.set_index('id').loc[topic_ids]
+scored = (candidate_topics['category'].values != 'source') & candidate_topics['has_content'].values.astype(bool)
+scored &= np.isin(topic_ids, ground_truth_df['topic_id'].values)
+order = np.argsort(topic_ids, kind = 'stable')
+knn_score, _ = candidates.top(10).metrics(topic_content_index, topics = order[scored[order]])
 
 print_log(cfg, 'Score based on the k-NN algorithm:')
-print_log(cfg, f"Overall score: {metric_fn(final_oof['pred_content_ids'], final_oof['content_ids'])}")
+print_log(cfg, f"Overall score: {knn_score}")
 
 """# The second stage
 
@@ -624,7 +609,7 @@ print_log(cfg, f"Overall score: {metric_fn(final_oof['pred_content_ids'], final_
 """
 
 class SecondStageLECRDataset(Dataset):
-    def __init__(self, cfg, df):
+    def __init__(self, cfg, df, topic_store = None, content_store = None):
         self.cfg = cfg
         self.topic_text = df['input_text_t'].tolist()
         self.content_text = df['input_text_c'].tolist()
@@ -634,30 +619,55 @@ class SecondStageLECRDataset(Dataset):
         
         self.distance = df['distance'].tolist()
         self.label = df['label'].tolist()
+        # The model only sees the two texts, the pairs of identical texts are encoded once at inference
+        self.unique_texts = UniqueTexts(self.topic_text, self.content_text) if cfg.dedup_texts else None
+        # Rows of the pre-tokenized texts, if any: the pairs are assembled from the token ids of each topic and
+        # content item instead of tokenizing both texts of every pair
+        self.topic_store = topic_store
+        self.content_store = content_store
+        if topic_store is not None:
+            self.topic_rows = topic_store.indices(df['topic_id'].values)
+            self.content_rows = content_store.indices(df['content_id'].values)
         
     def _tokenize(self, text):
         token = self.cfg.tokenizer(text,
-                                   padding = 'max_length',
+                                   padding = 'max_length' if not self.cfg.stg2_packed_pairs else False,
                                    max_length = cfg.max_len,
                                    truncation = True,
                                    return_attention_mask = True)
         return token
+    
+    def token_lengths(self):
+        '''Number of tokens of each pair'''
+        if not self.cfg.stg2_packed_pairs:
+            return np.full(len(self.label), 2 * self.cfg.max_len - 1)
+        if self.topic_store is not None:
+            topic_lengths = self.topic_store.lengths[self.topic_rows]
+            content_lengths = self.content_store.lengths[self.content_rows]
+        else:
+            topic_lengths = token_lengths(self.cfg.tokenizer, self.topic_text, self.cfg.max_len)
+            content_lengths = token_lengths(self.cfg.tokenizer, self.content_text, self.cfg.max_len)
+        return np.minimum(topic_lengths, self.cfg.max_len) + np.minimum(content_lengths, self.cfg.max_len) - 1
         
     def __len__(self):
         return len(self.topic_text)
     
     def __getitem__(self, idx):
-        topic_text = self.topic_text[idx]
-        content_text = self.content_text[idx]
-        
-        topic_token = self._tokenize(topic_text)
-        content_token = self._tokenize(content_text)
-        
-        input_ids = topic_token['input_ids'] + content_token['input_ids'][1:]    # Discard the CLS token at the beginning of the content text
+        if self.topic_store is None:
+            topic_input_ids = self._tokenize(self.topic_text[idx])['input_ids']
+            content_input_ids = self._tokenize(self.content_text[idx])['input_ids']
+        elif self.cfg.stg2_packed_pairs:
+            topic_input_ids = self.topic_store.get(self.topic_rows[idx])[:self.cfg.max_len]
+            content_input_ids = self.content_store.get(self.content_rows[idx])[:self.cfg.max_len]
+        else:
+            topic_input_ids, _ = self.topic_store.padded(self.topic_rows[idx], self.cfg.max_len)
+            content_input_ids, _ = self.content_store.padded(self.content_rows[idx], self.cfg.max_len)
+        input_ids = np.concatenate([topic_input_ids, content_input_ids[1:]])    # Discard the CLS token at the beginning of the content text
         
         label = self.label[idx]
         
         return {
+            'idx': idx,
             'input_ids': input_ids,
             'label': label,
         }
@@ -668,32 +678,15 @@ class Collator(object):
         self.max_len = cfg.max_len * 2
         
     def __call__(self, batch):
-        input_ids = []
-        attention_mask = []
-        label = []
-        
-        for item in batch:
-            batch_input_ids = item['input_ids']
-            mask = [1] * len(batch_input_ids)
-            batch_label = item['label']
-            
-            if len(batch_input_ids) > self.max_len:
-                # Truncate
-                batch_input_ids = batch_input_ids[:self.max_len]
-                batch_attention_mask = mask[:self.max_len]
-            else:
-                # Padding
-                batch_input_ids = batch_input_ids + [self.cfg.tokenizer.pad_token_id] * (self.max_len - len(batch_input_ids))
-                batch_attention_mask = mask + [0] * (self.max_len - len(mask))
-            
-            input_ids.append(batch_input_ids)
-            attention_mask.append(batch_attention_mask)
-            label.append(batch_label)
+        # Truncate to max_len and pad to the longest pair of the batch
+        input_ids, attention_mask = pad_sequences([item['input_ids'] for item in batch], self.cfg.tokenizer.pad_token_id, 
+                                                  max_len = self.max_len)
         
         return {
-            'input_ids': torch.tensor(input_ids, dtype = torch.long),
-            'attention_mask': torch.tensor(attention_mask, dtype = torch.long),
-            'label': torch.tensor(label, dtype = torch.float),
+            'idx': torch.tensor([item['idx'] for item in batch], dtype = torch.long),
+            'input_ids': torch.from_numpy(input_ids),
+            'attention_mask': torch.from_numpy(attention_mask),
+            'label': torch.tensor([item['label'] for item in batch], dtype = torch.float),
         }
     
 class SecondStageModel(nn.Module):
@@ -731,19 +724,20 @@ class SecondStageModel(nn.Module):
         return loss, output, embedding
     
 class SecondStageTextEmbedding(object):
-    def __init__(self, cfg, df):
+    def __init__(self, cfg, df, topic_store = None, content_store = None):
         self.cfg = cfg
         self.df = df
+        self.topic_store = topic_store
+        self.content_store = content_store
     
     def _prepare_dataloader(self, mode = 'train'):
         print_log(self.cfg, 'Preparing the dataloader...')
-        dataset = SecondStageLECRDataset(cfg, self.df)
+        dataset = SecondStageLECRDataset(cfg, self.df, topic_store = self.topic_store, content_store = self.content_store)
         if mode == 'train':
             dataloader = DataLoader(dataset, batch_size = self.cfg.batch_size, num_workers = self.cfg.num_workers, 
                                     shuffle = True, collate_fn = Collator(cfg))
         else:
-            dataloader = DataLoader(dataset, batch_size = self.cfg.batch_size, num_workers = self.cfg.num_workers, 
-                                    shuffle = False, collate_fn = Collator(cfg))
+            dataloader = inference_dataloader(self.cfg, dataset, self.cfg.stg2_inference_max_tokens, collate_fn = Collator(cfg))
         return dataloader
     
     def _prepare_model(self):
@@ -855,26 +849,19 @@ class SecondStageTextEmbedding(object):
         model = model.to(self.cfg.device)
         model.eval()
         
-        embeddings = []
-        preds = []
-        
-        if self.cfg.use_tqdm:
-            tbar = tqdm(dataloader)
-        else:
-            tbar = dataloader
-
-        for i, item in enumerate(tbar):
-            item = {k: v.to(self.cfg.device) for k, v in item.items()}
-            
-            with torch.no_grad():
-                with autocast(enabled = self.cfg.apex):
-                    _, batch_preds, batch_embeddings = model(item['input_ids'], item['attention_mask'])
-                        
-            embeddings.append(batch_embeddings.cpu().numpy())
-            preds.append(batch_preds.cpu().numpy())
-            
-        embeddings = np.concatenate(embeddings)
-        preds = np.concatenate(preds)
+        def forward(item):
+            with autocast(enabled = self.cfg.apex):
+                _, batch_preds, batch_embeddings = model(item['input_ids'], item['attention_mask'])
+            return batch_embeddings, batch_preds
+        
+        # The outputs of every pair are written at its position in the dataframe, whatever the order of the batches
+        engine = InferenceEngine(self.cfg, forward)
+        embeddings, preds = engine.run(dataloader, len(self.df))
+        print_log(self.cfg, f'Inference timings: {engine.summary()}')
+        unique_texts = dataloader.dataset.unique_texts
+        if unique_texts is not None:
+            unique_texts.fill_duplicates(embeddings)
+            unique_texts.fill_duplicates(preds)
         return embeddings, preds
 
 def negative_sampling(data):
@@ -885,7 +872,8 @@ def negative_sampling(data):
     return data.loc[chosen_idx].sample(frac = 1.)
 
 sampled_data = negative_sampling(data)
-SecondStageTextEmbedding(cfg, sampled_data).train(return_embedding = False)
+SecondStageTextEmbedding(cfg, sampled_data, topic_store = topic_token_store, 
+                         content_store = content_token_store).train(return_embedding = False)
 
 """# XGBoost"""
 
@@ -922,7 +910,8 @@ class TabularModel(object):
         return self.data.loc[chosen_idx].sample(frac = 1.)
         
     def _prepare_data(self, data):
-        embeddings, stg2_preds = SecondStageTextEmbedding(self.cfg, data).infer_embedding()
+        embeddings, stg2_preds = SecondStageTextEmbedding(self.cfg, data, topic_store = topic_token_store, 
+                                                          content_store = content_token_store).infer_embedding()
         
         if self.features is not None:
             embeddings = np.hstack([embeddings, stg2_preds.reshape(-1, 1), data[self.features].values])
@@ -1008,7 +997,7 @@ model_params = {
 }
 
 features = ['distance', 'encoded_language_t', 'encoded_language_c']
-ground_truth = pd.read_csv(os.path.join(cfg.comp_data_dir, 'correlations.csv'))
+ground_truth = ground_truth_df
 
 for seed in [1, 11, 111, 1111, 11111, 2, 22, 222, 2222, 22222]:
     cfg.seed = seed
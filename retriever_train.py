@@ -20,7 +20,6 @@ from sklearn.preprocessing import LabelEncoder
 from sklearn.metrics import accuracy_score, f1_score
 from sklearn.model_selection import StratifiedGroupKFold, GroupKFold
 from scipy.spatial.distance import cdist
-from sklearn.neighbors import NearestNeighbors
 
 import torch
 from torch import nn
@@ -33,6 +32,15 @@ import transformers
 from transformers import AutoTokenizer, AutoConfig, AutoModel
 from transformers import get_cosine_schedule_with_warmup, get_linear_schedule_with_warmup, AdamW
 
+from topic_tree import TopicTree
+from topic_content_index import TopicContentIndex
+from preprocessing import load_processed_data
+from token_store import TokenStore
+from embedding_inference import inference_model, inference_autocast, InferenceEngine
+from batching import token_lengths, inference_dataloader, UniqueTexts, ShuffledTokenBudgetBatchSampler
+from search_index import project_embeddings, candidate_search
+from candidates import CandidateSet
+
 import warnings
 warnings.filterwarnings('ignore')
 
@@ -66,17 +74,43 @@ class Config(object):
     sep_token_id = tokenizer.vocab_size + 1
     special_tokens_dict = {'additional_special_tokens': [sep_token]}
     tokenizer.add_special_tokens(special_tokens_dict)
+    # Input text, the fields are joined in this order
+    topic_fields = ['language', 'title', 'description']
+    topic_field_separator = sep_token
+    content_fields = ['language', 'title', 'description', 'text', 'kind']
+    content_field_separator = sep_token
+    text_chunk_size = 20000    # Rows joined at once, bounds the memory taken by the temporary strings
     # Data
     done_kfold_split = False
+    kfold_method = 'group'    # 'group', 'stratified_group'
+    breadcrumb_jobs = 1    # Number of processes building the topic breadcrumbs
+    use_processed_cache = True    # Reuse the processed data cached by a previous run (of either script)
     processed_data = True
     nfolds = 5
     negative_sample = 5
     # Dataloader
     max_len = 32
+    # content.csv is read by chunks and its fields are clipped to a character budget (None keeps everything),
+    # only the first max_len tokens of the input text are used anyway
+    content_chunksize = 20000    # None to read the whole file at once
+    content_char_budget = {'title': 16 * max_len, 'description': 16 * max_len, 'text': 16 * max_len}
+    use_token_store = True    # Tokenize the topics and content once, the datasets read the token ids from disk
     batch_size = 32 if not debug else 4
+    # Inference sorts the texts by token length and fills each batch up to this many padded tokens (None keeps
+    # batches of batch_size in the dataframe order)
+    inference_max_tokens = batch_size * max_len
+    # On CPU, the encoder infers the embeddings in float32 (None), with its linear layers dynamically quantized to
+    # int8 ('int8') or with bfloat16 autocast ('bf16'), see `python benchmarks.py cpu_inference` for the trade-off
+    cpu_inference = None
+    dedup_texts = True    # Encode the identical input texts only once at inference
     num_workers = os.cpu_count()
     # For training
     training_folds = [0, 1, 2, 3, 4]
+    # The topic/content pairs are shuffled, grouped by length within buckets of train_bucket_size pairs and
+    # packed into batches of at most train_max_tokens padded tokens (None keeps shuffled batches of batch_size)
+    train_max_tokens = 2 * batch_size * max_len
+    train_bucket_size = 100 * batch_size
+    train_max_batch_size = 4 * batch_size
     apex = False
     gradient_checkpointing = True
     nepochs = 10
@@ -88,6 +122,15 @@ class Config(object):
         'cosine': None,
         'num_k': 50,
     }
+    search_dim = None    # The embeddings are projected to this many dimensions (e.g. 128, 256) for the kNN search
+    language_partitioned_search = False    # The candidates of a topic are only searched among the content of its language
+    search_extra_languages = {}    # and of these other languages, e.g. {'mul': ['en']}
+    search_nlist = None    # Approximate kNN search with an IVF index of this many k-means lists (e.g. 1024)
+    search_nprobe = 16    # probing the lists of this many nearest centroids of every topic
+    search_pq_subspaces = None    # Approximate kNN search over the content product-quantized to this many bytes (e.g. 96)
+    search_pq_rerank = 4    # and exact re-rank of the num_k * search_pq_rerank nearest codes (0 to skip it)
+    search_int8 = False    # kNN search over the content quantized to int8
+    search_int8_rerank = 4    # re-scoring the num_k * search_int8_rerank best candidates in float32
     # For AWP
     use_awp = True
     if use_awp:
@@ -116,15 +159,21 @@ class Config(object):
         comp_data_dir = f'/content/drive/My Drive/Kaggle competitions/{competition_name}/comp_data'
         ext_data_dir = f'/content/drive/My Drive/Kaggle competitions/{competition_name}/ext_data'
         model_dir = f'/content/drive/My Drive/Kaggle competitions/{competition_name}/model'
+        processed_data_dir = f'{ext_data_dir}/processed'
+        token_store_dir = f'{ext_data_dir}/tokens'
         os.makedirs(os.path.join(model_dir, ver[:-1], ver[-1]), exist_ok = True)
     elif env == 'kaggle':
         comp_data_dir = ...
         ext_data_dir = ...
         model_dir = ...
+        processed_data_dir = ...
+        token_store_dir = ...
     elif env == 'vastai':
         comp_data_dir = 'data'
         ext_data_dir = 'ext_data'
         model_dir = f'model'
+        processed_data_dir = f'{ext_data_dir}/processed'
+        token_store_dir = f'{ext_data_dir}/tokens'
         os.makedirs(os.path.join(model_dir, ver[:-1], ver[-1]), exist_ok = True)
 
 cfg = Config()
@@ -183,56 +232,26 @@ def print_log(cfg, message):
     else:
         print(message)
 
-"""# Explore the data"""
+"""# Prepare the data
 
-content_df = pd.read_csv(os.path.join(cfg.comp_data_dir, 'content.csv'))
-topics_df = pd.read_csv(os.path.join(cfg.comp_data_dir, 'topics.csv'))
-correlations_df = pd.read_csv(os.path.join(cfg.comp_data_dir, 'correlations.csv'))
+* Load the processed topics/content/correlations, they are only recomputed from the CSV files when the cache misses
+"""
 
-all_languages = sorted(list(set(topics_df['language'].tolist() + content_df['language'].tolist())))
-cfg.languages_map = dict(zip(all_languages, range(len(all_languages))))
+topics_df, content_df, correlations_df = load_processed_data(cfg)
+topic2fold_split = topics_df[['id', 'fold']].set_index('id').to_dict()['fold']
+ground_truth_df = correlations_df[['topic_id', 'content_ids']].copy()
 
-if not cfg.done_kfold_split:
-    kf = GroupKFold(n_splits = cfg.nfolds)
-    folds = list(kf.split(topics_df, groups = topics_df['channel']))
-    topics_df['fold'] = -1
+topic_tree = TopicTree.from_df(topics_df)
+topic_content_index = TopicContentIndex.from_correlations(correlations_df, topic_ids = topics_df['id'].values, 
+                                                          content_ids = content_df['id'].values)
 
-    for fold, (train_idx, val_idx) in enumerate(folds):
-        topics_df.loc[val_idx, 'fold'] = fold
-    topic2fold_split = topics_df[['id', 'fold']].set_index('id').to_dict()['fold']
+"""* Pre-tokenize the input texts, the token stores are only rebuilt when the texts or the tokenizer change"""
 
-    with open(os.path.join(cfg.ext_data_dir, f'topic2fold_{cfg.nfolds}split_stratifiedkfold.pkl'), 'wb') as f:
-        pickle.dump(topic2fold_split, f)
+if cfg.use_token_store:
+    topic_token_store = TokenStore.load_or_build(cfg, 'topics', topics_df['id'].values, topics_df['input_text'].values)
+    content_token_store = TokenStore.load_or_build(cfg, 'content', content_df['id'].values, content_df['input_text'].values)
 else:
-    with open(os.path.join(cfg.ext_data_dir, f'topic2fold_{cfg.nfolds}split_stratifiedkfold.pkl'), 'rb') as f:
-        topic2fold_split = pickle.load(f)
-
-correlations_df = pd.read_csv(os.path.join(cfg.comp_data_dir, 'correlations.csv'))
-topics_df['fold'] = topics_df['id'].map(topic2fold_split)
-correlations_df['fold'] = correlations_df['topic_id'].map(topic2fold_split)
-content_df['fold'] = -1
-
-for fold in range(cfg.nfolds):
-    content_in_fold = set(correlations_df.loc[correlations_df['fold'] == fold, 'content_ids'].str.split().explode().tolist())
-    content_not_in_fold = set(correlations_df.loc[correlations_df['fold'] != fold, 'content_ids'].str.split().explode().tolist())
-    only_content_in_fold = content_in_fold - content_not_in_fold
-    content_df.loc[content_df['id'].isin(only_content_in_fold), 'fold'] = fold
-
-"""# Prepare the data"""
-
-def process_data(cfg, df, is_content = False):
-    # Fill NaN values in the title and description columns
-    df['title'] = df['title'].fillna(' ')
-    df['description'] = df['description'].fillna(' ')
-    if is_content:
-        df['text'] = df['text'].fillna(' ')
-
-    # Encode the language
-    df['encoded_language'] = df['language'].map(cfg.languages_map)
-    return df
-
-topics_df = process_data(cfg, topics_df)
-content_df = process_data(cfg, content_df, is_content = True)
+    topic_token_store = content_token_store = None
 
 """# Helper functions from the host"""
 
@@ -242,32 +261,25 @@ class Topic:
 
     @property
     def parent(self):
-        parent_id = topics_df.loc[self.id].parent
-        if pd.isna(parent_id):
+        parent_idx = topic_tree.parent(topic_tree.index(self.id))
+        if parent_idx < 0:
             return None
         else:
-            return Topic(parent_id)
+            return Topic(topic_tree.ids[parent_idx])
 
     @property
     def ancestors(self):
-        ancestors = []
-        parent = self.parent
-        while parent is not None:
-            ancestors.append(parent)
-            parent = parent.parent
-        return ancestors
+        return [Topic(topic_id) for topic_id in topic_tree.ids[topic_tree.ancestors(topic_tree.index(self.id))]]
 
     @property
     def siblings(self):
-        if not self.parent:
-            return []
-        else:
-            return [topic for topic in self.parent.children if topic != self]
+        return [Topic(topic_id) for topic_id in topic_tree.ids[topic_tree.siblings(topic_tree.index(self.id))]]
 
     @property
     def content(self):
-        if self.id in correlations_df.index:
-            return [ContentItem(content_id) for content_id in correlations_df.loc[self.id].content_ids.split()]
+        content_ids = topic_content_index.content_ids_of(self.id)
+        if len(content_ids) > 0:
+            return [ContentItem(content_id) for content_id in content_ids]
         else:
             return tuple([]) if self.has_content else []
 
@@ -287,7 +299,11 @@ class Topic:
 
     @property
     def children(self):
-        return [Topic(child_id) for child_id in topics_df[topics_df.parent == self.id].index]
+        return [Topic(child_id) for child_id in topic_tree.ids[topic_tree.children(topic_tree.index(self.id))]]
+
+    @property
+    def subtree(self):
+        return [Topic(topic_id) for topic_id in topic_tree.ids[topic_tree.subtree(topic_tree.index(self.id))]]
 
     def subtree_markdown(self, depth=0):
         markdown = "  " * depth + "- " + self.title + "\n"
@@ -303,7 +319,8 @@ class Topic:
         return self.id == other.id
 
     def __getattr__(self, name):
-        return topics_df.loc[self.id][name]
+        # Rows of topics_df are in the same order as the topic tree
+        return topics_df[name].iat[topic_tree.index(self.id)]
 
     def __str__(self):
         return self.title
@@ -318,10 +335,11 @@ class ContentItem:
 
     @property
     def topics(self):
-        return [Topic(topic_id) for topic_id in topics_df.loc[correlations_df[correlations_df.content_ids.str.contains(self.id)].index].index]
+        return [Topic(topic_id) for topic_id in topic_content_index.topic_ids_of(self.id)]
 
     def __getattr__(self, name):
-        return content_df.loc[self.id][name]
+        # Rows of content_df are in the same order as the incidence index
+        return content_df[name].iat[topic_content_index.content_index(self.id)]
 
     def __str__(self):
         return self.title
@@ -345,44 +363,22 @@ class ContentItem:
             breadcrumbs.append(new_breadcrumb)
         return breadcrumbs
 
-"""# Process the topics_df data"""
-
-topics_df = topics_df.set_index('id')
-content_df = content_df.set_index('id')
-correlations_df = correlations_df.set_index('topic_id')
-
-topics_df['input_text'] = topics_df.apply(lambda x: cfg.sep_token.join([x['language'],
-                                                                        x['title'],
-                                                                        x['description']]), axis = 1)
-
-content_df['input_text'] = content_df.apply(lambda x: cfg.sep_token.join([x['language'],
-                                                                          x['title'],
-                                                                          x['description'],
-                                                                          x['text'],
-                                                                          x['kind']]), axis = 1)
-
-topics_df['text'] = topics_df['input_text'].values
-
-for topic_id in tqdm(topics_df.index):
-    topics_df.loc[topic_id, 'text'] = Topic(topic_id).get_breadcrumbs(separator = cfg.tokenizer.sep_token)
-    
-topics_df = topics_df.drop('input_text', axis = 1).rename(columns = {'text': 'input_text'})
-    
-topics_df = topics_df.reset_index()
-content_df = content_df.reset_index()
-correlations_df = correlations_df.reset_index()
-
 topics_df = topics_df.drop(['title', 'description'], axis = 1)
 content_df = content_df.drop(['title', 'description', 'text', 'kind'], axis = 1)
 
 """# Plain k-NN"""
 
 class LECR_ComponentDataset(Dataset):
-    def __init__(self, cfg, df):
+    def __init__(self, cfg, df, token_store = None):
         self.cfg = cfg
         self.input_text = df['input_text'].tolist()
         self.ids = df['id'].tolist()
         self.language = df['encoded_language'].tolist()
+        self.unique_texts = UniqueTexts(self.input_text) if cfg.dedup_texts else None
+        # Rows of the pre-tokenized texts, if any
+        self.token_store = token_store
+        if token_store is not None:
+            self.token_rows = token_store.indices(df['id'].values)
 
     def _tokenize(self, text):
         token = self.cfg.tokenizer(text,
@@ -392,6 +388,11 @@ class LECR_ComponentDataset(Dataset):
                                    return_attention_mask = True)
         return token
 
+    def token_lengths(self):
+        if self.token_store is not None:
+            return np.minimum(self.token_store.lengths[self.token_rows], self.cfg.max_len)
+        return token_lengths(self.cfg.tokenizer, self.input_text, self.cfg.max_len)
+
     def __len__(self):
         return len(self.input_text)
 
@@ -400,29 +401,35 @@ class LECR_ComponentDataset(Dataset):
         input_text = self.input_text[idx]
         language = self.language[idx]
         
-        content_token = self._tokenize(input_text)
+        if self.token_store is not None:
+            input_ids, attention_mask = self.token_store.padded(self.token_rows[idx], self.cfg.max_len)
+        else:
+            content_token = self._tokenize(input_text)
+            input_ids, attention_mask = content_token['input_ids'], content_token['attention_mask']
         
         return {
+            'idx': idx,
             'ids': ids,
-            'input_ids': torch.tensor(content_token['input_ids'], dtype = torch.long),
-            'attention_mask': torch.tensor(content_token['attention_mask'], dtype = torch.long),
+            'input_ids': torch.tensor(input_ids, dtype = torch.long),
+            'attention_mask': torch.tensor(attention_mask, dtype = torch.long),
             'language': torch.tensor(language, dtype = torch.long),
         }
 
 class TextEmbedding(object):
-    def __init__(self, cfg, df):
+    def __init__(self, cfg, df, token_store = None):
         self.cfg = cfg
         self.df = df
+        self.token_store = token_store
         
     def _prepare_materials(self):
         print_log(self.cfg, 'Preparing the dataloader...')
-        dataset = LECR_ComponentDataset(cfg, self.df)
-        dataloader = DataLoader(dataset, batch_size = cfg.batch_size, num_workers = cfg.num_workers, shuffle = False)
+        dataset = LECR_ComponentDataset(cfg, self.df, token_store = self.token_store)
+        dataloader = inference_dataloader(self.cfg, dataset, self.cfg.inference_max_tokens)
         
         print_log(self.cfg, 'Preparing the encoding model...')
         model = AutoModel.from_pretrained(self.cfg.backbone).to(self.cfg.device)
         model.resize_token_embeddings(len(self.cfg.tokenizer))
-        return model, dataloader
+        return inference_model(self.cfg, model), dataloader
     
     def _pooler(self, x, mask = None):
         if mask is not None:
@@ -433,36 +440,23 @@ class TextEmbedding(object):
     
     def _embedding(self, model, dataloader):
         model.eval()
-    
-        ids = []
-        embeddings = []
-        languages = []
         
-        if self.cfg.use_tqdm:
-            tbar = tqdm(dataloader)
-        else:
-            tbar = dataloader
-
-        for i, item in enumerate(tbar):
-            batch_ids = item['ids']
-            input_ids = item['input_ids'].to(self.cfg.device)
-            attention_mask = item['attention_mask'].to(self.cfg.device)
-            batch_languages = item['language']
-            
-            with torch.no_grad():
-                with autocast(enabled = self.cfg.apex):
-                    local_len = max(attention_mask.sum(axis = 1))
-                    batch_embedding = model(input_ids[:,:local_len], attention_mask[:,:local_len]).last_hidden_state
-                    batch_embedding = self._pooler(batch_embedding, mask = attention_mask[:,:local_len])
-                        
-            ids.append(batch_ids)
-            embeddings.append(batch_embedding.cpu().numpy())
-            languages.append(batch_languages.numpy())
-
-        ids = np.concatenate(ids)
-        embeddings = np.concatenate(embeddings)
-        languages = np.concatenate(languages)
-        return ids, embeddings, languages
+        def forward(item):
+            input_ids, attention_mask = item['input_ids'], item['attention_mask']
+            with inference_autocast(self.cfg):
+                local_len = max(attention_mask.sum(axis = 1))
+                batch_embedding = model(input_ids[:,:local_len], attention_mask[:,:local_len]).last_hidden_state
+                batch_embedding = self._pooler(batch_embedding, mask = attention_mask[:,:local_len])
+            return batch_embedding.float()
+        
+        # The embedding of every text is written at its position in the dataframe, whatever the order of the batches
+        dataset = dataloader.dataset
+        engine = InferenceEngine(self.cfg, forward)
+        embeddings = engine.run(dataloader, len(dataset))
+        print_log(self.cfg, f'Inference timings: {engine.summary()}')
+        if dataset.unique_texts is not None:
+            dataset.unique_texts.fill_duplicates(embeddings)
+        return np.array(dataset.ids), embeddings, np.array(dataset.language)
 
     def fit(self):
         model, dataloader = self._prepare_materials()
@@ -520,7 +514,7 @@ data
 """# Design the dataloader"""
 
 class LECRDataset(Dataset):
-    def __init__(self, cfg, df, topic_data, content_data):
+    def __init__(self, cfg, df, topic_data, content_data, topic_store = None, content_store = None):
         self.cfg = cfg
         self.topic_id = df['topic_id'].tolist()
         self.content_id = df['content_ids'].tolist()
@@ -529,6 +523,12 @@ class LECRDataset(Dataset):
         self.label = df['label'].tolist()
         self.topic_data = topic_data
         self.content_data = content_data
+        # Rows of the pre-tokenized texts, if any
+        self.topic_store = topic_store
+        self.content_store = content_store
+        if topic_store is not None:
+            self.topic_rows = topic_store.indices(df['topic_id'].values)
+            self.content_rows = content_store.indices(df['content_ids'].values)
         
     def _tokenize(self, text):
         token = self.cfg.tokenizer(text,
@@ -538,6 +538,18 @@ class LECRDataset(Dataset):
                                    return_attention_mask = True)
         return token
 
+    def token_lengths(self):
+        '''Number of tokens of the topic and of the content of each pair'''
+        if self.topic_store is not None:
+            lengths = [self.topic_store.lengths[self.topic_rows], self.content_store.lengths[self.content_rows]]
+        else:
+            # Every topic/content item is tokenized once, however many pairs it appears in
+            lengths = []
+            for ids, texts in [(self.topic_id, self.topic_data), (self.content_id, self.content_data)]:
+                codes, uniques = pd.factorize(pd.Series(ids, dtype = object))
+                lengths.append(token_lengths(self.cfg.tokenizer, [texts[i] for i in uniques], self.cfg.max_len)[codes])
+        return np.minimum(np.stack(lengths, axis = 1), self.cfg.max_len)
+
     def __len__(self):
         return len(self.topic_id)
 
@@ -548,18 +560,24 @@ class LECRDataset(Dataset):
         content_class = self.content_class[idx]
         label = self.label[idx]
         
-        topic_input_text = self.topic_data[topic_id]
-        content_input_text = self.content_data[content_id]
+        if self.topic_store is not None:
+            topic_input_ids, topic_attention_mask = self.topic_store.padded(self.topic_rows[idx], self.cfg.max_len)
+            content_input_ids, content_attention_mask = self.content_store.padded(self.content_rows[idx], self.cfg.max_len)
+        else:
+            topic_input_text = self.topic_data[topic_id]
+            content_input_text = self.content_data[content_id]
 
-        topic_token = self._tokenize(topic_input_text)
-        content_token = self._tokenize(content_input_text)
+            topic_token = self._tokenize(topic_input_text)
+            content_token = self._tokenize(content_input_text)
+            topic_input_ids, topic_attention_mask = topic_token['input_ids'], topic_token['attention_mask']
+            content_input_ids, content_attention_mask = content_token['input_ids'], content_token['attention_mask']
         
         return {
-            'topic_input_ids': torch.tensor(topic_token['input_ids'], dtype = torch.long),
-            'topic_attention_mask': torch.tensor(topic_token['attention_mask'], dtype = torch.long),
+            'topic_input_ids': torch.tensor(topic_input_ids, dtype = torch.long),
+            'topic_attention_mask': torch.tensor(topic_attention_mask, dtype = torch.long),
             
-            'content_input_ids': torch.tensor(content_token['input_ids'], dtype = torch.long),
-            'content_attention_mask': torch.tensor(content_token['attention_mask'], dtype = torch.long),
+            'content_input_ids': torch.tensor(content_input_ids, dtype = torch.long),
+            'content_attention_mask': torch.tensor(content_attention_mask, dtype = torch.long),
             
             'topic_class': torch.tensor(topic_class, dtype = torch.long),
             'content_class': torch.tensor(content_class, dtype = torch.long),
@@ -743,9 +761,10 @@ class LECRModel(nn.Module):
             ls_eps = 1e-6
         )
         
-    def _feature_generator(self, input_ids, attention_mask):
+    def _feature_generator(self, input_ids, attention_mask, backbone = None):
+        backbone = self.backbone if backbone is None else backbone
         local_len = max(attention_mask.sum(axis = 1))
-        output_backbone = self.backbone(input_ids[:,:local_len], attention_mask = attention_mask[:,:local_len])
+        output_backbone = backbone(input_ids[:,:local_len], attention_mask = attention_mask[:,:local_len])
         embedding = self.pooler(output_backbone.last_hidden_state, mask = attention_mask[:,:local_len])
         return embedding
     
@@ -983,34 +1002,22 @@ def train_fn(cfg, model, train_dataloader, optimizer, epoch, num_train_steps, sc
 
 def infer_embedding_fn(cfg, model, dataloader):
     model.eval()
+    # A quantized copy of the backbone in the 'int8' CPU mode, the trained backbone is left untouched
+    backbone = inference_model(cfg, model.backbone)
     
-    ids = []
-    embeddings = []
-    languages = []
+    def forward(item):
+        with inference_autocast(cfg):
+            batch_embedding = model._feature_generator(item['input_ids'], item['attention_mask'], backbone = backbone)
+        return batch_embedding.float()
     
-    if cfg.use_tqdm:
-        tbar = tqdm(dataloader)
-    else:
-        tbar = dataloader
-
-    for i, item in enumerate(tbar):
-        batch_ids = item['ids']
-        input_ids = item['input_ids'].to(cfg.device)
-        attention_mask = item['attention_mask'].to(cfg.device)
-        batch_languages = item['language']
-
-        with torch.no_grad():
-            with autocast(enabled = cfg.apex):
-                batch_embedding = model._feature_generator(input_ids, attention_mask)
-
-        ids.append(batch_ids)
-        embeddings.append(batch_embedding.detach().cpu())
-        languages.append(batch_languages)
-
-    ids = np.concatenate(ids)
-    embeddings = torch.concat(embeddings)
-    languages = torch.concat(languages)
-    return ids, embeddings, languages
+    dataset = dataloader.dataset
+    engine = InferenceEngine(cfg, forward)
+    embeddings = engine.run(dataloader, len(dataset))
+    print_log(cfg, f'Inference timings: {engine.summary()}')
+    if dataset.unique_texts is not None:
+        # Only the first occurrence of each distinct text was encoded
+        dataset.unique_texts.fill_duplicates(embeddings)
+    return np.array(dataset.ids), torch.from_numpy(embeddings), torch.tensor(dataset.language, dtype = torch.long)
 
 def valid_fn(cfg, model, valid_dataloaders, ground_truth = None, fold = None):
     # Set up for training
@@ -1026,52 +1033,43 @@ def valid_fn(cfg, model, valid_dataloaders, ground_truth = None, fold = None):
     print_log(cfg, 'Extracting content embeddings...')
     content_ids, content_embeddings, content_languages = infer_embedding_fn(cfg, model, valid_content_dataloader)
     
-    neighbors_model = NearestNeighbors(n_neighbors = cfg.thres['num_k'], metric = 'cosine')
-    neighbors_model.fit(content_embeddings.numpy())
-    
-    dist, indices = neighbors_model.kneighbors(topic_embeddings.numpy(), return_distance = True)
-    
-    oof_dict_ids = {}
-    oof_dict_ids_top10 = {}
-    oof_dict_distance = {}
-
-    for i, (topic_lang, topic_id) in enumerate(zip(topic_languages, topic_ids)):
-        chosen_contents = content_ids[indices[i]]
-        chosen_contents_top10 = content_ids[indices[i][:10]]
-
-        oof_dict_ids[topic_id] = ' '.join(chosen_contents.tolist())
-        oof_dict_ids_top10[topic_id] = ' '.join(chosen_contents_top10.tolist())
-        oof_dict_distance[topic_id] = dist[i].tolist()
+    search_topic_embeddings, search_content_embeddings = project_embeddings(cfg, topic_embeddings.numpy(), 
+                                                                            content_embeddings.numpy())
+    dist, indices = candidate_search(cfg, search_topic_embeddings, topic_languages.numpy(), 
+                                     search_content_embeddings, content_languages.numpy())
+    # Fewer than num_k content items may be in the languages of a topic, the padding is dropped
+    candidates = CandidateSet.from_search(topic_ids, content_ids, dist, indices)
+    candidates_top10 = candidates.top(10)
         
     if ground_truth is not None:
         oof = pd.DataFrame({
-            'topic_id': list(oof_dict_ids.keys()),
-            'pred_content_ids': list(oof_dict_ids.values()),
-            'pred_content_ids_top10': list(oof_dict_ids_top10.values()),
-            'pred_distance': list(oof_dict_distance.values()),
+            'topic_id': topic_ids,
+            'pred_content_ids': candidates.to_strings(),
+            'pred_content_ids_top10': candidates_top10.to_strings(),
+            'pred_distance': candidates.to_lists(),
         })
         oof = oof.merge(ground_truth[['topic_id', 'content_ids']], on = 'topic_id', how = 'left')
         oof = oof.merge(topics_df[['id', 'fold']], left_on = 'topic_id', right_on = 'id', how = 'left').drop('id', axis = 1)
 
         if fold is not None:
-            score, recall = metric_fn(oof['pred_content_ids'], oof['content_ids'])
-            score_top10, recall_top10 = metric_fn(oof['pred_content_ids_top10'], oof['content_ids'])
+            score, recall = candidates.metrics(topic_content_index)
+            score_top10, recall_top10 = candidates_top10.metrics(topic_content_index)
             print_log(cfg, f'Fold {fold} score/recall/score-top10/recall-top10: {score}/{recall}/{score_top10}/{recall_top10}')
         else:
             for fold in range(cfg.nfolds):
-                fold_score, fold_recall = metric_fn(oof.loc[oof.fold == fold, 'pred_content_ids'], 
-                                                    oof.loc[oof.fold == fold, 'content_ids'])
-                fold_score_top10, fold_recall_top10 = metric_fn(oof.loc[oof.fold == fold, 'pred_content_ids_top10'], 
-                                                                oof.loc[oof.fold == fold, 'content_ids'])
+                fold_topics = np.flatnonzero(oof.fold.values == fold)
+                fold_score, fold_recall = candidates.metrics(topic_content_index, topics = fold_topics)
+                fold_score_top10, fold_recall_top10 = candidates_top10.metrics(topic_content_index, topics = fold_topics)
                 print_log(cfg, f'Fold {fold}: {fold_score}/{fold_recall}/{fold_score_top10}/{fold_recall_top10}')
 
-            score, recall = metric_fn(oof['pred_content_ids'], oof['content_ids'])
-            score_top10, recall_top10 = metric_fn(oof['pred_content_ids_top10'], oof['content_ids'])
+            score, recall = candidates.metrics(topic_content_index)
+            score_top10, recall_top10 = candidates_top10.metrics(topic_content_index)
             print_log(cfg, f'Fold {fold} score/recall/score-top10/recall-top10: {score}/{recall}/{score_top10}/{recall_top10}')
 
         return oof, score, recall, score_top10, recall_top10
     else:
-        return oof_dict_ids, oof_dict_ids_top10, oof_dict_distance
+        return dict(zip(topic_ids, candidates.to_strings())), dict(zip(topic_ids, candidates_top10.to_strings())), \
+               dict(zip(topic_ids, candidates.to_lists()))
 
 """* Preparing the optimizer and scheduler"""
 
@@ -1104,28 +1102,42 @@ def get_scheduler(cfg, optimizer, num_train_steps):
 
 def training_loop(cfg):
     print_log(cfg, 'Preparing the training and validation dataloaders...')
-    dataset = LECRDataset(cfg, data, topic_data, content_data)
-    dataloader = DataLoader(dataset, batch_size = cfg.batch_size, num_workers = cfg.num_workers, shuffle = True)
+    dataset = LECRDataset(cfg, data, topic_data, content_data, 
+                          topic_store = topic_token_store, content_store = content_token_store)
+    if cfg.train_max_tokens is not None:
+        batch_sampler = ShuffledTokenBudgetBatchSampler(dataset.token_lengths(), cfg.train_max_tokens, cfg.train_bucket_size,
+                                                        max_batch_size = cfg.train_max_batch_size, seed = cfg.seed)
+        dataloader = DataLoader(dataset, batch_sampler = batch_sampler, num_workers = cfg.num_workers)
+    else:
+        batch_sampler = None
+        dataloader = DataLoader(dataset, batch_size = cfg.batch_size, num_workers = cfg.num_workers, shuffle = True)
     
-    valid_correlations_df = pd.read_csv(os.path.join(cfg.comp_data_dir, 'correlations.csv'))
+    valid_correlations_df = ground_truth_df
     
     valid_topic_dataset = LECR_ComponentDataset(cfg, topics_df.loc[(topics_df['category'] != 'source') & 
-                                                                    topics_df.has_content])
-    valid_content_dataset = LECR_ComponentDataset(cfg, content_df)
+                                                                    topics_df.has_content], 
+                                                token_store = topic_token_store)
+    valid_content_dataset = LECR_ComponentDataset(cfg, content_df, token_store = content_token_store)
     
-    valid_topics_dataloader = DataLoader(valid_topic_dataset, batch_size = cfg.batch_size, num_workers = cfg.num_workers, shuffle = False)
-    valid_content_dataloader = DataLoader(valid_content_dataset, batch_size = cfg.batch_size, num_workers = cfg.num_workers, shuffle = False)
+    valid_topics_dataloader = inference_dataloader(cfg, valid_topic_dataset, cfg.inference_max_tokens)
+    valid_content_dataloader = inference_dataloader(cfg, valid_content_dataset, cfg.inference_max_tokens)
     valid_dataloaders = (valid_topics_dataloader, valid_content_dataloader)
 
     print_log(cfg, 'Preparing the model, optimizer, and scheduler...')
     model = LECRModel(cfg).to(cfg.device)
     optimizer = get_optimizer(cfg, model)
-    num_training_steps = len(dataloader) * cfg.nepochs
+    if batch_sampler is not None:
+        # The number of batches varies from one epoch to the next
+        num_training_steps = sum(batch_sampler.num_batches(epoch) for epoch in range(cfg.nepochs))
+    else:
+        num_training_steps = len(dataloader) * cfg.nepochs
     scheduler = get_scheduler(cfg, optimizer, num_training_steps)
 
     best_score = -np.inf
     for epoch in range(cfg.nepochs):
         start_time = time.time()
+        if batch_sampler is not None:
+            batch_sampler.set_epoch(epoch)
         # Train
         best_score, oof = train_fn(cfg, model, dataloader, optimizer, epoch, num_training_steps, scheduler, 
                                    valid_dataloaders, valid_correlations_df, best_score = best_score)
@@ -0,0 +1,635 @@
+# -*- coding: utf-8 -*-
+"""Nearest-neighbour search of the topic embeddings among the content embeddings
+
+`exact_search` finds the exact top-k cosine neighbours: the corpus is normalized once, the queries
+are scored in blocks of bounded memory by one matrix product each and only the k best scores of
+a block are selected (then sorted), on a thread pool on CPU or with `torch.topk` on GPU. On CPU,
+it returns the same neighbours and distances as `NearestNeighbors(metric = 'cosine')`.
+
+`LanguagePartitionedIndex` groups the content by language, so that each topic is only searched among
+the content of its own language (and of the extra languages allowed for it). `IVFIndex` is an
+approximate inverted-file index: the content is clustered by k-means into `nlist` lists and a query
+is only compared with the content of its `nprobe` nearest lists. `candidate_search` is the search of
+the candidates of the scripts, partitioned when `cfg.language_partitioned_search` is set and
+approximate when `cfg.search_nlist` is.
+
+`PQIndex` compresses the content by product quantization: each embedding is stored as one byte per
+subspace, 96 bytes instead of 3KB for 96 subspaces of a 768-dimension model. The queries are compared
+with the quantized content (asymmetric distances) and the short list can be re-ranked exactly from
+the original embeddings, memory-mapped so only its rows are read. `Int8Index` sits in between: the
+content is quantized to int8 with a scale per dimension, searched exhaustively by int8 matrix products
+and the `k * rerank` best candidates are re-scored in float32.
+
+Every index and the projection have a `state`, the arrays they are rebuilt from by `from_state`, which
+`index_store.SearchIndexStore` saves and memory-maps back.
+
+`PCAProjection` reduces the embeddings to `cfg.search_dim` dimensions before they are indexed. It
+is fitted on the content embeddings and, by default, keeps the main components of the uncentered
+embeddings: the mean direction they share carries much of their cosine similarities, centering
+them first loses more neighbours. `projection_report` measures what a projection costs: the recall
+of the full-dimension neighbours, the memory of the index and the query latency.
+"""
+
+import os, time, tempfile, warnings
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from threadpoolctl import threadpool_limits
+
+def normalize(x):
+    '''Rows of `x` scaled to a unit norm, as float32 (the null rows are left as they are)'''
+    x = np.asarray(x, dtype = np.float32)
+    # Computed as scikit-learn does, so the distances are the same to the last bit
+    norms = np.sqrt(np.einsum('ij,ij->i', x, x))
+    norms[norms == 0] = 1
+    return x / norms[:, None]
+
+def _distances(queries, corpus):
+    # Cosine distances of normalized vectors, computed as in `exact_search`
+    block = queries @ corpus.T
+    block *= -1
+    block += 1
+    return np.clip(block, 0, 2, out = block)
+
+def _select(distances, k):
+    # The k smallest distances of every row, in increasing order, selected as `NearestNeighbors` does (same ties)
+    top = np.argpartition(distances, k - 1, axis = 1)[:, :k]
+    top_distances = np.take_along_axis(distances, top, axis = 1)
+    order = np.argsort(top_distances, axis = 1)
+    return np.take_along_axis(top_distances, order, axis = 1), np.take_along_axis(top, order, axis = 1)
+
+def _merge(distances, indices, new_distances, new_indices):
+    # The best of the neighbours found so far and of new ones, as many as found so far
+    merged_distances = np.concatenate([distances, new_distances], axis = 1)
+    merged_indices = np.concatenate([indices, new_indices], axis = 1)
+    top = np.argsort(merged_distances, axis = 1, kind = 'stable')[:, :distances.shape[1]]
+    return np.take_along_axis(merged_distances, top, axis = 1), np.take_along_axis(merged_indices, top, axis = 1)
+
+def exact_search(queries, corpus, k, memory_mb = 1024, num_threads = None, device = None, normalized = False):
+    '''
+    Cosine distances and indices of the k nearest corpus items of every query, from the nearest, like
+    `NearestNeighbors(metric = 'cosine').kneighbors`. The score blocks of all threads hold about `memory_mb` MB.
+    By default the blocks are searched one after the other, each matrix product using all the threads of BLAS. With
+    `num_threads` > 1, that many blocks are searched at once and BLAS is limited to one thread meanwhile, so the cores
+    are not oversubscribed (the selections, single-threaded, then run in parallel too).
+    '''
+    queries = np.asarray(queries, dtype = np.float32) if normalized else normalize(queries)
+    corpus = np.asarray(corpus, dtype = np.float32) if normalized else normalize(corpus)
+    k = min(k, len(corpus))
+    distances = np.empty((len(queries), k), dtype = np.float32)
+    indices = np.empty((len(queries), k), dtype = np.int64)
+    if k == 0 or len(queries) == 0:
+        return distances, indices
+    num_threads = num_threads or 1
+    block_size = max(int(memory_mb * 2**20 // (4 * max(len(corpus), 1) * num_threads)), 1)
+
+    if device is not None and torch.device(device).type == 'cuda':
+        corpus_t = torch.from_numpy(corpus).to(device)
+        for start in range(0, len(queries), block_size * num_threads):
+            scores = torch.from_numpy(queries[start:start + block_size * num_threads]).to(device) @ corpus_t.T
+            top_distances, top = torch.topk((1 - scores).clamp_(0, 2), k, dim = 1, largest = False)
+            distances[start:start + len(top)] = top_distances.cpu().numpy()
+            indices[start:start + len(top)] = top.cpu().numpy()
+        return distances, indices
+
+    def search_block(start):
+        top_distances, top = _select(_distances(queries[start:start + block_size], corpus), k)
+        distances[start:start + len(top)] = top_distances
+        indices[start:start + len(top)] = top
+
+    if num_threads == 1:
+        for start in range(0, len(queries), block_size):
+            search_block(start)
+        return distances, indices
+    # The matrix products and the selections release the GIL
+    with threadpool_limits(limits = 1, user_api = 'blas'), ThreadPoolExecutor(max_workers = num_threads) as executor:
+        list(executor.map(search_block, range(0, len(queries), block_size)))
+    return distances, indices
+
+class ExactIndex(object):
+    def __init__(self, embeddings):
+        self.embeddings = normalize(embeddings)
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    def search(self, queries, k, **kwargs):
+        return exact_search(normalize(queries), self.embeddings, k, normalized = True, **kwargs)
+
+    def state(self):
+        return {'embeddings': self.embeddings}
+
+    @classmethod
+    def from_state(cls, state):
+        index = cls.__new__(cls)
+        index.__dict__.update(state)
+        return index
+
+class LanguagePartitionedIndex(object):
+    def __init__(self, embeddings, languages):
+        languages = np.asarray(languages)
+        # The content of each language is a contiguous block of the normalized embeddings
+        self.order = np.argsort(languages, kind = 'stable')
+        self.embeddings = normalize(np.asarray(embeddings)[self.order])
+        partition_languages, starts, counts = np.unique(languages[self.order], return_index = True, return_counts = True)
+        self.partitions = {language: (start, start + count) for language, start, count in 
+                           zip(partition_languages.tolist(), starts, counts)}
+
+    def __len__(self):
+        return len(self.order)
+
+    def _rows(self, languages):
+        ranges = [self.partitions[language] for language in languages if language in self.partitions]
+        if len(ranges) == 1:
+            return np.arange(*ranges[0]), self.embeddings[ranges[0][0]:ranges[0][1]]
+        rows = np.concatenate([np.arange(start, end) for start, end in ranges] + [np.zeros(0, dtype = np.int64)])
+        return rows, self.embeddings[rows]
+
+    def search(self, queries, query_languages, k, extra_languages = None, **kwargs):
+        '''
+        Cosine distances and indices of the k nearest content items of every query among the content of its language
+        and of its `extra_languages` (one sequence per query), as `exact_search`. The rows of the queries with fewer
+        than k such items are padded with infinite distances and -1 indices.
+        '''
+        queries = normalize(queries)
+        query_languages = np.asarray(query_languages).tolist()
+        distances = np.full((len(queries), k), np.inf, dtype = np.float32)
+        indices = np.full((len(queries), k), -1, dtype = np.int64)
+
+        # The queries searched among the same languages are searched together
+        groups = {}
+        for i, language in enumerate(query_languages):
+            extra = () if extra_languages is None else tuple(sorted(set(extra_languages[i]) - {language}))
+            groups.setdefault((language,) + extra, []).append(i)
+        for languages, members in groups.items():
+            rows, corpus = self._rows(languages)
+            if len(rows) == 0:
+                continue
+            members = np.array(members)
+            group_distances, group_indices = exact_search(queries[members], corpus, k, normalized = True, **kwargs)
+            distances[members, :group_distances.shape[1]] = group_distances
+            indices[members, :group_indices.shape[1]] = self.order[rows[group_indices]]
+        return distances, indices
+
+    def state(self):
+        languages = np.array(list(self.partitions.keys()), dtype = np.int64)
+        bounds = np.array(list(self.partitions.values()), dtype = np.int64).reshape(-1, 2)
+        return {'order': self.order, 'embeddings': self.embeddings, 'partition_languages': languages, 'partition_bounds': bounds}
+
+    @classmethod
+    def from_state(cls, state):
+        index = cls.__new__(cls)
+        index.order, index.embeddings = state['order'], state['embeddings']
+        index.partitions = {language: (start, end) for language, (start, end) in
+                            zip(state['partition_languages'].tolist(), state['partition_bounds'].tolist())}
+        return index
+
+def _cluster_sums(x, assignments, num_clusters):
+    sums = torch.zeros((num_clusters, x.shape[1]), dtype = torch.float32)
+    return sums.index_add_(0, torch.from_numpy(assignments), torch.from_numpy(np.ascontiguousarray(x))).numpy()
+
+def spherical_kmeans(x, num_clusters, num_iterations = 10, max_samples = 256, seed = 0):
+    '''Unit-norm centroids of the normalized rows of `x`, fitted on up to `max_samples` rows per cluster'''
+    rng = np.random.default_rng(seed)
+    if len(x) > num_clusters * max_samples:
+        x = x[np.sort(rng.choice(len(x), num_clusters * max_samples, replace = False))]
+    x = normalize(x)
+    centroids = x[rng.choice(len(x), num_clusters, replace = False)]
+    for _ in range(num_iterations):
+        assignments = exact_search(x, centroids, 1, normalized = True)[1][:, 0]
+        sums = _cluster_sums(x, assignments, num_clusters)
+        counts = np.bincount(assignments, minlength = num_clusters)
+        # The empty clusters restart from random rows
+        empty = np.flatnonzero(counts == 0)
+        sums[empty] = x[rng.choice(len(x), len(empty), replace = False)]
+        centroids = normalize(sums)
+    return centroids
+
+class IVFIndex(object):
+    def __init__(self, embeddings, nlist, num_iterations = 10, seed = 0):
+        embeddings = normalize(embeddings)
+        self.nlist = min(nlist, len(embeddings))
+        self.centroids = spherical_kmeans(embeddings, self.nlist, num_iterations = num_iterations, seed = seed)
+        assignments = exact_search(embeddings, self.centroids, 1, normalized = True)[1][:, 0]
+        # The content of each list is a contiguous block of the embeddings
+        self.order = np.argsort(assignments, kind = 'stable')
+        self.embeddings = embeddings[self.order]
+        self.offsets = np.searchsorted(assignments[self.order], np.arange(self.nlist + 1))
+
+    def __len__(self):
+        return len(self.order)
+
+    def search(self, queries, k, nprobe = 16, memory_mb = 1024):
+        '''
+        Cosine distances and indices of the k nearest content items of every query among the content of its `nprobe`
+        nearest lists, computed as `exact_search` does. The rows of the queries with fewer than k such items are padded
+        with infinite distances and -1 indices. With every list probed, the neighbours are those of `exact_search` up to
+        float32 rounding (the products are blocked differently, distances may differ by about 1e-7) and the order of
+        exact ties, not bit for bit.
+        '''
+        queries = normalize(queries)
+        k = min(k, len(self))
+        distances = np.full((len(queries), k), np.inf, dtype = np.float32)
+        indices = np.full((len(queries), k), -1, dtype = np.int64)
+        probes = exact_search(queries, self.centroids, min(nprobe, self.nlist), normalized = True)[1]
+
+        # Every list is scored against all the queries probing it, the best items are merged into those found so far
+        probed_lists = probes.ravel()
+        probing_queries = np.repeat(np.arange(len(queries)), probes.shape[1])[np.argsort(probed_lists, kind = 'stable')]
+        bounds = np.searchsorted(np.sort(probed_lists), np.arange(self.nlist + 1))
+        for l in range(self.nlist):
+            start, end = self.offsets[l], self.offsets[l + 1]
+            members = probing_queries[bounds[l]:bounds[l + 1]]
+            block_size = max(int(memory_mb * 2**20 // (4 * max(end - start, 1))), 1)
+            for block_start in range(0, len(members) if end > start else 0, block_size):
+                block = members[block_start:block_start + block_size]
+                list_distances, list_indices = _select(_distances(queries[block], self.embeddings[start:end]), min(k, end - start))
+                distances[block], indices[block] = _merge(distances[block], indices[block], list_distances, list_indices + start)
+        found = indices >= 0
+        indices[found] = self.order[indices[found]]
+        return distances, indices
+
+    def state(self):
+        return {'centroids': self.centroids, 'order': self.order, 'embeddings': self.embeddings, 'offsets': self.offsets}
+
+    @classmethod
+    def from_state(cls, state):
+        index = cls.__new__(cls)
+        index.__dict__.update(state)
+        index.nlist = len(index.centroids)
+        return index
+
+def kmeans(x, num_clusters, num_iterations = 10, seed = 0):
+    '''Euclidean k-means centroids of the rows of `x`'''
+    rng = np.random.default_rng(seed)
+    x = np.asarray(x, dtype = np.float32)
+    centroids = x[rng.choice(len(x), num_clusters, replace = False)]
+    for _ in range(num_iterations):
+        assignments = _nearest_centroids(x, centroids)
+        counts = np.bincount(assignments, minlength = num_clusters)
+        sums = _cluster_sums(x, assignments, num_clusters)
+        empty = counts == 0
+        centroids = sums / np.maximum(counts, 1)[:, None]
+        centroids[empty] = x[rng.choice(len(x), int(empty.sum()), replace = False)]
+    return centroids
+
+def _nearest_centroids(x, centroids, block_size = 65536):
+    assignments = np.empty(len(x), dtype = np.int64)
+    squared_norms = (centroids ** 2).sum(axis = 1)
+    for start in range(0, len(x), block_size):
+        # |x - c|^2 without the |x|^2 term, which does not change the nearest centroid
+        distances = x[start:start + block_size] @ (-2 * centroids).T
+        distances += squared_norms
+        assignments[start:start + block_size] = np.argmin(distances, axis = 1)
+    return assignments
+
+def _rerank(queries, indices, read_rows, k, memory_mb = 1024):
+    # The k nearest of the candidate `indices` of every normalized query, by their float32 distances. Only the rows of
+    # a block of queries are read at a time: they are held 3 times (read, normalized and gathered per query)
+    block_size = max(int(memory_mb * 2**20 // (3 * 4 * indices.shape[1] * queries.shape[1])), 1)
+    distances = np.empty((len(queries), k), dtype = np.float32)
+    top_indices = np.empty((len(queries), k), dtype = np.int64)
+    for start in range(0, len(queries), block_size):
+        block = slice(start, start + block_size)
+        rows, positions = np.unique(indices[block], return_inverse = True)
+        candidates = normalize(read_rows(rows))    # Sorted rows, read sequentially from a memory map
+        positions = positions.reshape(indices[block].shape)
+        exact = np.clip(1 - np.einsum('qd,qsd->qs', queries[block], candidates[positions]), 0, 2)
+        top = np.argsort(exact, axis = 1, kind = 'stable')[:, :k]
+        distances[block] = np.take_along_axis(exact, top, axis = 1)
+        top_indices[block] = np.take_along_axis(indices[block], top, axis = 1)
+    return distances, top_indices
+
+class PQIndex(object):
+    '''
+    Product-quantized normalized embeddings: every embedding is cut into `num_subspaces` sub-vectors, each replaced
+    by the 1-byte code of its nearest centroid among the 256 of its subspace (fitted by k-means on `max_samples`
+    rows). Only the codes and the codebooks are kept.
+    '''
+    def __init__(self, embeddings, num_subspaces, num_iterations = 10, max_samples = 65536, seed = 0):
+        embeddings = normalize(embeddings)
+        dim = embeddings.shape[1]
+        assert dim % num_subspaces == 0, f'{num_subspaces} subspaces do not divide {dim} dimensions!'
+        self.num_subspaces = num_subspaces
+        self.subspace_dim = dim // num_subspaces
+        rng = np.random.default_rng(seed)
+        sample = embeddings[np.sort(rng.choice(len(embeddings), max_samples, replace = False))] if len(embeddings) > max_samples else embeddings
+        num_centroids = min(256, len(sample))
+        self.codebooks = np.empty((num_subspaces, num_centroids, self.subspace_dim), dtype = np.float32)
+        self.codes = np.empty((len(embeddings), num_subspaces), dtype = np.uint8)
+        for j in range(num_subspaces):
+            columns = slice(j * self.subspace_dim, (j + 1) * self.subspace_dim)
+            self.codebooks[j] = kmeans(sample[:, columns], num_centroids, num_iterations = num_iterations, seed = seed + j)
+            self.codes[:, j] = _nearest_centroids(embeddings[:, columns], self.codebooks[j])
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.codebooks.nbytes
+
+    def decode(self, start = 0, end = None):
+        '''The quantized embeddings of the rows from `start` to `end`'''
+        codes = self.codes[start:end]
+        return self.codebooks[np.arange(self.num_subspaces), codes].reshape(len(codes), -1)
+
+    def search(self, queries, k, vectors = None, rerank = 4, memory_mb = 1024):
+        '''
+        Cosine distances and indices of the k nearest content items of every query, from the asymmetric distances
+        (the query itself against the quantized content). With the original content `vectors` (e.g. memory-mapped),
+        the `k * rerank` nearest items are re-ranked by their exact distances, reading only their rows.
+        '''
+        queries = normalize(queries)
+        k = min(k, len(self))
+        shortlist = min(k * rerank, len(self)) if vectors is not None and rerank else k
+        distances = np.full((len(queries), shortlist), np.inf, dtype = np.float32)
+        indices = np.full((len(queries), shortlist), -1, dtype = np.int64)
+        if k == 0 or len(queries) == 0:
+            return distances[:, :k], indices[:, :k]
+
+        # The sum of the query/centroid products of the subspaces is the product of the query and the quantized
+        # embedding, the content is decoded block by block to compute it with one matrix product per block. A block holds
+        # its decoded content, the float32 distances of the queries to it and the int64 output of `argpartition`
+        block_size = max(int(memory_mb * 2**20 // ((4 + 8) * len(queries) + 4 * self.num_subspaces * self.subspace_dim)), shortlist)
+        for start in range(0, len(self), block_size):
+            block_distances, block_indices = _select(_distances(queries, self.decode(start, start + block_size)), min(shortlist, len(self) - start))
+            distances, indices = _merge(distances, indices, block_distances, block_indices + start)
+        if shortlist == k:
+            return distances, indices
+
+        return _rerank(queries, indices, vectors.__getitem__, k, memory_mb = memory_mb)
+
+    def state(self):
+        return {'codebooks': self.codebooks, 'codes': self.codes}
+
+    @classmethod
+    def from_state(cls, state):
+        index = cls.__new__(cls)
+        index.__dict__.update(state)
+        index.num_subspaces, _, index.subspace_dim = index.codebooks.shape
+        return index
+
+def _int8_products(queries, codes):
+    # Exact int32 products, by the int8 matrix product of torch when it has one (float32 holds them exactly otherwise)
+    if hasattr(torch, '_int_mm'):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning)    # The codes may be a read-only memory map, they are only read
+            return torch._int_mm(torch.from_numpy(queries), torch.from_numpy(codes).T).numpy()
+    return (queries.astype(np.float32) @ codes.astype(np.float32).T).astype(np.int32)
+
+class Int8Index(object):
+    '''
+    Normalized embeddings quantized to int8 with one scale per dimension, 4 times smaller than in float32. The queries
+    are quantized too, the `k * rerank` best int8 products are found and re-scored in float32.
+    '''
+    def __init__(self, embeddings):
+        embeddings = normalize(embeddings)
+        self.scales = np.abs(embeddings).max(axis = 0) / 127
+        self.scales[self.scales == 0] = 1
+        self.codes = np.rint(embeddings / self.scales).astype(np.int8)
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.scales.nbytes
+
+    def dequantize(self, rows):
+        return self.codes[rows] * self.scales
+
+    def quantize_queries(self, queries):
+        # The content scales are folded into the queries, then every query gets its own scale
+        queries = queries * self.scales
+        query_scales = np.abs(queries).max(axis = 1, keepdims = True) / 127
+        query_scales[query_scales == 0] = 1
+        return np.rint(queries / query_scales).astype(np.int8)
+
+    def search(self, queries, k, vectors = None, rerank = 4, memory_mb = 1024):
+        '''
+        Cosine distances and indices of the k nearest content items of every query, re-scored from the original
+        content `vectors` (e.g. memory-mapped, only the rows of the candidates are read) or, without them, from the
+        dequantized content
+        '''
+        queries = normalize(queries)
+        k = min(k, len(self))
+        shortlist = min(max(k * rerank, k), len(self))
+        indices = np.empty((len(queries), shortlist), dtype = np.int64)
+        if k == 0 or len(queries) == 0:
+            return np.empty((len(queries), k), dtype = np.float32), indices[:, :k]
+
+        quantized = self.quantize_queries(queries)
+        # The products of a query differ from its cosine similarities by a positive factor, they rank the content alike.
+        # A block holds the int32 products of its queries, negated in place, and the int64 output of `argpartition`
+        block_size = max(int(memory_mb * 2**20 // ((4 + 8) * len(self))), 1)
+        for start in range(0, len(queries), block_size):
+            products = _int8_products(quantized[start:start + block_size], self.codes)
+            indices[start:start + block_size] = _select(np.negative(products, out = products), shortlist)[1]
+        return _rerank(queries, indices, self.dequantize if vectors is None else vectors.__getitem__, k, memory_mb = memory_mb)
+
+    def state(self):
+        return {'scales': self.scales, 'codes': self.codes}
+
+    @classmethod
+    def from_state(cls, state):
+        index = cls.__new__(cls)
+        index.__dict__.update(state)
+        return index
+
+def build_index(cfg, content_embeddings, content_languages):
+    '''
+    The index of the content selected by the config: exact, partitioned by language with
+    `cfg.language_partitioned_search`, an IVF index with `cfg.search_nlist`, product-quantized with
+    `cfg.search_pq_subspaces` or quantized to int8 with `cfg.search_int8`
+    '''
+    if cfg.search_int8:
+        assert cfg.search_nlist is None and cfg.search_pq_subspaces is None and not cfg.language_partitioned_search, \
+            'The int8 index is searched exhaustively!'
+        return Int8Index(content_embeddings)
+    if cfg.search_pq_subspaces is not None:
+        assert cfg.search_nlist is None and not cfg.language_partitioned_search, 'The PQ index is searched exhaustively!'
+        return PQIndex(content_embeddings, cfg.search_pq_subspaces)
+    if cfg.search_nlist is not None:
+        assert not cfg.language_partitioned_search, 'The IVF index is not partitioned by language!'
+        return IVFIndex(content_embeddings, cfg.search_nlist)
+    if cfg.language_partitioned_search:
+        return LanguagePartitionedIndex(content_embeddings, content_languages)
+    return ExactIndex(content_embeddings)
+
+def index_search(cfg, index, topic_embeddings, topic_languages, vectors = None):
+    '''
+    The `cfg.thres['num_k']` nearest content items of every topic in `index`, among the content of the language of
+    the topic and of its `cfg.search_extra_languages` for a partitioned index. The PQ and int8 candidates are
+    re-ranked from the normalized content `vectors`.
+    '''
+    k = cfg.thres['num_k']
+    if isinstance(index, Int8Index):
+        return index.search(topic_embeddings, k, vectors = vectors, rerank = cfg.search_int8_rerank)
+    if isinstance(index, PQIndex):
+        return index.search(topic_embeddings, k, vectors = vectors, rerank = cfg.search_pq_rerank)
+    if isinstance(index, IVFIndex):
+        return index.search(topic_embeddings, k, nprobe = cfg.search_nprobe)
+    if isinstance(index, LanguagePartitionedIndex):
+        extra_languages = {cfg.languages_map[language]: [cfg.languages_map[extra] for extra in extras if extra in cfg.languages_map]
+                           for language, extras in cfg.search_extra_languages.items() if language in cfg.languages_map}
+        return index.search(topic_embeddings, topic_languages, k, device = cfg.device,
+                            extra_languages = [extra_languages.get(language, ()) for language in np.asarray(topic_languages).tolist()])
+    return index.search(topic_embeddings, k, device = cfg.device)
+
+def candidate_search(cfg, topic_embeddings, topic_languages, content_embeddings, content_languages):
+    '''The nearest content items of every topic, in an index of the content built for this search only'''
+    index = build_index(cfg, content_embeddings, content_languages)
+    vectors = normalize(content_embeddings) if isinstance(index, (PQIndex, Int8Index)) else None
+    return index_search(cfg, index, topic_embeddings, topic_languages, vectors = vectors)
+
+class PCAProjection(object):
+    def __init__(self, dim, center = False):
+        self.dim = dim
+        self.center = center
+        self.mean = None
+        self.components = None
+
+    def fit(self, x, max_samples = 200000, seed = 0):
+        x = np.asarray(x, dtype = np.float32)
+        if len(x) > max_samples:
+            x = x[np.sort(np.random.default_rng(seed).choice(len(x), max_samples, replace = False))]
+        self.mean = x.mean(axis = 0) if self.center else np.zeros(x.shape[1], dtype = np.float32)
+        x = x - self.mean
+        # Eigenvectors of the second moments, by decreasing eigenvalue
+        eigenvalues, eigenvectors = np.linalg.eigh(x.T.astype(np.float64) @ x / len(x))
+        order = np.argsort(eigenvalues)[::-1]
+        self.components = np.ascontiguousarray(eigenvectors[:, order[:self.dim]].T, dtype = np.float32)
+        self.explained_variance = float(eigenvalues[order[:self.dim]].sum() / eigenvalues.sum())
+        return self
+
+    def state(self):
+        return {'mean': self.mean, 'components': self.components}
+
+    @classmethod
+    def from_state(cls, state):
+        projection = cls(len(state['components']))
+        projection.mean, projection.components = state['mean'], state['components']
+        return projection
+
+    def transform(self, x, batch_size = 65536):
+        output = np.empty((len(x), self.dim), dtype = np.float32)
+        for start in range(0, len(x), batch_size):
+            batch = np.asarray(x[start:start + batch_size], dtype = np.float32)
+            output[start:start + len(batch)] = (batch - self.mean) @ self.components.T
+        return output
+
+def fit_projection(cfg, content_embeddings):
+    '''The projection to `cfg.search_dim` dimensions fitted on the content, None when the embeddings are kept as they are'''
+    if cfg.search_dim is None or cfg.search_dim >= np.shape(content_embeddings)[1]:
+        return None
+    return PCAProjection(cfg.search_dim).fit(content_embeddings)
+
+def project_embeddings(cfg, topic_embeddings, content_embeddings):
+    '''The embeddings projected to `cfg.search_dim` dimensions by a projection fitted on the content, or as they are'''
+    projection = fit_projection(cfg, content_embeddings)
+    if projection is None:
+        return topic_embeddings, content_embeddings
+    return projection.transform(topic_embeddings), projection.transform(content_embeddings)
+
+def _recall(indices, reference):
+    return float(np.mean([len(set(pred.tolist()) & set(true.tolist())) / len(true) for pred, true in zip(indices, reference)]))
+
+def projection_report(queries, corpus, dims = (128, 256), ks = (10, 50), center = False):
+    '''
+    For the full dimension and each of `dims`: recall@k of the full-dimension neighbours of the queries, memory of the
+    indexed corpus (MB) and search latency (ms per query)
+    '''
+    k = max(ks)
+    report = {}
+    for dim in (None,) + tuple(dims):
+        start = time.perf_counter()
+        if dim is None:
+            projected_queries, projected_corpus = np.asarray(queries, dtype = np.float32), np.asarray(corpus, dtype = np.float32)
+        else:
+            projection = PCAProjection(dim, center = center).fit(corpus)
+            projected_corpus = projection.transform(corpus)
+            projected_queries = projection.transform(queries)
+        fit_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        indices = exact_search(projected_queries, projected_corpus, k)[1]
+        latency = (time.perf_counter() - start) / len(queries)
+        if dim is None:
+            reference = indices
+        report[dim or np.shape(corpus)[1]] = dict(
+            {f'recall@{k}': _recall(indices[:, :k], reference[:, :k]) for k in ks},
+            index_mb = projected_corpus.nbytes / 2**20, query_ms = latency * 1000, fit_s = fit_time)
+    return report
+
+def ivf_sweep(queries, corpus, nlists = (256, 1024), nprobes = (4, 16, 64), k = 50):
+    '''Recall@k of the exact neighbours, latency (ms per query) and build time of an IVF index for each nlist/nprobe'''
+    start = time.perf_counter()
+    reference = exact_search(queries, corpus, k)[1]
+    report = [{'nlist': None, 'nprobe': None, f'recall@{k}': 1., 'query_ms': (time.perf_counter() - start) / len(queries) * 1000,
+               'build_s': 0.}]
+    for nlist in nlists:
+        start = time.perf_counter()
+        index = IVFIndex(corpus, nlist)
+        build_time = time.perf_counter() - start
+        for nprobe in nprobes:
+            if nprobe > index.nlist:
+                continue
+            start = time.perf_counter()
+            indices = index.search(queries, k, nprobe = nprobe)[1]
+            latency = (time.perf_counter() - start) / len(queries)
+            report.append({'nlist': index.nlist, 'nprobe': nprobe, f'recall@{k}': _recall(indices, reference),
+                           'query_ms': latency * 1000, 'build_s': build_time})
+    return report
+
+def pq_report(queries, corpus, subspaces = (48, 96), reranks = (0, 4), k = 50, path = None):
+    '''
+    Recall@k of the exact neighbours, index memory and latency (ms per query) of PQ indexes with each number of
+    subspaces, re-ranking the short lists from the corpus memory-mapped from `path` (a temporary file by default)
+    '''
+    reference = exact_search(queries, corpus, k)[1]
+    if path is None:
+        handle, path = tempfile.mkstemp(suffix = '.npy')
+        os.close(handle)
+    np.save(path, np.asarray(corpus, dtype = np.float32))
+    vectors = np.load(path, mmap_mode = 'r')
+    report = []
+    try:
+        for num_subspaces in subspaces:
+            if corpus.shape[1] % num_subspaces != 0:
+                continue
+            start = time.perf_counter()
+            index = PQIndex(corpus, num_subspaces)
+            build_time = time.perf_counter() - start
+            for rerank in reranks:
+                start = time.perf_counter()
+                indices = index.search(queries, k, vectors = vectors, rerank = rerank)[1]
+                latency = (time.perf_counter() - start) / len(queries)
+                report.append({'subspaces': num_subspaces, 'rerank': rerank, f'recall@{k}': _recall(indices, reference),
+                               'index_mb': index.nbytes / 2**20, 'float32_mb': corpus.shape[0] * corpus.shape[1] * 4 / 2**20,
+                               'query_ms': latency * 1000, 'build_s': build_time})
+    finally:
+        del vectors
+        os.remove(path)
+    return report
+
+def int8_report(queries, corpus, reranks = (1, 2, 4), k = 50):
+    '''
+    Throughput (queries per second), index memory, recall@k of the exact neighbours and rate of queries whose k
+    neighbours are exactly those of the float32 search, for each over-fetching factor of the int8 search
+    '''
+    start = time.perf_counter()
+    reference = exact_search(queries, corpus, k)[1]
+    report = [{'rerank': None, 'queries_per_s': len(queries) / (time.perf_counter() - start), 'index_mb': corpus.size * 4 / 2**20,
+               f'recall@{k}': 1., 'exact_match': 1., 'build_s': 0.}]
+    start = time.perf_counter()
+    index = Int8Index(corpus)
+    build_time = time.perf_counter() - start
+    for rerank in reranks:
+        start = time.perf_counter()
+        indices = index.search(queries, k, vectors = corpus, rerank = rerank)[1]
+        throughput = len(queries) / (time.perf_counter() - start)
+        exact_match = np.mean([set(a.tolist()) == set(b.tolist()) for a, b in zip(indices, reference)])
+        report.append({'rerank': rerank, 'queries_per_s': throughput, 'index_mb': index.nbytes / 2**20,
+                       f'recall@{k}': _recall(indices, reference), 'exact_match': float(exact_match), 'build_s': build_time})
+    return report
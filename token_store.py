@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""Pre-tokenized, memory-mapped token ids of the topics and content
+
+The input texts are tokenized once, in batches, with the fast tokenizer and truncated to `max_len`.
+The token ids of all entities are concatenated into one flat int32 array, with int64 offsets and
+int32 lengths, and saved as `.npy` files that are memory-mapped when loaded. A store is keyed by the
+entity ids, the texts and the tokenizer/`max_len` fingerprint, so it is rebuilt whenever any of them
+changes. The datasets slice token ids from the store instead of calling the tokenizer per item, and
+DataLoader workers share the memory-mapped pages instead of each holding a tokenizer.
+"""
+
+import os, json, hashlib
+import numpy as np
+import pandas as pd
+
+from utils import print_log, write_directory, MemoryMappedStore
+
+TOKEN_STORE_VERSION = 1
+
+def tokenizer_fingerprint(tokenizer, max_len):
+    sha = hashlib.sha1()
+    if getattr(tokenizer, 'is_fast', False):
+        # The serialized backend holds the vocabulary, the added tokens and the normalization rules. Its
+        # truncation/padding state depends on the last call of the tokenizer, so it is left out
+        backend = json.loads(tokenizer.backend_tokenizer.to_str())
+        backend.pop('truncation', None)
+        backend.pop('padding', None)
+        sha.update(json.dumps(backend, sort_keys = True).encode())
+    else:
+        sha.update(json.dumps([tokenizer.name_or_path, len(tokenizer), tokenizer.all_special_tokens]).encode())
+    sha.update(f'max_len={max_len}'.encode())
+    return sha.hexdigest()[:16]
+
+def texts_fingerprint(ids, texts):
+    sha = hashlib.sha1()
+    for entity_id, text in zip(ids, texts):
+        sha.update(entity_id.encode())
+        sha.update(b'\x00')
+        sha.update(text.encode())
+        sha.update(b'\x01')
+    return sha.hexdigest()[:16]
+
+class TokenStore(MemoryMappedStore):
+    array_names = ('ids', 'token_ids', 'offsets', 'lengths')
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.max_len = self.meta['max_len']
+        self.pad_token_id = self.meta['pad_token_id']
+        self._id2idx = None
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state['_id2idx'] = None
+        return state
+
+    @property
+    def ids(self):
+        return self.arrays['ids']
+
+    @property
+    def lengths(self):
+        return self.arrays['lengths']
+
+    def __len__(self):
+        return len(self.arrays['lengths'])
+
+    def indices(self, ids):
+        if self._id2idx is None:
+            self._id2idx = pd.Index(np.asarray(self.ids))
+        indices = self._id2idx.get_indexer(ids)
+        assert (indices >= 0).all(), 'Some ids are missing from the token store!'
+        return indices
+
+    def get(self, idx):
+        offsets = self.arrays['offsets']
+        return self.arrays['token_ids'][offsets[idx]:offsets[idx + 1]]
+
+    def padded(self, idx, max_len = None):
+        '''Token ids padded to `max_len` and the attention mask, as the tokenizer with `padding = "max_length"`'''
+        max_len = max_len or self.max_len
+        tokens = self.get(idx)[:max_len]
+        input_ids = np.full(max_len, self.pad_token_id, dtype = np.int64)
+        input_ids[:len(tokens)] = tokens
+        attention_mask = np.zeros(max_len, dtype = np.int64)
+        attention_mask[:len(tokens)] = 1
+        return input_ids, attention_mask
+
+    @classmethod
+    def build(cls, path, ids, texts, tokenizer, max_len, batch_size = 4096):
+        ids = np.asarray(ids).astype(str)
+        lengths = np.zeros(len(ids), dtype = np.int32)
+        token_ids = []
+        for start in range(0, len(ids), batch_size):
+            batch = tokenizer(list(texts[start:start + batch_size]),
+                              max_length = max_len,
+                              truncation = True,
+                              return_attention_mask = False)['input_ids']
+            lengths[start:start + len(batch)] = [len(tokens) for tokens in batch]
+            token_ids.append(np.fromiter((t for tokens in batch for t in tokens), dtype = np.int32))
+        offsets = np.zeros(len(ids) + 1, dtype = np.int64)
+        np.cumsum(lengths, out = offsets[1:])
+
+        def write_fn(tmp_path):
+            np.save(os.path.join(tmp_path, 'ids.npy'), ids)
+            np.save(os.path.join(tmp_path, 'token_ids.npy'), np.concatenate(token_ids) if token_ids else np.zeros(0, dtype = np.int32))
+            np.save(os.path.join(tmp_path, 'offsets.npy'), offsets)
+            np.save(os.path.join(tmp_path, 'lengths.npy'), lengths)
+            with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+                json.dump({
+                    'version': TOKEN_STORE_VERSION,
+                    'size': len(ids),
+                    'max_len': max_len,
+                    'pad_token_id': tokenizer.pad_token_id,
+                    'num_tokens': int(offsets[-1]),
+                }, f, indent = 2)
+        return cls(write_directory(path, write_fn))
+
+    @classmethod
+    def load_or_build(cls, cfg, name, ids, texts, max_len = None):
+        max_len = max_len or cfg.max_len
+        texts = np.asarray(texts, dtype = object)
+        key = f'{tokenizer_fingerprint(cfg.tokenizer, max_len)}_{texts_fingerprint(ids, texts)}'
+        path = os.path.join(cfg.token_store_dir, f'{name}_v{TOKEN_STORE_VERSION}_{key}')
+        if os.path.exists(os.path.join(path, 'meta.json')):
+            print_log(cfg, f'Loading the {name} token store from {path}...')
+            return cls(path)
+        print_log(cfg, f'Tokenizing the {name} into {path}...')
+        os.makedirs(cfg.token_store_dir, exist_ok = True)
+        return cls.build(path, ids, texts, cfg.tokenizer, max_len)
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""Sparse topic <-> content incidence index built from correlations.csv
+
+Topics and content items are integer-encoded by their row position in topics_df/content_df.
+The edges are kept both in CSR form (topic -> content, in the order of the `content_ids`
+strings) and in CSC form (content -> topic, in the order of correlations.csv), so both
+directions are answered in O(degree).
+"""
+
+import numpy as np
+import pandas as pd
+
+class TopicContentIndex(object):
+    def __init__(self, topic_ids, content_ids, edge_topic_ids, edge_content_ids):
+        self.topic_ids = np.asarray(topic_ids, dtype = object)
+        self.content_ids = np.asarray(content_ids, dtype = object)
+        self.topic2idx = pd.Index(self.topic_ids)
+        self.content2idx = pd.Index(self.content_ids)
+
+        # Edges whose topic or content is unknown are dropped
+        edge_topics = self.topic2idx.get_indexer(edge_topic_ids)
+        edge_contents = self.content2idx.get_indexer(edge_content_ids)
+        known = (edge_topics >= 0) & (edge_contents >= 0)
+        self.edge_topics = edge_topics[known].astype(np.int32)
+        self.edge_contents = edge_contents[known].astype(np.int32)
+
+        self.csr_offsets, self.csr_content = self._compress(self.edge_topics, self.edge_contents, len(self.topic_ids))
+        self.csc_offsets, self.csc_topics = self._compress(self.edge_contents, self.edge_topics, len(self.content_ids))
+
+    @staticmethod
+    def _compress(rows, cols, num_rows):
+        order = np.argsort(rows, kind = 'stable')
+        offsets = np.zeros(num_rows + 1, dtype = np.int64)
+        np.cumsum(np.bincount(rows, minlength = num_rows), out = offsets[1:])
+        return offsets, cols[order]
+
+    @classmethod
+    def from_correlations(cls, correlations_df, topic_ids = None, content_ids = None):
+        correlations_df = correlations_df.reset_index() if 'topic_id' not in correlations_df.columns else correlations_df
+        split_content_ids = correlations_df['content_ids'].str.split()
+        edge_topic_ids = np.repeat(correlations_df['topic_id'].values, split_content_ids.str.len().values)
+        edge_content_ids = split_content_ids.explode().values
+        if topic_ids is None:
+            topic_ids = pd.unique(correlations_df['topic_id'].values)
+        if content_ids is None:
+            content_ids = pd.unique(edge_content_ids)
+        return cls(topic_ids, content_ids, edge_topic_ids, edge_content_ids)
+
+    @property
+    def num_edges(self):
+        return len(self.edge_topics)
+
+    def topic_index(self, topic_id):
+        return self.topic2idx.get_loc(topic_id)
+
+    def content_index(self, content_id):
+        return self.content2idx.get_loc(content_id)
+
+    def topic_degree(self):
+        return np.diff(self.csr_offsets)
+
+    def content_degree(self):
+        return np.diff(self.csc_offsets)
+
+    def content_of(self, topic_idx):
+        return self.csr_content[self.csr_offsets[topic_idx]:self.csr_offsets[topic_idx + 1]]
+
+    def topics_of(self, content_idx):
+        return self.csc_topics[self.csc_offsets[content_idx]:self.csc_offsets[content_idx + 1]]
+
+    def content_ids_of(self, topic_id):
+        if topic_id not in self.topic2idx:
+            return self.content_ids[:0]
+        return self.content_ids[self.content_of(self.topic_index(topic_id))]
+
+    def topic_ids_of(self, content_id):
+        if content_id not in self.content2idx:
+            return self.topic_ids[:0]
+        return self.topic_ids[self.topics_of(self.content_index(content_id))]
+
+    def content_fold(self, topic_fold):
+        '''
+        Fold of every content item given the fold of every topic: a content item belongs to a fold when all
+        the topics it is correlated with are in that fold, otherwise (or without any topic) it gets -1.
+        '''
+        topic_fold = pd.Series(topic_fold).fillna(-1).values.astype(np.int64)
+        content_fold = np.full(len(self.content_ids), -1, dtype = np.int64)
+        degree = self.content_degree()
+        has_topics = degree > 0
+        if not has_topics.any():
+            return content_fold
+
+        # Segment-wise min/max over the CSC layout, empty segments are skipped by `reduceat`
+        edge_fold = topic_fold[self.csc_topics]
+        starts = self.csc_offsets[:-1][has_topics]
+        min_fold = np.minimum.reduceat(edge_fold, starts)
+        max_fold = np.maximum.reduceat(edge_fold, starts)
+        content_fold[has_topics] = np.where(min_fold == max_fold, min_fold, -1)
+        return content_fold
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""Array-backed index of the topic trees in topics.csv
+
+The tree is built once and answers the navigation queries of the host's `Topic` helper
+(parent, ancestors, siblings, children, subtree) with integer arrays instead of
+`topics_df.loc[...]` lookups. Topics are addressed by their row position in the dataframe
+the tree was built from; `index`/`ids` convert between positions and topic ids.
+"""
+
+import numpy as np
+import pandas as pd
+
+class TopicTree(object):
+    def __init__(self, ids, parents, channels = None):
+        self.ids = np.asarray(ids, dtype = object)
+        self.id2idx = pd.Index(self.ids)
+        assert self.id2idx.is_unique, 'Topic ids must be unique!'
+        self.size = len(self.ids)
+
+        # Parent position of each topic, -1 for the roots (and for parents missing from the table)
+        self.parent_idx = self.id2idx.get_indexer(pd.Series(parents, dtype = object)).astype(np.int32)
+
+        # CSR layout of the children, siblings keep the row order of the dataframe
+        has_parent = self.parent_idx >= 0
+        child_nodes = np.flatnonzero(has_parent)
+        order = np.argsort(self.parent_idx[child_nodes], kind = 'stable')
+        self.children_index = child_nodes[order].astype(np.int32)
+        counts = np.bincount(self.parent_idx[child_nodes], minlength = self.size)
+        self.children_offsets = np.zeros(self.size + 1, dtype = np.int64)
+        np.cumsum(counts, out = self.children_offsets[1:])
+
+        # Depth and level order (breadth-first from the roots)
+        self.depth = np.full(self.size, -1, dtype = np.int32)
+        levels = []
+        frontier = np.flatnonzero(~has_parent).astype(np.int32)
+        level = 0
+        while len(frontier) > 0:
+            self.depth[frontier] = level
+            levels.append(frontier)
+            frontier = self._children_of(frontier)
+            frontier = frontier[self.depth[frontier] < 0]    # Guard against cycles
+            level += 1
+        self.levels = levels
+
+        if channels is not None:
+            channel_codes, self.channel_names = pd.factorize(pd.Series(channels, dtype = object))
+            self.channel = channel_codes.astype(np.int32)
+        else:
+            self.channel = None
+            self.channel_names = None
+
+    @classmethod
+    def from_df(cls, df):
+        ids = df['id'].values if 'id' in df.columns else df.index.values
+        channels = df['channel'].values if 'channel' in df.columns else None
+        return cls(ids, df['parent'].values, channels = channels)
+
+    def _children_of(self, nodes):
+        starts = self.children_offsets[nodes]
+        lengths = self.children_offsets[nodes + 1] - starts
+        total = lengths.sum()
+        if total == 0:
+            return np.zeros(0, dtype = np.int32)
+        # Gather all the CSR segments at once
+        positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(total)
+        return self.children_index[positions]
+
+    def __len__(self):
+        return self.size
+
+    def index(self, topic_id):
+        return self.id2idx.get_loc(topic_id)
+
+    def indices(self, topic_ids):
+        return self.id2idx.get_indexer(topic_ids)
+
+    @property
+    def roots(self):
+        return self.levels[0] if len(self.levels) > 0 else np.zeros(0, dtype = np.int32)
+
+    def parent(self, idx):
+        return int(self.parent_idx[idx])
+
+    def ancestors(self, idx):
+        ancestors = []
+        parent = self.parent_idx[idx]
+        while parent >= 0:
+            ancestors.append(parent)
+            parent = self.parent_idx[parent]
+        return np.asarray(ancestors, dtype = np.int32)
+
+    def children(self, idx):
+        return self.children_index[self.children_offsets[idx]:self.children_offsets[idx + 1]]
+
+    def siblings(self, idx):
+        parent = self.parent_idx[idx]
+        if parent < 0:
+            return np.zeros(0, dtype = np.int32)
+        children = self.children(parent)
+        return children[children != idx]
+
+    def subtree(self, idx):
+        # Pre-order traversal, i.e. the order of `Topic.subtree_markdown`
+        nodes = []
+        stack = [idx]
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            stack.extend(self.children(node)[::-1].tolist())
+        return np.asarray(nodes, dtype = np.int32)
+
+    # Breadcrumbs
+    def _root_of(self):
+        root = np.arange(self.size, dtype = np.int32)
+        for nodes in self.levels[1:]:
+            root[nodes] = root[self.parent_idx[nodes]]
+        return root
+
+    def breadcrumbs(self, texts, separator = ' >> ', include_self = True, include_root = True, n_jobs = 1):
+        '''
+        Bulk version of `Topic.get_breadcrumbs` for every topic of the tree, `texts` holds the text of
+        each topic in tree order. The topics are processed level by level and each breadcrumb extends
+        the one of its parent, so the cost is linear in the number of topics.
+        '''
+        texts = np.asarray(texts, dtype = object)
+        if n_jobs > 1 and len(self.roots) > 1:
+            crumbs = self._parallel_breadcrumbs(texts, separator, include_root, n_jobs)
+        else:
+            crumbs = level_order_breadcrumbs(self.parent_idx, self.depth, texts, separator, include_root)
+        if include_self:
+            return crumbs
+
+        # Without the topic itself, a breadcrumb is the one of its parent
+        ancestor_crumbs = np.full(self.size, '', dtype = object)
+        has_parent = self.parent_idx >= 0
+        ancestor_crumbs[has_parent] = crumbs[self.parent_idx[has_parent]]
+        return ancestor_crumbs
+
+    def near_ancestors(self, texts, separator = ' >> ', how_near = 1, include_self = True):
+        '''Bulk version of `Topic.get_near_ancestors`, i.e. the topic followed by at most `how_near` ancestors'''
+        if not include_self:
+            # `Topic.get_near_ancestors` only bounds the ancestors when the topic itself is included
+            return self.breadcrumbs(texts, separator = separator, include_self = False)
+
+        texts = np.asarray(texts, dtype = object)
+        crumbs = texts.copy()
+        ancestor = self.parent_idx.copy()
+        for _ in range(how_near):
+            has_ancestor = np.flatnonzero(ancestor >= 0)
+            if len(has_ancestor) == 0:
+                break
+            crumbs[has_ancestor] = crumbs[has_ancestor] + separator + texts[ancestor[has_ancestor]]
+            ancestor[has_ancestor] = self.parent_idx[ancestor[has_ancestor]]
+        return crumbs
+
+    def _parallel_breadcrumbs(self, texts, separator, include_root, n_jobs):
+        from concurrent.futures import ProcessPoolExecutor
+
+        # Every channel is a separate tree, spread them over the workers by size
+        root = self._root_of()
+        tree_sizes = np.bincount(root, minlength = self.size)
+        group_sizes = np.zeros(n_jobs, dtype = np.int64)
+        root_group = np.zeros(self.size, dtype = np.int32)
+        for r in self.roots[np.argsort(-tree_sizes[self.roots], kind = 'stable')]:
+            group = np.argmin(group_sizes)
+            root_group[r] = group
+            group_sizes[group] += tree_sizes[r]
+        node_group = root_group[root]
+
+        jobs = []
+        for group in range(n_jobs):
+            nodes = np.flatnonzero(node_group == group)
+            if len(nodes) == 0:
+                continue
+            # Re-index the parents within the group
+            local = np.full(self.size, -1, dtype = np.int32)
+            local[nodes] = np.arange(len(nodes), dtype = np.int32)
+            parents = self.parent_idx[nodes]
+            local_parents = np.where(parents >= 0, local[np.maximum(parents, 0)], -1).astype(np.int32)
+            jobs.append((nodes, (local_parents, self.depth[nodes], texts[nodes], separator, include_root)))
+
+        crumbs = np.empty(self.size, dtype = object)
+        with ProcessPoolExecutor(max_workers = len(jobs)) as executor:
+            futures = [(nodes, executor.submit(level_order_breadcrumbs, *args)) for nodes, args in jobs]
+            for nodes, future in futures:
+                crumbs[nodes] = future.result()
+        return crumbs
+
+def level_order_breadcrumbs(parent_idx, depth, texts, separator, include_root = True):
+    crumbs = texts.copy()    # Topics caught in a cycle (depth -1) keep their own text
+    order = np.argsort(depth, kind = 'stable')
+    sorted_depth = depth[order]
+    bounds = np.flatnonzero(np.diff(sorted_depth)) + 1
+    for nodes in np.split(order, bounds):
+        if len(nodes) == 0:
+            continue
+        level = depth[nodes[0]]
+        if level < 0 or (level == 1 and not include_root):
+            continue
+        if level == 0:
+            if not include_root:
+                crumbs[nodes] = ''
+            continue
+        crumbs[nodes] = texts[nodes] + separator + crumbs[parent_idx[nodes]]
+    return crumbs
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""Small helpers shared by the modules used in the training scripts"""
+
+import os, json, time, shutil, hashlib, logging
+import numpy as np
+
+def print_log(cfg, message):
+    if cfg.use_log:
+        logging.info(message)
+    else:
+        print(message)
+
+def file_hash(path, chunk_size = 1 << 24):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def write_directory(path, write_fn, replace = False):
+    '''
+    Fill a temporary directory with `write_fn(tmp_path)` and move it to `path` in one rename, so an interrupted run
+    never leaves a partial directory behind. An existing `path` is kept as it is (another process wrote the same
+    directory in the meantime) unless `replace` is set. `path` is then a symbolic link to the current version, which
+    is swapped in one rename so that readers never find it missing; the previous version is removed afterwards (the
+    processes that memory-mapped its files keep them).
+    '''
+    path = os.path.normpath(path)
+    tmp_path = f'{path}.tmp{os.getpid()}_{time.time_ns()}'
+    os.makedirs(tmp_path)
+    try:
+        write_fn(tmp_path)
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors = True)
+        raise
+
+    if not replace:
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            shutil.rmtree(tmp_path)
+        return path
+
+    version_path = tmp_path.replace('.tmp', '.v', 1)
+    os.rename(tmp_path, version_path)
+    link_path = f'{tmp_path}.link'
+    os.symlink(os.path.basename(version_path), link_path)
+    previous = os.path.realpath(path) if os.path.islink(path) else None
+    if os.path.isdir(path) and previous is None:
+        # A directory written before the links were used, it is moved aside as it cannot be replaced by a link
+        previous = f'{tmp_path}.previous'
+        os.rename(path, previous)
+    os.replace(link_path, path)
+    if previous is not None:
+        shutil.rmtree(previous, ignore_errors = True)
+    return path
+
+class MemoryMappedStore(object):
+    '''
+    A directory of `.npy` arrays and of a `meta.json`, the arrays named by `array_names` are memory-mapped when first
+    used. The processes receiving a pickled store re-open them instead of copying them.
+    '''
+    array_names = ()
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self._arrays = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+    @property
+    def arrays(self):
+        if self._arrays is None:
+            self._arrays = {name: np.load(os.path.join(self.path, f'{name}.npy'), mmap_mode = 'r') for name in self.array_names}
+        return self._arrays